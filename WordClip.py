@@ -1,11 +1,11 @@
-from youtube_utils import video_to_flac, download_video, change_audio_speed
-from google.cloud import speech_v1p1beta1
-import io
-import sys
+from youtube_utils import download_audio, fetch_slowed_clip
+from speech_to_text import get_recognizer, Transcript, RecognizedWord
+from video_alignment import load_alignment
+from audio_utils import decode_audio
+from run_ledger import get_ledger
 import os
 from pydub import AudioSegment
 from pydub.playback import play
-from subprocess import check_output
 
 
 '''
@@ -61,29 +61,27 @@ def next_raw_audio_filepath(word, attempt, speed):
 def next_cropped_audio_filepath(word, attempt, speed):
     cropped_audio_directory = f"{directories['AUDIO_DIRECTORY']}/{word}/attempt-{attempt}"
     if not os.path.exists(cropped_audio_directory):
-        os.makedirs(cropped_audio_directory)
-
-    crop_iterations = [x for x in os.listdir(cropped_audio_directory) if f'raw-{word}' not in x]
-    if crop_iterations == []:
-        crop_iteration = 0
-    else:
-        print(crop_iterations)
-        nums = [crop_iteration_from_filepath(filepath) for filepath in crop_iterations]
-        crop_iteration = max(nums) + 1
+        os.makedirs(cropped_audio_directory, exist_ok=True)
+
+    # Runs from before the ledger numbered crops by scanning the directory
+    def first_crop_iteration():
+        crop_iterations = [x for x in os.listdir(cropped_audio_directory) if f'raw-{word}' not in x]
+        return max([crop_iteration_from_filepath(filepath) for filepath in crop_iterations], default=-1) + 1
+
+    crop_iteration = get_ledger().next_id(f'crop/{word}/{attempt}', first=first_crop_iteration)
     return f"{cropped_audio_directory}/{word}-cropi-{crop_iteration}-speed-{speed}.flac"
 
 
 def next_raw_video_filepath(word):
     video_output_subdirectory = f"{directories['VIDEO_DIRECTORY']}/{word}"
     if not os.path.exists(video_output_subdirectory):
-        os.makedirs(video_output_subdirectory)
-
-    attempts = os.listdir(video_output_subdirectory)
-    if attempts == []:
-        attempt = 0
-    else:
-        nums = [attempt_from_filepath(video_output_subdirectory + '/' + x) for x in attempts if 'attempt' in x]
-        attempt = max(nums) + 1
+        os.makedirs(video_output_subdirectory, exist_ok=True)
+
+    def first_attempt():
+        attempts = [attempt_from_filepath(video_output_subdirectory + '/' + x) for x in os.listdir(video_output_subdirectory) if 'attempt' in x]
+        return max(attempts, default=-1) + 1
+
+    attempt = get_ledger().next_id(f'attempt/{word}', first=first_attempt)
     os.makedirs(f"{video_output_subdirectory}/attempt-{attempt}")
     video_output_filepath = f"{video_output_subdirectory}/attempt-{attempt}/raw-{word}.mkv"
 
@@ -93,49 +91,77 @@ def next_raw_video_filepath(word):
 
 
 class WordClip():
+    '''
+    A clip of a word in a video, and the root of the clips derived from it.
+
+    Only a raw clip touches the network or disk: its audio is downloaded and decoded once, the
+    first time it's needed. crop and change_speed derive children whose audio is held in memory
+    (crops are views into their parent's samples), and children are memoized per raw clip by
+    (speed, interval in the source video), so asking for the same crop twice returns the same
+    clip. Nothing derived is written to disk until save() is called on it.
+    '''
+
+    __slots__ = (
+        'raw', 'word', 'video_code', 'start_time', 'end_time', 'speed', 'logger', 'length', 'audio_filepath',
+        '_root', '_attempt', '_produce', '_audio', '_derived', '_transcription', '_occurrences',
+    )
 
-    def __init__(self, word, video_code, start_time, end_time, logger=None, speed=1, raw_video_filepath=None, raw_audio_filepath=None, raw_clip_start_time=None, raw_clip_end_time=None, audio_filepath=None):
-        # On generation one/raw clips, we download a video, then take the audio for operations.
-        # On child generations, we operate only on audio, but we still learn about where the video is.
+    def __init__(self, word, video_code, start_time, end_time, logger=None, speed=1, root=None, produce=None):
+        # A raw clip is made with the caption's interval, which is widened by a buffer.
+        # Children are made by crop and change_speed, with their interval in the source video
+        # and produce() returning their AudioBuffer
 
         # Check if we're the raw clip
-        self.raw = not audio_filepath
+        self.raw = root is None
 
         self.word = word
         self.video_code = video_code
-        self.start_time = start_time    # Refers to the start and end time of the initially downloaded clip
+        self.start_time = start_time    # Refers to the start and end time of this clip in the source video
         self.end_time = end_time
         self.speed = speed
         self.logger = logger
+        self._audio = None
+        self._transcription = None
+        self._occurrences = None
 
-        # If we're the first generation, download the video
+        # If we're the first generation, note where the audio will go. The video is only fetched by get_matching_video
         if self.raw:
-            self.raw_video_filepath = next_raw_video_filepath(word)
+            raw_video_filepath = next_raw_video_filepath(word)
             buffer = 5
-            download_video(video_code, start_time, end_time, self.raw_video_filepath, log_filepath=logger)
-            self.start_time = start_time-buffer    # Refers to the start and end time of the initially downloaded clip
+            self.start_time = start_time-buffer
             self.end_time = end_time+buffer
-            self._attempt = attempt_from_filepath(self.raw_video_filepath)
-            self.raw_clip_start_time = self.start_time
-            self.raw_clip_end_time = self.end_time
-            self.raw_audio_filepath = next_raw_audio_filepath(word, self._attempt, self.speed)
-            self.audio_filepath = self.raw_audio_filepath
-            self._convert_raw_video_to_audio(self.audio_filepath)
-            self._crop_iteration = None
-
-        # Not the first generation, don't download, just note where things already are
-        else:
-            self.raw_video_filepath = raw_video_filepath
-            self.raw_audio_filepath = raw_audio_filepath
-            self.raw_clip_start_time = raw_clip_start_time
-            self.raw_clip_end_time = raw_clip_end_time
+            self._root = self
+            self._attempt = attempt_from_filepath(raw_video_filepath)
+            self._derived = {}
+            self.audio_filepath = next_raw_audio_filepath(word, self._attempt, self.speed)
 
-            self._attempt = attempt_from_filepath(self.raw_video_filepath)
-            self.audio_filepath = audio_filepath
-            self._crop_iteration = crop_iteration_from_filepath(audio_filepath)
+            def produce():
+                download_audio(video_code, start_time, end_time, self.audio_filepath, safety_buffer=buffer, log_filepath=logger)
+                return decode_audio(self.audio_filepath, log_filepath=logger)
+            self._produce = produce
+
+        # Not the first generation, share the raw clip's family
+        else:
+            self._root = root
+            self._attempt = root._attempt
+            self._derived = root._derived
+            self.audio_filepath = None
+            self._produce = produce
 
         self.length = self.end_time - self.start_time
-        self._transcribe()
+
+
+    @property
+    def raw_audio_filepath(self):
+        return self._root.audio_filepath
+
+    @property
+    def raw_clip_start_time(self):
+        return self._root.start_time
+
+    @property
+    def raw_clip_end_time(self):
+        return self._root.end_time
 
 
     def __iter__(self):
@@ -151,135 +177,131 @@ class WordClip():
                 f'Interval: ({self.start_time}, {self.end_time})\n' +\
                 f'Transcript: {self.transcript}\n'
 
-    def _convert_raw_video_to_audio(self, raw_audio_filepath):
-        '''Converts raw video to audio. Only needs to be done in first generation constructor.'''
-        video_to_flac(self.raw_video_filepath, raw_audio_filepath, self.logger)
+    def play(self):
+        samples = self.audio.samples.astype('<i2').tobytes()
+        play(AudioSegment(data=samples, sample_width=2, frame_rate=self.audio.sample_rate, channels=1))
 
 
-    def play(self):
-        sound = AudioSegment.from_file(self.audio_filepath)
-        play(sound)
+    @property
+    def audio(self):
+        '''This clip's AudioBuffer, produced the first time it's asked for.'''
+        if self._audio is None:
+            self._audio = self._produce()
+            self._produce = None
+        return self._audio
 
 
-    def save(self):
-        pass
+    def save(self, filepath=None):
+        '''Writes this clip's audio to filepath, or the next free crop filepath. Returns where it went.'''
+        if self.raw:
+            self.audio
+            return self.audio_filepath
+
+        filepath = filepath or next_cropped_audio_filepath(self.word, self._attempt, self.speed)
+        self.audio.save(filepath, self.logger)
+        self.audio_filepath = filepath
+        return filepath
+
+
+    @property
+    def transcription(self):
+        self._transcribe()
+        return self._transcription or None
+
+    @property
+    def transcript(self):
+        return self.transcription.transcript.lower() if self.transcription else None
+
+    @property
+    def transcibed_words(self):
+        return list(self.transcription.words) if self.transcription else []
+
+    @property
+    def transcribed_word_strings(self):
+        return [w.word.lower() for w in self.transcibed_words]
+
+
+    def _aligned_transcription(self):
+        '''The transcription of a raw clip read from its video's alignment, or None if it has none.'''
+        # Derived clips are slowed or cropped, so alignment times don't apply to them
+        if not self.raw:
+            return None
+        alignment = load_alignment(self.video_code)
+        if alignment is None:
+            return None
+
+        words = [RecognizedWord(w.word, w.start_time - self.start_time, w.end_time - self.start_time, w.confidence)
+                 for w in alignment.words_between(self.start_time, self.end_time)]
+        if words == []:
+            return None
+        return Transcript(' '.join(w.word for w in words), words)
 
 
     def _transcribe(self):
-        client = speech_v1p1beta1.SpeechClient()
-        enable_word_time_offsets = True
-        enable_word_confidence = True
-        language_code = "en-US"
-        config = {
-            "enable_word_confidence": enable_word_confidence,
-            "enable_word_time_offsets": enable_word_time_offsets,
-            "language_code": language_code,
-        }
-        with io.open(self.audio_filepath, "rb") as f:
-            content = f.read()
-        audio = {"content": content}
-
-        response = client.recognize(config, audio)
-
-
-        # TODO: We throw out alternatives and only use the first one.. they may be helpful
-
-        # The first result includes start and end time word offsets
-        try:
-            result = response.results[0]
-        except IndexError:
-            self.transcription = None
-            self.transcript = None
-            self.transcribed_word_strings = []
-            self.transcibed_words = []
-            # raise NoTranscriptionError(f'No words were found in clip {self.audio_filepath}')
+        if self._occurrences is not None:
             return
 
-        # First alternative is the most probable result
-        alternative = result.alternatives[0]
-        self.transcription = alternative
-        self.transcript = alternative.transcript.lower()
-        self.transcribed_word_strings = [w.word.lower() for w in alternative.words]
-        self.transcibed_words = [w for w in alternative.words]
+        alternative = self._aligned_transcription()
+
+        if alternative is None:
+            # The process-wide recognizer keeps its clients alive between clips
+            alternative = get_recognizer().recognize(self.audio.to_wav_bytes())
+
+        # Silence is remembered as False, so it isn't recognized again
+        self._transcription = alternative or False
+        self._occurrences = {}
+        for w in (alternative.words if alternative else []):
+            self._occurrences.setdefault(w.word.lower(), []).append(w)
+        # raise NoTranscriptionError(f'No words were found in clip {self.audio_filepath}')
+
+
+    def occurrences_of(self, word):
+        self._transcribe()
+        return self._occurrences.get(word.lower(), [])
 
 
     def interval_of(self, word):
-        if word.lower() not in [w.lower() for w in self.transcribed_word_strings]:
+        occurrences = self.occurrences_of(word)
+        if occurrences == []:
             return None
-
-        for w in self.transcibed_words:
-            if w.word.lower() == word.lower():
-                start_time = float(str(w.start_time.seconds) + '.' + str(w.start_time.nanos))
-                end_time = float(str(w.end_time.seconds) + '.' + str(w.end_time.nanos))
-                return (start_time, end_time)
+        return (occurrences[0].start_time, occurrences[0].end_time)
 
 
     def confidence_of(self, word):
-        if word.lower() not in [w.lower() for w in self.transcribed_word_strings]:
+        occurrences = self.occurrences_of(word)
+        if occurrences == []:
             return None
+        return occurrences[0].confidence
+
 
-        for w in self.transcibed_words:
-            if w.word.lower() == word.lower():
-                return w.confidence
+    def _derive(self, speed, start_time, end_time, produce):
+        '''The family's clip for (speed, interval), made with produce() only if it doesn't exist yet.'''
+        key = (speed, round(start_time, 3), round(end_time, 3))
+        if key not in self._derived:
+            self._derived[key] = WordClip(self.word, self.video_code, start_time, end_time, logger=self.logger, speed=speed, root=self._root, produce=produce)
+        return self._derived[key]
 
 
     def change_speed(self, speed):
-        new_audio_filepath = next_cropped_audio_filepath(self.word, self._attempt, speed)
-        change_audio_speed(self.audio_filepath, speed, new_audio_filepath, log_filepath=self.logger)
-        return WordClip(
-            self.word,
-            self.video_code,
-            self.start_time,
-            self.end_time,
-            logger=self.logger,
-            speed=speed,
-            raw_video_filepath=self.raw_video_filepath,
-            raw_audio_filepath=self.raw_audio_filepath,
-            raw_clip_start_time=self.raw_clip_start_time,
-            raw_clip_end_time=self.raw_clip_end_time,
-            audio_filepath=new_audio_filepath
-        )
+        '''This clip's interval at speed, which is relative to the source video.'''
+        root = self._root
 
+        # Always slowed from the raw audio, so speed changes never stack
+        def produce():
+            offset = self.start_time - root.start_time
+            return root.audio.slice(offset, offset + self.length).change_speed(speed, self.logger)
 
-    def crop(self, interval):
-        '''Crops our audio file, adds the cropped audio to a directory, and creates a new WordClip to handle that audio file'''
+        return self._derive(speed, self.start_time, self.end_time, produce)
 
-        cropped_audio_filepath = next_cropped_audio_filepath(self.word, self._attempt, self.speed)
 
+    def crop(self, interval):
+        '''Returns the clip of the (start, end) seconds of this clip's audio.'''
         crop_start_time, crop_end_time = interval
-        clip_length = crop_end_time - crop_start_time
-
-        print('cs', crop_start_time)
-        print('ce', crop_end_time)
-        print('st', self.start_time)
-        print('et', self.end_time)
-
-
-        with open(self.logger, 'a') as log:
-            if clip_length > 0.1:
-                # Should swap
-                # Insanity in the numbers here lets us crop from the raw file
-                cropping_command = f'ffmpeg -y -ss 0 -i {self.raw_audio_filepath} -ss {self.start_time+crop_start_time - self.raw_clip_start_time} -t {self.end_time+(crop_end_time-self.length) - (self.start_time+crop_start_time)} -c:a flac {cropped_audio_filepath}'
-                print(cropping_command)
-                check_output(cropping_command, shell=True, stderr=log)
-            else:
-                print("FUCK")
-
-
-        # TODO: Proper calculations for start and end time need to be made & take speed into account
-        return WordClip(
-            self.word,
-            self.video_code,
-            self.start_time+crop_start_time,
-            self.end_time+(crop_end_time-self.length),
-            logger=self.logger,
-            speed=self.speed,
-            raw_video_filepath=self.raw_video_filepath,
-            raw_audio_filepath=self.raw_audio_filepath,
-            raw_clip_start_time=self.raw_clip_start_time,
-            raw_clip_end_time=self.raw_clip_end_time,
-            audio_filepath=cropped_audio_filepath
-        )
+
+        # Our audio runs at self.speed, the source interval is measured at normal speed
+        start_time = self.start_time + crop_start_time * self.speed
+        end_time = self.start_time + crop_end_time * self.speed
+        return self._derive(self.speed, start_time, end_time, lambda: self.audio.slice(crop_start_time, crop_end_time))
 
 
     def crop_beginning(self, distance):
@@ -293,18 +315,14 @@ class WordClip():
 
 
     def get_matching_video(self):
-        raw_audio_directory = f"{directories['VIDEO_DIRECTORY']}/{word}/attempt-{attempt}"
-        video_filepath = f"{raw_audio_directory}/{word}.mkv"
+        '''Downloads the video for just this clip's interval, at this clip's speed.'''
+        video_directory = f"{directories['VIDEO_DIRECTORY']}/{self.word}/attempt-{self._attempt}"
+        video_filepath = f"{video_directory}/{self.word}-speed-{self.speed}.mkv"
 
-        crop_start_time = self.start_time
-        crop_end_time = self.end_time
-        clip_length = crop_end_time - crop_start_time
-
-        with open(self.logger, 'a') as log:
-            if clip_length > 0:
-                cropping_command = f'ffmpeg -y -ss 0 -i {self.raw_video_filepath} -ss {crop_start_time} -t {crop_end_time - crop_start_time} -c:v libx264 -c:a flac {video_filepath}'
-                check_output(cropping_command, shell=True, stderr=log)
+        if self.length <= 0:
+            return None
 
+        fetch_slowed_clip(self.video_code, self.start_time, self.end_time, self.speed, video_output=video_filepath, safety_buffer=0, log_filepath=self.logger)
 
         print(video_filepath)
         return video_filepath
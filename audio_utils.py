@@ -0,0 +1,76 @@
+import io
+import os
+import wave
+import numpy as np
+from subprocess import check_output, run, PIPE
+
+
+'''
+Audio held in memory as NumPy sample buffers.
+
+A clip is decoded once, candidate crops are views into the same samples, and a crop
+only becomes bytes when it is sent for recognition (as an in-memory WAV) or saved.
+'''
+
+
+SAMPLE_RATE = 16000
+
+
+class AudioBuffer():
+    '''Mono 16-bit samples and their rate. Slicing shares memory with the parent buffer.'''
+
+    def __init__(self, samples, sample_rate=SAMPLE_RATE):
+        self.samples = samples
+        self.sample_rate = sample_rate
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        return f'AudioBuffer({round(self.duration, 3)}s at {self.sample_rate}Hz)'
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def slice(self, start_time, end_time):
+        '''Returns the [start_time, end_time] seconds of this buffer without copying.'''
+        first = max(0, int(round(start_time * self.sample_rate)))
+        last = min(len(self.samples), int(round(end_time * self.sample_rate)))
+        return AudioBuffer(self.samples[first:max(first, last)], self.sample_rate)
+
+    def to_wav_bytes(self):
+        '''Encodes the samples as LINEAR16 WAV in memory, which the Speech API reads directly.'''
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(np.ascontiguousarray(self.samples, dtype='<i2').tobytes())
+        return buffer.getvalue()
+
+    def change_speed(self, speed, log_filepath=''):
+        '''Returns a new buffer played at speed, keeping pitch, without touching disk.'''
+        if speed == 1:
+            return self
+        command = ['ffmpeg', '-f', 's16le', '-ar', str(self.sample_rate), '-ac', '1', '-i', '-', '-filter:a', f'atempo={speed}', '-f', 's16le', '-']
+        with open(log_filepath or os.devnull, 'a') as log:
+            log.write(f'Executing: {" ".join(command)}\n')
+            raw = run(command, input=np.ascontiguousarray(self.samples, dtype='<i2').tobytes(), stdout=PIPE, stderr=log, check=True).stdout
+        return AudioBuffer(np.frombuffer(raw, dtype='<i2'), self.sample_rate)
+
+    def save(self, filepath, log_filepath=''):
+        '''Writes the samples to filepath, in whatever format its extension asks ffmpeg for.'''
+        command = ['ffmpeg', '-y', '-f', 's16le', '-ar', str(self.sample_rate), '-ac', '1', '-i', '-', filepath]
+        with open(log_filepath or os.devnull, 'a') as log:
+            log.write(f'Executing: {" ".join(command)}\n')
+            run(command, input=np.ascontiguousarray(self.samples, dtype='<i2').tobytes(), stdout=PIPE, stderr=log, check=True)
+
+
+def decode_audio(filepath, sample_rate=SAMPLE_RATE, log_filepath=''):
+    '''Decodes any audio ffmpeg can read into a mono AudioBuffer, in a single process.'''
+    command = ['ffmpeg', '-i', filepath, '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), '-']
+    with open(log_filepath or os.devnull, 'a') as log:
+        log.write(f'Executing: {" ".join(command)}\n')
+        raw = check_output(command, stderr=log)
+    return AudioBuffer(np.frombuffer(raw, dtype='<i2'), sample_rate)
@@ -0,0 +1,154 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from run_ledger import get_ledger
+
+
+'''
+Ranked vocabulary candidates, so clip_word downloads the clips most likely to work first.
+
+A word's rows are scored once and kept in SQLite, where the best k come out of an index in
+O(k). A row's score is a fixed part, from the row itself, plus a part shared by every row of
+its video, learnt from how clipping from that video went:
+
+    row:   caption span length (up to 2 seconds), less a penalty for rows of the same video
+           within a second of it, which is what rolling auto captions leave behind
+    video: success rate of attempts on the video (with a uniform prior), plus the mean
+           confidence of its successful clips
+
+Each outcome updates its video's statistics and rescores only that video's rows. The
+statistics are seeded from the run ledger the first time the ranking is opened.
+'''
+
+
+CANDIDATE_RANKING_FILEPATH = './cache/candidates.sqlite'
+
+MAX_SPAN_LENGTH = 2.0
+DUPLICATE_WINDOW = 1.0
+DEFAULT_CONFIDENCE = 0.85
+
+# What clip_word records for rows that failed, and so feeds to record(success=False). Other
+# outcomes, e.g. cancelled speculative attempts that may well have passed, say nothing of the video
+FAILED_OUTCOMES = ('word not found', 'not isolated', 'fetch failed', 'search failed')
+
+
+def row_score(clip_info, neighbours):
+    '''The part of a row's score that depends only on the row and the other rows of its video.'''
+    video_code, start_time, end_time = clip_info
+    span = min(end_time - start_time, MAX_SPAN_LENGTH) / MAX_SPAN_LENGTH
+    duplicates = sum(1 for s in neighbours if s != start_time and abs(s - start_time) < DUPLICATE_WINDOW)
+    return span - 0.25 * min(duplicates, 2)
+
+
+def video_score(successes, failures, confidence_sum):
+    success_rate = (successes + 1) / (successes + failures + 2)
+    mean_confidence = confidence_sum / successes if successes else DEFAULT_CONFIDENCE
+    return 2 * success_rate + mean_confidence
+
+
+class CandidateRanking():
+
+    def __init__(self, filepath=CANDIDATE_RANKING_FILEPATH):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._db = sqlite3.connect(filepath, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS candidates (word TEXT, video_code TEXT, start_time REAL, end_time REAL, prior REAL, score REAL, PRIMARY KEY (word, video_code, start_time, end_time))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS candidates_by_score ON candidates (word, score DESC)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS candidates_by_video ON candidates (video_code)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS words (word TEXT PRIMARY KEY, row_count INTEGER, ranked REAL)')
+            seeded = self._db.execute("SELECT name FROM sqlite_master WHERE name = 'videos'").fetchone()
+            self._db.execute('CREATE TABLE IF NOT EXISTS videos (video_code TEXT PRIMARY KEY, successes INTEGER, failures INTEGER, confidence_sum REAL)')
+        if not seeded:
+            self._seed_from_ledger()
+
+    def _seed_from_ledger(self):
+        for attempt in get_ledger().attempts():
+            video_code = attempt['inputs'].get('video_code')
+            if video_code is None or attempt['outcome'] not in ('clipped',) + FAILED_OUTCOMES:
+                continue
+            self._count(video_code, attempt['outcome'] == 'clipped', attempt['outputs'].get('confidence', 0))
+
+    def _count(self, video_code, success, confidence):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR IGNORE INTO videos VALUES (?, 0, 0, 0)', (video_code,))
+            if success:
+                self._db.execute('UPDATE videos SET successes = successes + 1, confidence_sum = confidence_sum + ? WHERE video_code = ?', (confidence, video_code))
+            else:
+                self._db.execute('UPDATE videos SET failures = failures + 1 WHERE video_code = ?', (video_code,))
+            successes, failures, confidence_sum = self._db.execute('SELECT successes, failures, confidence_sum FROM videos WHERE video_code = ?', (video_code,)).fetchone()
+            self._db.execute('UPDATE candidates SET score = prior + ? WHERE video_code = ?', (video_score(successes, failures, confidence_sum), video_code))
+
+    def _video_scores(self, video_codes):
+        scores = {video_code: video_score(0, 0, 0) for video_code in video_codes}
+        for video_code, successes, failures, confidence_sum in self._db.execute('SELECT * FROM videos'):
+            if video_code in scores:
+                scores[video_code] = video_score(successes, failures, confidence_sum)
+        return scores
+
+    def refresh(self, word, clip_info_list):
+        '''Ranks word's rows, unless the ranking already holds as many as clip_info_list.'''
+        with self._lock:
+            row = self._db.execute('SELECT row_count FROM words WHERE word = ?', (word,)).fetchone()
+            if row is not None and row[0] == len(clip_info_list):
+                return
+
+            starts_by_video = {}
+            for video_code, start_time, end_time in clip_info_list:
+                starts_by_video.setdefault(video_code, []).append(start_time)
+            video_scores = self._video_scores(starts_by_video)
+
+            rows = []
+            for clip_info in clip_info_list:
+                prior = row_score(clip_info, starts_by_video[clip_info[0]])
+                rows += [(word, *clip_info, prior, prior + video_scores[clip_info[0]])]
+            with self._db:
+                self._db.execute('DELETE FROM candidates WHERE word = ?', (word,))
+                self._db.executemany('INSERT OR REPLACE INTO candidates VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self._db.execute('INSERT OR REPLACE INTO words VALUES (?, ?, ?)', (word, len(clip_info_list), time.time()))
+
+    def count(self, word):
+        with self._lock:
+            row = self._db.execute('SELECT row_count FROM words WHERE word = ?', (word,)).fetchone()
+        return row[0] if row else 0
+
+    def top(self, word, k=1):
+        '''The k best ranked (video_code, start_time, end_time) rows of word.'''
+        with self._lock:
+            return self._db.execute('SELECT video_code, start_time, end_time FROM candidates WHERE word = ? ORDER BY score DESC LIMIT ?', (word, k)).fetchall()
+
+    def record(self, word, clip_info, success, confidence=0):
+        '''Learns from an attempt on clip_info. A failed row is dropped from the ranking.'''
+        video_code, start_time, end_time = clip_info
+        if not success:
+            with self._lock, self._db:
+                removed = self._db.execute('DELETE FROM candidates WHERE word = ? AND video_code = ? AND start_time = ? AND end_time = ?', (word, video_code, start_time, end_time)).rowcount
+                self._db.execute('UPDATE words SET row_count = row_count - ? WHERE word = ?', (removed, word))
+        self._count(video_code, success, confidence)
+
+
+_candidate_ranking = None
+_candidate_ranking_lock = threading.Lock()
+
+def get_candidate_ranking():
+    global _candidate_ranking
+    with _candidate_ranking_lock:
+        if _candidate_ranking is None:
+            _candidate_ranking = CandidateRanking()
+        return _candidate_ranking
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('word')
+    parser.add_argument('-k', type=int, default=10, help='How many candidates to show')
+    args = parser.parse_args()
+
+    for video_code, start_time, end_time in get_candidate_ranking().top(args.word, args.k):
+        print(f'{video_code}\t{start_time}\t{end_time}')
@@ -1,10 +1,21 @@
 import argparse
 import os
-import csv
-from subprocess import check_output
-from youtube_utils import download_video, video_to_flac, upload_blob, change_video_speed, seconds_to_timecode
+import asyncio
+import threading
+from youtube_utils import fetch_slowed_clip, fetch_slowed_clip_async, video_to_flac, upload_blob, seconds_to_timecode
 from speech_to_text import sample_recognize
-from shutil import copyfile
+from audio_utils import decode_audio
+from crop_search import search_crop, evaluate_concurrently, ISOLATED, NOT_ISOLATED, MISSING
+from voice_activity import snap_boundaries
+from multiplexed_recognition import recognize_multiplexed
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from vocabulary_index import VocabularyIndex, read_tsv_shard, VOCAB_INDEX_FILEPATH
+from video_alignment import best_aligned_occurrence
+from run_ledger import get_ledger
+from tombstones import get_tombstones
+from candidate_ranking import get_candidate_ranking
+from trusted_vocabulary import trusted_vocabulary_filepath, read_trusted_vocabulary, add_to_trusted_vocabulary, set_artifact, trusted_artifact
 
 LOG_DIRECTORY = './logs'
 VOCAB_DIRECTORY = './vocabulary'
@@ -16,24 +27,31 @@ GOOD_CLIPS_SUBDIRECTORY = 'words'
 
 clean_word = lambda x: ''.join([c for c in x.lower() if c.isalpha() or c.isdigit() or c==' ']).rstrip()
 
-def get_word_time(word, audio_filepath, must_isolate=False, min_confidence=0.7, log_filepath=''):
+def get_word_time(word, audio_filepath, must_isolate=False, min_confidence=0.7, log_filepath='', content=None):
     # TODO: Allow for close matches e.g. Hillbillies to hill billies
     # Use GCP Speech-to-Text to refine clip cropping
-    found_word = False
-    start_time = 0
-    end_time = 0
-    confidence = 0
     try:
-        text = sample_recognize(audio_filepath, log_filepath)
+        text = sample_recognize(audio_filepath, log_filepath, content=content)
     except IndexError:
         raise FileNotFoundError("GCP didn't detect the word in our clip. Exiting...")
+    return word_time_in_transcript(word, text, must_isolate, min_confidence)
+
 
+def word_time_in_transcript(word, text, must_isolate=False, min_confidence=0.7):
+    '''get_word_time for a Transcript we already have, e.g. one clip's share of a multiplexed request.'''
+    if text is None:
+        raise FileNotFoundError("GCP didn't detect the word in our clip. Exiting...")
+
+    found_word = False
+    start_time = 0
+    end_time = 0
+    confidence = 0
     for w in text.words:
         if clean_word(w.word) == word:
             found_word = True
-            start_time = float(str(w.start_time.seconds) + '.' + str(w.start_time.nanos))
-            end_time = float(str(w.end_time.seconds) + '.' + str(w.end_time.nanos))
-            confidence = float(w.confidence)
+            start_time = w.start_time
+            end_time = w.end_time
+            confidence = w.confidence
 
             if must_isolate and len(text.words) > 1:
                 raise FileExistsError("GCP detected our word but not isolated.")
@@ -44,42 +62,54 @@ def get_word_time(word, audio_filepath, must_isolate=False, min_confidence=0.7,
     return start_time, end_time, confidence
 
 
+_vocabulary_index = None
+_vocabulary_index_mtime = None
+
+def vocabulary_index():
+    '''Returns the memory-mapped vocabulary index, or None if it hasn't been imported. Reopened whenever it is rebuilt.'''
+    global _vocabulary_index, _vocabulary_index_mtime
+    if not os.path.exists(VOCAB_INDEX_FILEPATH):
+        return None
+    mtime = os.stat(VOCAB_INDEX_FILEPATH).st_mtime_ns
+    if _vocabulary_index is None or mtime != _vocabulary_index_mtime:
+        # The old map isn't closed, a lookup on another thread may still be reading it
+        _vocabulary_index, _vocabulary_index_mtime = VocabularyIndex(VOCAB_INDEX_FILEPATH), mtime
+    return _vocabulary_index
+
+
+def in_vocabulary(word):
+    index = vocabulary_index()
+    if index is not None and word in index:
+        return True
+    return os.path.exists(vocabulary_filepath(word))
+
+
+def index_is_current(word):
+    '''
+    Whether the index holds every row of word. The index is built from the TSV shards, and
+    expand_vocabulary only appends to shards, so a shard written since holds rows it lacks.
+    '''
+    shard_filepath = vocabulary_filepath(word)
+    if not os.path.exists(shard_filepath):
+        return True
+    return os.stat(shard_filepath).st_mtime_ns <= _vocabulary_index_mtime
+
+
 def get_clip_information(word):
-    tsv_filepath = vocabulary_filepath(word)
-    clip_info_list = []
-    with open(tsv_filepath, mode='r') as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        next(reader)
-        for row in reader:
-            clip_info_list += [(row[0], float(row[1]), float(row[2]))]
-    return clip_info_list
-
-
-def erase_tsv_row(word, selection_function):
-    # Read all into memory
-    tsv_filepath = vocabulary_filepath(word)
-    clip_info_list = []
-    with open(tsv_filepath, mode='r') as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        next(reader)
-        for row in reader:
-            clip_info_list += [(row[0], float(row[1]), float(row[2]))]
-
-    dont_write = selection_function(clip_info_list)
-    clip_info_list = [x for x in clip_info_list if x != dont_write]
-
-    # Delete TSV
-    os.remove(tsv_filepath)
-
-    # Quit here if no clips are left
-    if clip_info_list == []:
-        return
-
-    with open(tsv_filepath, mode='a') as out:
-        writer = csv.writer(out, delimiter='\t', lineterminator='\n')
-        writer.writerow(['video_code', 'start_time', 'end_time'])
-        for row in clip_info_list:
-            writer.writerow(row)
+    # Prefer the single-file index, fall back to the per-word TSV shard
+    index = vocabulary_index()
+    if index is not None and word in index and index_is_current(word):
+        clip_info_list = index.lookup(word)
+    else:
+        clip_info_list = read_tsv_shard(vocabulary_filepath(word))
+
+    # Rows rejected since the vocabulary was last compacted
+    return get_tombstones().alive(word, clip_info_list)
+
+
+def reject_clip_information(word, clip_info):
+    '''Marks a row of the vocabulary bad. Applied to the TSV shards and index by tombstones.py compact.'''
+    get_tombstones().reject(word, clip_info)
 
 
 def vocabulary_filepath(word):
@@ -88,59 +118,109 @@ def vocabulary_filepath(word):
     return filepath
 
 
-def next_clean_log_file(safe_word):
-    log_subdirectory = f'{LOG_DIRECTORY}/{safe_word}'
-    if not os.path.exists(log_subdirectory):
-        os.makedirs(log_subdirectory)
+def word_video_interval(clip_info):
+    '''The source interval of a word whose times were measured in a slowed clip, which began safety_buffer before the caption.'''
+    source_start_time = clip_info['clip_start_time'] - clip_info['safety_buffer']
+    word_start_time = source_start_time + clip_info['start_time'] * clip_info['speed_multiplier']
+    word_end_time = source_start_time + clip_info['end_time'] * clip_info['speed_multiplier']
+    return word_start_time, word_end_time
+
 
+def render_word_video(clip_info, output, log_filepath=''):
+    '''Downloads just the video behind a chosen word interval and slows it to match the audio it was judged on.'''
+    word_start_time, word_end_time = word_video_interval(clip_info)
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    fetch_slowed_clip(clip_info['video_code'], word_start_time, word_end_time, clip_info['speed_multiplier'], video_output=output, safety_buffer=0, log_filepath=log_filepath)
+
+
+async def render_word_video_async(clip_info, output, log_filepath=''):
+    word_start_time, word_end_time = word_video_interval(clip_info)
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    await fetch_slowed_clip_async(clip_info['video_code'], word_start_time, word_end_time, clip_info['speed_multiplier'], video_output=output, safety_buffer=0, log_filepath=log_filepath)
+
+
+def aligned_clip_information(video_code, occurrence):
+    '''
+    An aligned word as trusted clip information. The clip is the word itself, and the word's
+    interval is measured as in clip_word, in the clip slowed and widened by a safety_buffer.
+    '''
+    speed_multiplier = 0.7
+    safety_buffer = 1
+    return {
+        'video_code': video_code,
+        'clip_start_time': occurrence.start_time,
+        'clip_end_time': occurrence.end_time,
+        'safety_buffer': safety_buffer,
+        'speed_multiplier': speed_multiplier,
+        'start_time': safety_buffer / speed_multiplier,
+        'end_time': (safety_buffer + occurrence.end_time - occurrence.start_time) / speed_multiplier,
+    }
+
+
+def clip_aligned_word(safe_word, video_code, occurrence, log_filepath=''):
+    '''Cuts a word at the interval an aligned video gives for it, slowed like any other clip.'''
+    speed_multiplier = 0.7
+    cropped_audio_directory = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/cropped'
+    if not os.path.exists(cropped_audio_directory):
+        os.makedirs(cropped_audio_directory)
+    good_clips_directory = f'{MEDIA_DIRECTORY}/{GOOD_CLIPS_SUBDIRECTORY}'
+    if not os.path.exists(good_clips_directory):
+        os.makedirs(good_clips_directory)
+
+    cropped_mono_filepath = f'{cropped_audio_directory}/{safe_word}-{video_code}-{int(occurrence.start_time*1000)}.flac'
+    final_filepath = f'{good_clips_directory}/{safe_word}-{round(occurrence.confidence, 2)}.mkv'
+    fetch_slowed_clip(video_code, occurrence.start_time, occurrence.end_time, speed_multiplier, audio_output=cropped_mono_filepath, video_output=final_filepath, safety_buffer=0, log_filepath=log_filepath)
+    return final_filepath
+
+
+def first_free_index(filepath_template):
+    '''Index of the first filepath_template.format(index) not on disk, for runs from before the ledger.'''
     index = 0
-    LOG_FILEPATH = f'{log_subdirectory}/{safe_word}-{index}.txt'
-    while os.path.exists(LOG_FILEPATH):
+    while os.path.exists(filepath_template.format(index)):
         index += 1
-        LOG_FILEPATH = f'{log_subdirectory}/{safe_word}-{index}.txt'
-    return LOG_FILEPATH
+    return index
 
 
-def trusted_load(safe_word, tsv_filepath):
-    LOG_FILEPATH = next_clean_log_file(safe_word)
+def next_clean_log_file(safe_word):
+    log_subdirectory = f'{LOG_DIRECTORY}/{safe_word}'
+    if not os.path.exists(log_subdirectory):
+        os.makedirs(log_subdirectory, exist_ok=True)
 
-    clip_info_list = []
-    with open(tsv_filepath, mode='r') as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        next(reader)
-        for row in reader:
-            clip_info_list += [(
-                row[0],
-                float(row[1]),
-                float(row[2]),
-                float(row[3]),
-                float(row[4]),
-                float(row[5]),
-            )]
-    clip_info = clip_info_list[0]
-    video_code, clip_start_time, clip_end_time, speed_multiplier, word_start_time, word_end_time = clip_info
-
-    clip_filepath = f'{MEDIA_DIRECTORY}/{VIDEO_SUBDIRECTORY}/raw-clips/{safe_word}/{safe_word}.mkv'
-    safety_buffer = 1
-    download_video(video_code, clip_start_time, clip_end_time, clip_filepath, safety_buffer=safety_buffer, log_filepath=LOG_FILEPATH)
+    log_template = log_subdirectory + '/' + safe_word + '-{}.txt'
+    index = get_ledger().next_id(f'log/{safe_word}', first=lambda: first_free_index(log_template))
+    return log_template.format(index)
 
-    slow_clip_filepath = f'{MEDIA_DIRECTORY}/{VIDEO_SUBDIRECTORY}/slow-clips/{safe_word}-{int(speed_multiplier*100)}-percent.mkv'
-    change_video_speed(clip_filepath, 0.7, slow_clip_filepath, LOG_FILEPATH)
 
-    slow_word_modified_filepath = f'video/slow-word-clips/{safe_word}.mkv'
-    cropping_command = f'ffmpeg -y -ss 0 -i {slow_clip_filepath} -ss {word_start_time} -t {word_end_time - word_start_time} -c:v libx264 -c:a aac {slow_word_modified_filepath}'
-    with open(LOG_FILEPATH, 'a') as log:
-        check_output(cropping_command, shell=True, stderr=log)
+def trusted_load(safe_word, tsv_filepath, edition=0):
+    '''Returns the video of an edition of a trusted word, rendering and storing it only if it was never stored.'''
+    filepath = trusted_artifact(tsv_filepath, edition)
+    if filepath is not None:
+        return filepath
 
-    final_filepath = f'video/best-clips/{safe_word}.mkv'
-    copyfile(slow_word_modified_filepath, final_filepath)
+    LOG_FILEPATH = next_clean_log_file(safe_word)
+    video_code, clip_start_time, clip_end_time, speed_multiplier, word_start_time, word_end_time, digest = read_trusted_vocabulary(tsv_filepath)[edition]
+    print(f'Rendering edition {edition} of trusted word "{safe_word}" from {video_code}')
 
-    return final_filepath
+    # Trusted intervals are measured like clip_word's, in a clip slowed and widened by a second
+    clip_info = {
+        'video_code': video_code,
+        'clip_start_time': clip_start_time,
+        'clip_end_time': clip_end_time,
+        'safety_buffer': 1,
+        'speed_multiplier': speed_multiplier,
+        'start_time': word_start_time,
+        'end_time': word_end_time,
+    }
+    rendered_filepath = f'{MEDIA_DIRECTORY}/{GOOD_CLIPS_SUBDIRECTORY}/trusted/{safe_word}-{edition}.mkv'
+    render_word_video(clip_info, rendered_filepath, LOG_FILEPATH)
+    return set_artifact(tsv_filepath, edition, rendered_filepath)
 
 
 
 
-def clip_word(word):
+def clip_word(word, max_in_flight=4, cancel_on_hit=True, multiplex=False, use_alignments=True, speculate=1, prefetch=1, use_trusted=True):
     '''
     Algorithm
         Clean word (to avoid errors from bad strings & directories)
@@ -157,234 +237,430 @@ def clip_word(word):
             Convert new clip to FLAC
             Use GCP to transcribe clip
             If transcription is not just our word, remove row one of TSV & return to (1)
+
+        Crop candidates are recognized up to max_in_flight at a time. With cancel_on_hit, the
+        first isolated, high confidence candidate cancels the ones that haven't been sent yet.
+        With multiplex, each round's candidates are instead packed into a single request.
+
+        Candidates flow through an asyncio pipeline (see clip_candidates): while one is being
+        recognized and cropped, the next prefetch candidates are already downloading. With
+        speculate above 1, that many are recognized and cropped at once. The first to pass wins,
+        the others are cancelled and their media deleted.
+
+        With use_alignments, a word heard confidently in an aligned video (see video_alignment)
+        is cut straight from there, skipping (1) to (3). Without use_trusted, occurrences and
+        vocabulary rows the word's trusted editions came from are passed over, to stock another.
     '''
+    return asyncio.run(clip_word_async(word, max_in_flight, cancel_on_hit, multiplex, use_alignments, speculate, prefetch, use_trusted))
+
+
+async def clip_word_async(word, max_in_flight=4, cancel_on_hit=True, multiplex=False, use_alignments=True, speculate=1, prefetch=1, use_trusted=True):
+    '''clip_word for callers already running an event loop, e.g. to clip many words at once.'''
 
     # TODO
-    # Stop re-downloading elements if they exist locally
-    # Also delete videos or move to an archive if they are failures
+    # Delete videos or move to an archive if they are failures
+
+    loop = asyncio.get_running_loop()
 
     # Clean word
     safe_word = clean_word(word)
 
     # Check if we have a trusted clip source to use
-    vocab_subdirectory = word[0].upper()
-    filepath = f'./trusted-vocabulary/{vocab_subdirectory}/{safe_word}.tsv'
-    if os.path.exists(filepath):
+    filepath = trusted_vocabulary_filepath(safe_word)
+    if use_trusted and os.path.exists(filepath):
         print(f'Performing trusted load on {safe_word}')
-        return trusted_load(safe_word, filepath)
-
-
-    word_retrieved = False
-    while not word_retrieved:
-        LOG_FILEPATH = next_clean_log_file(safe_word)
-        generated_clips_info = {}
-
-        # If word not in vocabulary, throw error
-        print(f'Checking if "{safe_word}" is in vocabulary...')
-        filepath = vocabulary_filepath(safe_word)
-        if not os.path.exists(filepath):
-            raise FileNotFoundError(f"We don't have the word {safe_word} yet!")
-
-        # Get information on all clips of the word
-        print(f'Getting information on all instances of "{safe_word}"')
-        clip_info_list = get_clip_information(safe_word)
-        print(f'The vocabulary holds {len(clip_info_list)} instances of "{safe_word}"')
-
-        # Pick clip to use
-        def max_clip_length_function(clip_info_list):
-            clip_info_list = [(x[2]-x[1], x) for x in clip_info_list]
-            return max(clip_info_list)[1]
-
-        clip_info = max_clip_length_function(clip_info_list)
-        video_code, raw_clip_start_time, raw_clip_end_time = clip_info
-
-        # Download a clip which includes the word, plus some time on both sides
-        print(f'Clip selected. VC={video_code}, start={seconds_to_timecode(raw_clip_start_time)}, '+\
-              f'end={seconds_to_timecode(raw_clip_end_time)}.\n' +\
-              f'Link: https://www.youtube.com/watch?v={video_code}')
-
-        # Find next clear raw clip filepath
-        raw_clip_dir = f'{MEDIA_DIRECTORY}/{VIDEO_SUBDIRECTORY}/{safe_word}/raw-clips'
-        if not os.path.exists(raw_clip_dir):
-            os.makedirs(raw_clip_dir)
-        index = 0
-        raw_clip_filepath = f'{raw_clip_dir}/{safe_word}-{index}.mkv'
-        while os.path.exists(raw_clip_filepath):
-            index += 1
-            raw_clip_filepath = f'{raw_clip_dir}/{safe_word}-{index}.mkv'
-
-
-        # TODO: If you start to close to the beginning of a video, we fail for lookahead
-        safety_buffer = 1
-        download_video(video_code, raw_clip_start_time, raw_clip_end_time, raw_clip_filepath, safety_buffer=safety_buffer, log_filepath=LOG_FILEPATH)
-        clip_length = raw_clip_end_time - raw_clip_start_time + 2*safety_buffer
-        print(f'Raw clip of length {round(clip_length, 2)} seconds saved to {raw_clip_filepath}')
-
-        # Now we slow it down (this seems to improve recognition)
-        speed_multiplier = 0.7
-        print(f'Slowing clip by factor of {speed_multiplier}')
-        slow_clips_subdirectory = f'{MEDIA_DIRECTORY}/{VIDEO_SUBDIRECTORY}/{safe_word}/slow-clips'
-        if not os.path.exists(slow_clips_subdirectory):
-            os.makedirs(slow_clips_subdirectory)
-        slow_clip_filepath = f'{slow_clips_subdirectory}/{safe_word}-{index}-{int(speed_multiplier*100)}-percent.mkv'
-
-        change_video_speed(raw_clip_filepath, 0.7, slow_clip_filepath, LOG_FILEPATH)
-        print(f'Slowed clip of length {round(clip_length * (1/speed_multiplier), 2)} seconds saved to {slow_clip_filepath}')
-
-        # Convert to audio
-        print(f'Converting clip {slow_clip_filepath} to mono FLAC audio...')
-        slow_clips_audio_subdirectory = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/slow-clips'
-        if not os.path.exists(slow_clips_audio_subdirectory):
-            os.makedirs(slow_clips_audio_subdirectory)
-        mono_filepath = f'{slow_clips_audio_subdirectory}/{safe_word}-{index}.flac'
-        video_to_flac(slow_clip_filepath, mono_filepath, LOG_FILEPATH)
-        print(f'Audio saved to {mono_filepath}')
-
-        # Get start and end time for word in slowed clip
-        print(f'Querying GCPs Speech-to-Text API with audio clip {mono_filepath}')
-        try:
-            word_start_time, word_end_time, conf = get_word_time(safe_word, mono_filepath, min_confidence=0.85, log_filepath=LOG_FILEPATH)
-        except FileNotFoundError:
-            print(f'Word "{safe_word}" not found in audio clip {mono_filepath}')
-            print(f'Entry deemed bad -- erasing clip info from {safe_word} TSV...')
-            erase_tsv_row(safe_word, max_clip_length_function)
-            continue
+        return await loop.run_in_executor(None, trusted_load, safe_word, filepath)
+
+    # Stocking another edition skips the occurrences and rows already trusted
+    trusted_rows = []
+    if not use_trusted and os.path.exists(filepath):
+        trusted_rows = [edition[:3] for edition in read_trusted_vocabulary(filepath)]
+
+    # Aligned videos already know where each of their words is
+    if use_alignments:
+        aligned = await loop.run_in_executor(None, partial(best_aligned_occurrence, safe_word, min_confidence=0.85, exclude=trusted_rows))
+        if aligned is not None:
+            video_code, occurrence = aligned
+            print(f'Word "{safe_word}" is aligned in {video_code} at ({occurrence.start_time}, {occurrence.end_time}) with confidence {round(occurrence.confidence, 2)}/1.0')
+            LOG_FILEPATH = next_clean_log_file(safe_word)
+            attempt_id = get_ledger().begin_attempt(safe_word, 'aligned', video_code=video_code, start_time=occurrence.start_time, end_time=occurrence.end_time, log=LOG_FILEPATH)
+            final_filepath = await loop.run_in_executor(None, clip_aligned_word, safe_word, video_code, occurrence, LOG_FILEPATH)
+            get_ledger().finish_attempt(attempt_id, 'clipped', video=final_filepath, confidence=occurrence.confidence)
+            return await loop.run_in_executor(None, add_to_trusted_vocabulary, safe_word, aligned_clip_information(video_code, occurrence), final_filepath)
+
+    # If word not in vocabulary, throw error
+    print(f'Checking if "{safe_word}" is in vocabulary...')
+    if not in_vocabulary(safe_word):
+        raise FileNotFoundError(f"We don't have the word {safe_word} yet!")
+
+    # Rank all clips of the word once, retries take the next best from the ranking
+    print(f'Getting information on all instances of "{safe_word}"')
+    ranking = get_candidate_ranking()
+    clip_info_list = await loop.run_in_executor(None, partial(get_clip_information, safe_word))
+    await loop.run_in_executor(None, ranking.refresh, safe_word, clip_info_list)
+
+    search_options = dict(max_in_flight=max_in_flight, cancel_on_hit=cancel_on_hit, multiplex=multiplex)
+    return await clip_candidates(safe_word, ranking, speculate, prefetch, search_options, trusted_rows)
+
+
+async def clip_candidates(safe_word, ranking, speculate=1, prefetch=1, search_options={}, skip=()):
+    '''
+    Clips safe_word from its best ranked vocabulary rows, as a pipeline of stages:
 
-        print(f'Word "{safe_word}" found at interval ({word_start_time}, {word_end_time}) with confidence {round(conf, 2)}/1.0')
-
-        #TODO: Add changes to beginning time
-        print(f'Beginning crop trials to find best interval for word...')
-        # We trim, ask GCP if right. If wrong, trim in more until start === end
-        conf_list = []
-        increment = 0.08 # Arbitrarily chosen
-        steps = 20
-        alterations = [(0, (s*increment)-(steps//2)*increment) for s in range(steps)]
-
-        for i, (beginning_alteration, end_alteration) in enumerate(alterations):
-            # For each new alteration, we create a clip
-            word_start_time = word_start_time + beginning_alteration
-            shifted_word_end_time = word_end_time + end_alteration
-
-            cropped_audio_directory = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/cropped'
-            if not os.path.exists(cropped_audio_directory):
-                os.makedirs(cropped_audio_directory)
-            slow_word_modified_filepath = f'{cropped_audio_directory}/{safe_word}-{index}-{i}.flac'
-
-            # Retrim
-            clip_length = shifted_word_end_time - word_start_time
-            with open(LOG_FILEPATH, 'a') as log:
-                if clip_length > 0.1:
-                    print(f'Cropping {mono_filepath} to interval ({word_start_time}, {shifted_word_end_time}) and writing to {slow_word_modified_filepath}')
-                    log.write(f'Cropping slowed approximate clip to interval ({word_start_time}, {shifted_word_end_time})\n')
-                    log.write(f'Cropped clip to be written to {slow_word_modified_filepath}\n')
-                    cropping_command = f'ffmpeg -y -ss 0 -i {mono_filepath} -ss {word_start_time} -t {round(shifted_word_end_time - word_start_time, 4)} -c:a flac {slow_word_modified_filepath}'
-                    log.write(f'Executing: {cropping_command}\n')
-                    check_output(cropping_command, shell=True, stderr=log)
-
-                    # TODO: Complete this to make easier re-lookups
-                    generated_clips_info[slow_word_modified_filepath] = {
-                        'video_code': video_code,
-                        'clip_start_time': raw_clip_start_time,
-                        'clip_end_time': raw_clip_end_time,
-                        'speed_multiplier': speed_multiplier,
-                        'start_time': word_start_time,
-                        'end_time': shifted_word_end_time
-                    }
-
-                else:
-                    print(f'Proposed crop interval ({word_start_time}, {shifted_word_end_time}) was deemed too short. Skipping...')
-                    log.write(f'Proposed clip crop interval ({word_start_time}, {shifted_word_end_time}) was deemed too short. Skipping...\n')
-        print(f'All word crops generated.')
-
-
-        conf_list = []
-        for i in range(steps):
-            cropped_mono_filepath = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/cropped/{safe_word}-{index}-{i}.flac'
-            if not os.path.exists(cropped_mono_filepath):
-                continue
+        resolve, fetch and slow   one ffmpeg pass per row (fetch_slowed_clip_async), prefetch rows ahead
+        recognize, crop, verify   speculate rows at a time, on threads since the Speech API blocks
+        render                    the winner only
 
-            print(f'Querying GCPs Speech-to-Text API with audio clip {cropped_mono_filepath}')
+    Rows are queued in rank order as their downloads start, and at most speculate + prefetch are
+    between starting a download and finishing a search. So downloading the next rows overlaps with
+    recognizing the current ones without running ahead. The first row to pass wins. Every other
+    row is cancelled, wherever it is in the pipeline, and its media deleted.
+    '''
+    loop = asyncio.get_running_loop()
+    fetched = asyncio.Queue()
+    slots = asyncio.Semaphore(speculate + prefetch)
+    cancelled = threading.Event()
+    # Skipped rows count as in flight for good, so they're never fetched
+    in_flight = list(skip)
+    fetches = []
+    errors = []
+
+    async def fetch_one(candidate):
+        try:
+            await fetch_candidate(candidate)
+        except Exception:
+            drop_candidate(candidate, 'fetch failed')
+            raise
+        return candidate
+
+    async def fetch_stage():
+        # Each failure drops a row from the ranking, so the next row is the best one not in flight
+        while True:
+            await slots.acquire()
+            rows = [] if cancelled.is_set() else [row for row in ranking.top(safe_word, len(in_flight) + 1) if row not in in_flight]
+            if rows == []:
+                break
+            in_flight.append(rows[0])
+            candidate = start_candidate(safe_word, rows[0])
+            fetches.append(asyncio.ensure_future(fetch_one(candidate)))
+            await fetched.put((candidate, fetches[-1]))
+        # One marker ends the searchers, each passes it on to the next
+        await fetched.put(None)
+
+    async def search_stage(executor):
+        while True:
+            queued = await fetched.get()
+            if queued is None:
+                fetched.put_nowait(None)
+                return None
+            candidate, fetch = queued
             try:
-                trim_start_time, trim_end_time, conf = get_word_time(safe_word, cropped_mono_filepath, must_isolate=True, min_confidence=0.85, log_filepath=LOG_FILEPATH)
-                print(f'Word "{safe_word}" found at interval ({trim_start_time}, {trim_end_time}) with {round(conf, 2)}/1.0 confidence')
-                conf_list += [(i, conf)]
-            except FileNotFoundError:
-                print(f'Word "{safe_word}" not found in audio clip {cropped_mono_filepath}')
-            except FileExistsError:
-                print(f'Word "{safe_word}" was found in audio clip {cropped_mono_filepath}, but not isolated')
-
-        print(conf_list)
-
-        if conf_list != []:
-            print(f'Word "{safe_word}" found in audio clips {[i for i, conf in conf_list]}')
-            clip_num, conf = max(conf_list, key=lambda x: float(x[1]))
-            cropped_mono_filepath = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/cropped/{safe_word}-{index}-{clip_num}.flac'
-
-            print(f'Maximum confidence of {round(conf, 2)} came from clip {cropped_mono_filepath}')
-            word_retrieved = True
-
-#            print(f'Writing trusted clip info to trusted vocabulary')
-            best_clip_info = generated_clips_info[cropped_mono_filepath]
-#            add_to_trusted_vocabulary(safe_word, best_clip_info)
-
-            # Generate a video clip to match the best audio
-            final_filepath = f'{MEDIA_DIRECTORY}/{GOOD_CLIPS_SUBDIRECTORY}/{safe_word}-{round(conf, 2)}.mkv'
-            cropping_command = f'ffmpeg -y -ss 0 -i {slow_clip_filepath} -ss {best_clip_info["start_time"]} -t {round(best_clip_info["end_time"] - best_clip_info["start_time"], 4)} -c:v libx264 -c:a flac {final_filepath}'
-            print('Executing: ', cropping_command)
-            with open(LOG_FILEPATH) as log:
-                check_output(cropping_command, shell=True, stderr=log)
-            return final_filepath
-
-        else:
-            print(f'No audio clip contained word "{safe_word}"')
-            print(f'Entry deemed bad -- erasing clip info from {safe_word} TSV...')
-            erase_tsv_row(safe_word, max_clip_length_function)
-
-    return word_clip_filepath
-
-
-
-def write_to_tsv(row, header, filepath):
-    mode = 'w'
-    if os.path.exists(filepath):
-        mode = 'a'
-
-    with open(filepath, mode) as f:
-        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
-        if mode == 'w':
-            writer.writerow(header)
-        writer.writerow(row)
-
+                await fetch
+            except asyncio.CancelledError:
+                drop_candidate(candidate)
+                return None
+            except Exception as error:
+                # Treated like a rejection: the row leaves the ranking and the next one is fetched
+                ranking.record(safe_word, candidate['clip_info'], success=False)
+                in_flight.remove(candidate['clip_info'])
+                errors.append(error)
+                slots.release()
+                continue
+            try:
+                passed = await loop.run_in_executor(executor, partial(search_candidate, safe_word, candidate, ranking, cancelled=cancelled, **search_options))
+            except CandidateCancelled:
+                return None
+            except Exception as error:
+                # e.g. a Speech API error. The row is given up on, its searcher goes on to the next
+                print(f'Searching {candidate["mono_filepath"]} for "{safe_word}" failed: {error}')
+                drop_candidate(candidate, 'search failed')
+                ranking.record(safe_word, candidate['clip_info'], success=False)
+                errors.append(error)
+                continue
+            finally:
+                in_flight.remove(candidate['clip_info'])
+                slots.release()
+            if passed is not None:
+                cancelled.set()
+                return passed
+
+    print(f'Trying the {ranking.count(safe_word)} instances of "{safe_word}" in the vocabulary, {speculate} at a time')
+    with ThreadPoolExecutor(speculate) as executor:
+        fetcher = asyncio.ensure_future(fetch_stage())
+        searchers = [asyncio.ensure_future(search_stage(executor)) for _ in range(speculate)]
+
+        winner = None
+        try:
+            for searcher in asyncio.as_completed(searchers):
+                try:
+                    winner = await searcher
+                except Exception:
+                    # Gathered below, and raised if nothing passes
+                    continue
+                if winner is not None:
+                    break
+        finally:
+            # Also when clip_word itself is cancelled, e.g. by a timeout.
+            # Stop downloading and drop the rows never searched, then wake searchers still waiting
+            # for a row. Those mid-search notice the cancellation at their next step
+            cancelled.set()
+            fetcher.cancel()
+            await asyncio.gather(fetcher, return_exceptions=True)
+            for fetch in fetches:
+                fetch.cancel()
+            leftovers = []
+            while not fetched.empty():
+                queued = fetched.get_nowait()
+                if queued is not None:
+                    leftovers += [queued]
+            fetch_results = await asyncio.gather(*[fetch for candidate, fetch in leftovers], return_exceptions=True)
+            for (candidate, fetch), result in zip(leftovers, fetch_results):
+                if not isinstance(result, Exception):
+                    drop_candidate(candidate)
+            fetched.put_nowait(None)
+            results = await asyncio.gather(*searchers, return_exceptions=True)
+            for passed in results:
+                if isinstance(passed, dict) and passed is not winner:
+                    drop_candidate(passed)
+
+    if winner is not None:
+        return await render_candidate(safe_word, winner, ranking)
+
+    # Download and search errors surface once nothing else can succeed
+    for error in errors + results:
+        if isinstance(error, Exception):
+            raise error
+    raise FileNotFoundError(f"Every instance of {safe_word} has been deemed bad!")
+
+
+class CandidateCancelled(Exception):
+    pass
+
+
+def start_candidate(safe_word, clip_info):
+    '''Opens an attempt at one vocabulary row, and takes its log and slowed clip filepaths from the ledger.'''
+    LOG_FILEPATH = next_clean_log_file(safe_word)
+    video_code, raw_clip_start_time, raw_clip_end_time = clip_info
+    attempt_id = get_ledger().begin_attempt(safe_word, 'vocabulary', video_code=video_code, start_time=raw_clip_start_time, end_time=raw_clip_end_time, log=LOG_FILEPATH)
+
+    # Download a clip which includes the word, plus some time on both sides
+    print(f'Clip selected. VC={video_code}, start={seconds_to_timecode(raw_clip_start_time)}, '+\
+          f'end={seconds_to_timecode(raw_clip_end_time)}.\n' +\
+          f'Link: https://www.youtube.com/watch?v={video_code}')
+
+    # Take the next slowed clip filepath from the ledger
+    slow_clips_audio_subdirectory = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/slow-clips'
+    if not os.path.exists(slow_clips_audio_subdirectory):
+        os.makedirs(slow_clips_audio_subdirectory, exist_ok=True)
+    mono_template = slow_clips_audio_subdirectory + '/' + safe_word + '-{}.flac'
+    index = get_ledger().next_id(f'slow-clip/{safe_word}', first=lambda: first_free_index(mono_template))
+    mono_filepath = mono_template.format(index)
+
+    return {
+        'clip_info': clip_info,
+        'attempt_id': attempt_id,
+        'log_filepath': LOG_FILEPATH,
+        'index': index,
+        'mono_filepath': mono_filepath,
+        # The word's times are measured in this clip, slowed and widened by safety_buffer
+        'safety_buffer': 1,
+        'speed_multiplier': 0.7,
+    }
+
+
+async def fetch_candidate(candidate):
+    '''Downloads, slows (this seems to improve recognition) and converts a candidate's audio in one ffmpeg pass.'''
+    # Only the audio is needed to judge a candidate, video is fetched for the winner alone.
+    # TODO: If you start to close to the beginning of a video, we fail for lookahead
+    video_code, raw_clip_start_time, raw_clip_end_time = candidate['clip_info']
+    speed_multiplier, safety_buffer = candidate['speed_multiplier'], candidate['safety_buffer']
+    mono_filepath = candidate['mono_filepath']
+    await fetch_slowed_clip_async(video_code, raw_clip_start_time, raw_clip_end_time, speed_multiplier, audio_output=mono_filepath, safety_buffer=safety_buffer, log_filepath=candidate['log_filepath'])
+    clip_length = raw_clip_end_time - raw_clip_start_time + 2*safety_buffer
+    print(f'Slowed audio of length {round(clip_length * (1/speed_multiplier), 2)} seconds saved to {mono_filepath}')
+
+
+def drop_candidate(candidate, outcome='cancelled'):
+    '''Deletes a candidate's slowed audio and records how it ended.'''
+    if os.path.exists(candidate['mono_filepath']):
+        os.remove(candidate['mono_filepath'])
+    get_ledger().finish_attempt(candidate['attempt_id'], outcome)
+
+
+def search_candidate(safe_word, candidate, ranking, max_in_flight=4, cancel_on_hit=True, multiplex=False, cancelled=None):
+    '''
+    Recognizes a fetched candidate and searches it for a crop isolating safe_word. Returns the
+    candidate with its best crop for render_candidate, or None if the row was deemed bad (and rejected).
+    Once cancelled is set, the search stops at its next step and raises CandidateCancelled.
+    '''
+    cancelled = cancelled or threading.Event()
+    LOG_FILEPATH = candidate['log_filepath']
+    mono_filepath = candidate['mono_filepath']
+    clip_info = candidate['clip_info']
+    video_code, raw_clip_start_time, raw_clip_end_time = clip_info
+    safety_buffer, speed_multiplier = candidate['safety_buffer'], candidate['speed_multiplier']
+    generated_clips_info = {}
+
+    def stop_if_cancelled():
+        if cancelled.is_set():
+            print(f'Another instance of "{safe_word}" was clipped first, dropping {mono_filepath}')
+            drop_candidate(candidate)
+            raise CandidateCancelled(mono_filepath)
+
+    def reject(outcome, **outputs):
+        print(f'Entry deemed bad -- marking clip info of {safe_word} rejected...')
+        get_ledger().finish_attempt(candidate['attempt_id'], outcome, **outputs)
+        reject_clip_information(safe_word, clip_info)
+        ranking.record(safe_word, clip_info, success=False)
+
+    stop_if_cancelled()
+
+    # Get start and end time for word in slowed clip
+    print(f'Querying GCPs Speech-to-Text API with audio clip {mono_filepath}')
+    try:
+        word_start_time, word_end_time, conf = get_word_time(safe_word, mono_filepath, min_confidence=0.85, log_filepath=LOG_FILEPATH)
+    except FileNotFoundError:
+        print(f'Word "{safe_word}" not found in audio clip {mono_filepath}')
+        reject('word not found', audio=mono_filepath)
+        return None
+    stop_if_cancelled()
 
+    print(f'Word "{safe_word}" found at interval ({word_start_time}, {word_end_time}) with confidence {round(conf, 2)}/1.0')
 
-def add_to_trusted_vocabulary(safe_word, clip_info):
-    vocabulary_directory = './trusted-vocabulary'
-    vocab_subdirectory = safe_word[0].upper()
+    print(f'Beginning crop trials to find best interval for word...')
+    # The slowed audio is decoded once and every trial is a view into it, nothing touches disk.
+    # The search moves both boundaries, steered by whether the word was heard alone, too wide or not at all
+    audio = decode_audio(mono_filepath, log_filepath=LOG_FILEPATH)
 
-    dir_path = f'{vocabulary_directory}/{vocab_subdirectory}'
-    filepath = f'{dir_path}/{safe_word}.tsv'
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    def classify_crop(crop_label, find_word):
+        try:
+            trim_start_time, trim_end_time, conf = find_word()
+            print(f'Word "{safe_word}" found at interval ({trim_start_time}, {trim_end_time}) with {round(conf, 2)}/1.0 confidence')
+            return ISOLATED, conf
+        except FileNotFoundError:
+            print(f'Word "{safe_word}" not found in audio clip {crop_label}')
+            return MISSING, 0
+        except FileExistsError:
+            print(f'Word "{safe_word}" was found in audio clip {crop_label}, but not isolated')
+            return NOT_ISOLATED, 0
+
+    recognition_stats = {'requests': 0}
+
+    # Crops of a cancelled attempt are given up on rather than recognized
+    def evaluate_crop(interval):
+        if cancelled.is_set():
+            return None
+        crop_label = f'{mono_filepath} ({interval[0]}, {interval[1]})'
+        print(f'Querying GCPs Speech-to-Text API with audio clip {crop_label}')
+        content = audio.slice(*interval).to_wav_bytes()
+        recognition_stats['requests'] += 1
+        return classify_crop(crop_label, lambda: get_word_time(safe_word, crop_label, must_isolate=True, min_confidence=0.85, log_filepath=LOG_FILEPATH, content=content))
+
+    def evaluate_multiplexed(intervals):
+        if cancelled.is_set():
+            return [None] * len(intervals)
+        print(f'Querying GCPs Speech-to-Text API with {len(intervals)} audio clips from {mono_filepath} packed together')
+        transcripts = recognize_multiplexed([audio.slice(*interval) for interval in intervals], LOG_FILEPATH, label=mono_filepath, stats=recognition_stats)
+        return [
+            classify_crop(f'{mono_filepath} ({interval[0]}, {interval[1]})', lambda: word_time_in_transcript(safe_word, transcript, must_isolate=True, min_confidence=0.85))
+            for interval, transcript in zip(intervals, transcripts)
+        ]
+
+    # Snap the recognizer's boundaries to nearby silence locally, so the first crops sent are
+    # already good ones and the recognizer mostly confirms them. Later steps can be finer too
+    candidates = snap_boundaries(audio, word_start_time, word_end_time)
+    print(f'Boundaries snapped to silence give candidate crops {candidates}')
+
+    target_confidence = 0.95
+    search = dict(target_confidence=target_confidence, coarse_step=0.08, candidates=candidates)
+    if multiplex:
+        # Each round's neighbouring crops share one request
+        best_interval, conf, trials = search_crop(evaluate_multiplexed, word_start_time, word_end_time, audio.duration, parallelism=4, **search)
+    else:
+        # Each round's neighbouring crops are recognized at once, up to max_in_flight requests.
+        # With cancel_on_hit they go in two waves, and a confident hit in the first skips the second
+        with ThreadPoolExecutor(max_in_flight) as executor:
+            wave_size = max(1, max_in_flight // 2) if cancel_on_hit else None
+            evaluate_crops = lambda intervals: evaluate_concurrently(evaluate_crop, intervals, executor, target_confidence if cancel_on_hit else None, wave_size)
+            best_interval, conf, trials = search_crop(evaluate_crops, word_start_time, word_end_time, audio.duration, parallelism=max_in_flight, **search)
+    stop_if_cancelled()
+    print(f'Crop search tried {len(trials)} crops in {recognition_stats["requests"]} recognition requests')
+    with open(LOG_FILEPATH, 'a') as log:
+        log.write(f'Crop search tried {len(trials)} crops in {recognition_stats["requests"]} recognition requests, best interval {best_interval}\n')
 
-    video_code = clip_info['video_code']
-    clip_start_time = clip_info['clip_start_time']
-    clip_end_time = clip_info['clip_end_time']
-    speed_multiplier = clip_info['speed_multiplier']
-    word_start_time = clip_info['start_time']
-    word_end_time = clip_info['end_time']
+    conf_list = []
+    for interval, (status, trial_conf) in trials.items():
+        if status != ISOLATED:
+            continue
+        conf_list += [(interval, trial_conf)]
+
+        # TODO: Complete this to make easier re-lookups
+        generated_clips_info[interval] = {
+            'video_code': video_code,
+            'clip_start_time': raw_clip_start_time,
+            'clip_end_time': raw_clip_end_time,
+            'safety_buffer': safety_buffer,
+            'speed_multiplier': speed_multiplier,
+            'start_time': interval[0],
+            'end_time': interval[1]
+        }
+
+    print(conf_list)
+
+    if conf_list == []:
+        print(f'No audio clip contained word "{safe_word}"')
+        reject('not isolated', audio=mono_filepath, crops_tried=len(trials))
+        return None
+
+    print(f'Word "{safe_word}" found in audio clips {[i for i, conf in conf_list]}')
+    best_interval, conf = max(conf_list, key=lambda x: float(x[1]))
+    return dict(candidate, audio=audio, interval=best_interval, confidence=conf, clip_information=generated_clips_info[best_interval])
+
+
+async def render_candidate(safe_word, candidate, ranking):
+    '''Writes the winning crop of search_candidate and the video to match it. Returns the video's filepath.'''
+    LOG_FILEPATH = candidate['log_filepath']
+    best_interval, conf = candidate['interval'], candidate['confidence']
+    best_clip_info = candidate['clip_information']
+
+    # Only the winning crop is written out
+    cropped_audio_directory = f'{MEDIA_DIRECTORY}/{AUDIO_SUBDIRECTORY}/{safe_word}/cropped'
+    if not os.path.exists(cropped_audio_directory):
+        os.makedirs(cropped_audio_directory, exist_ok=True)
+    cropped_mono_filepath = f'{cropped_audio_directory}/{safe_word}-{candidate["index"]}.flac'
+    final_filepath = f'{MEDIA_DIRECTORY}/{GOOD_CLIPS_SUBDIRECTORY}/{safe_word}-{round(conf, 2)}.mkv'
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, candidate['audio'].slice(*best_interval).save, cropped_mono_filepath, LOG_FILEPATH)
+        print(f'Maximum confidence of {round(conf, 2)} came from clip {cropped_mono_filepath}')
 
-    write_to_tsv(
-        [video_code, clip_start_time, clip_end_time, speed_multiplier, word_start_time, word_end_time],
-        'video_code clip_start_time clip_end_time speed_multiplier word_start_time word_end_time'.split(),
-        filepath
-    )
+        # Generate a video clip to match the best audio
+        print(f'Fetching video for the chosen interval and writing to {final_filepath}')
+        await render_word_video_async(best_clip_info, final_filepath, LOG_FILEPATH)
+    except asyncio.CancelledError:
+        drop_candidate(candidate)
+        raise
+    except Exception:
+        # The row passed, so it stays in the ranking, only this attempt failed
+        drop_candidate(candidate, 'render failed')
+        raise
+    get_ledger().finish_attempt(candidate['attempt_id'], 'clipped', audio=cropped_mono_filepath, video=final_filepath, interval=best_interval, confidence=conf)
+    ranking.record(safe_word, candidate['clip_info'], success=True, confidence=conf)
 
+    print(f'Writing trusted clip info to trusted vocabulary')
+    return await asyncio.get_running_loop().run_in_executor(None, add_to_trusted_vocabulary, safe_word, best_clip_info, final_filepath)
 
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('word')
+    parser.add_argument('--max-in-flight', type=int, default=4, help='Crop candidates recognized at once')
+    parser.add_argument('--no-cancel-on-hit', action='store_true', help='Finish every candidate in a round, even after a confident hit')
+    parser.add_argument('--multiplex', action='store_true', help='Pack each round of candidates into one recognition request')
+    parser.add_argument('--no-alignments', action='store_true', help='Ignore aligned videos and search the vocabulary')
+    parser.add_argument('--speculate', type=int, default=1, help='Vocabulary rows tried at once, the first to pass wins')
+    parser.add_argument('--prefetch', type=int, default=1, help='Vocabulary rows downloaded ahead of recognition')
+    parser.add_argument('--no-trusted', action='store_true', help='Clip afresh even if the word is trusted, stocking another edition')
     args = parser.parse_args()
 
-    clip_word(str(args.word))
+    clip_word(str(args.word), args.max_in_flight, not args.no_cancel_on_hit, args.multiplex, not args.no_alignments, args.speculate, args.prefetch, not args.no_trusted)
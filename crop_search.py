@@ -0,0 +1,123 @@
+'''
+Adaptive search for the crop of a clip in which the recognizer hears our word alone.
+
+Replaces sweeping the end of the crop over a fixed grid. The recognizer's answer for a crop
+says which way to move: a crop where the word is heard with others is too wide, a crop where
+it isn't heard at all is too narrow, and among isolated crops higher confidence is better.
+Each round tries moving either boundary by the current step and moves to the first
+neighbour that ranks better; when none does, the step is halved, until it drops below
+fine_step. The search stops as soon as a crop reaches target_confidence or max_calls
+recognitions have been spent.
+
+Neighbours can be recognized concurrently with evaluate_concurrently.
+'''
+
+
+from concurrent.futures import as_completed
+
+
+ISOLATED = 'isolated'
+NOT_ISOLATED = 'not isolated'
+MISSING = 'missing'
+
+
+def _rank(result, interval):
+    status, confidence = result
+    length = interval[1] - interval[0]
+    if status == ISOLATED:
+        return (2, confidence)
+    if status == NOT_ISOLATED:
+        return (1, -length)
+    return (0, length)
+
+
+def _moves(status, step):
+    if status == ISOLATED:
+        return [(0, step), (0, -step), (-step, 0), (step, 0)]
+    if status == NOT_ISOLATED:
+        return [(0, -step), (step, 0), (step, -step)]
+    return [(0, step), (-step, 0), (-step, step)]
+
+
+def search_crop(evaluate_many, start_time, end_time, duration, coarse_step=0.16, fine_step=0.04, min_length=0.1, max_calls=10, target_confidence=0.95, parallelism=1, candidates=()):
+    '''
+    Searches around (start_time, end_time) for the best crop within [0, duration].
+    If candidates are given (e.g. from voice_activity.snap_boundaries), they are tried together
+    first instead, and the search continues from the best of them.
+
+    evaluate_many([(start, end), ...]) must return one (status, confidence) per interval, status
+    being ISOLATED, NOT_ISOLATED or MISSING, or None for an interval it gave up on. Neighbours
+    are handed to it parallelism at a time.
+
+    Returns (interval, confidence, trials). interval is None if no crop isolated the word, and
+    trials maps every interval sent for recognition to its result, so len(trials) is the call count.
+    '''
+    trials = {}
+
+    def key(interval):
+        return (round(interval[0], 3), round(interval[1], 3))
+
+    def valid(interval):
+        return 0 <= interval[0] and interval[1] <= duration and interval[1] - interval[0] >= min_length
+
+    def run(intervals):
+        fresh = []
+        for interval in map(key, intervals):
+            if valid(interval) and interval not in trials and interval not in fresh:
+                fresh += [interval]
+        fresh = fresh[:max(0, max_calls - len(trials))]
+        if fresh:
+            for interval, result in zip(fresh, evaluate_many(fresh)):
+                if result is not None:
+                    trials[interval] = result
+        return [interval for interval in map(key, intervals) if interval in trials]
+
+    starts = [key(c) for c in candidates] or [key((max(0, start_time), min(duration, end_time)))]
+    tried = run(starts)
+    if tried == []:
+        return None, 0, trials
+    best = max(tried, key=lambda x: _rank(trials[x], x))
+
+    step = coarse_step
+    while step >= fine_step and len(trials) < max_calls:
+        status, confidence = trials[best]
+        if status == ISOLATED and confidence >= target_confidence:
+            break
+
+        neighbours = [(best[0] + ds, best[1] + de) for ds, de in _moves(status, step)]
+        improved = False
+        for i in range(0, len(neighbours), parallelism):
+            tried = run(neighbours[i:i + parallelism])
+            better = [x for x in tried if _rank(trials[x], x) > _rank(trials[best], best)]
+            if better:
+                best = max(better, key=lambda x: _rank(trials[x], x))
+                improved = True
+                break
+
+        if not improved:
+            step /= 2
+
+    status, confidence = trials[best]
+    if status != ISOLATED:
+        return None, 0, trials
+    return best, confidence, trials
+
+
+def evaluate_concurrently(evaluate, intervals, executor, stop_confidence=None, wave_size=None):
+    '''
+    Runs evaluate(interval) -> (status, confidence), or None if it gave up, for every interval on executor.
+
+    Results come back in the order of intervals. Intervals are sent in waves of wave_size, all at
+    once by default. With stop_confidence, once a wave has an isolated result at or above it, later
+    waves aren't sent and their intervals come back as None. Waves smaller than the executor's pool
+    are what make this save requests, a wave's requests are all sent before any of them answers.
+    '''
+    wave_size = wave_size or len(intervals)
+    results = [None] * len(intervals)
+    for first in range(0, len(intervals), wave_size):
+        futures = {executor.submit(evaluate, intervals[i]): i for i in range(first, min(first + wave_size, len(intervals)))}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+        if stop_confidence is not None and any(r is not None and r[0] == ISOLATED and r[1] >= stop_confidence for r in results):
+            break
+    return results
@@ -13,9 +13,9 @@ def expand_clips(letter):
     words = [x.replace('.tsv', '') for x in check_output(f'ls vocabulary/{letter}', shell=True).decode().split()]
 
     for word in words:
-        # Download a clip for this word
+        # Download a clip for this word, packing crop candidates to keep request counts down
         try:
-            filepath = clip_word(word)
+            filepath = clip_word(word, multiplex=True)
         except FileNotFoundError:
             continue
 
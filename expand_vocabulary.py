@@ -1,11 +1,20 @@
 import argparse
-from youtube_utils import download_captions
-from utils import timecode_to_seconds
+from youtube_utils import download_captions, captions_downloader, list_video_codes, LocalCaptionExtractor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 import os
 import csv
+import io
+import json
+import re
+import threading
+import time
 
 
 VOCAB_DIRECTORY = './vocabulary'
+VOCAB_HEADER = ['video_code', 'start_time', 'end_time']
+CAPTIONS_DIRECTORY = 'captions'
+INCOMING_CAPTIONS_DIRECTORY = f'{CAPTIONS_DIRECTORY}/incoming'
 
 
 def expand_vocabulary(video_code):
@@ -17,82 +26,331 @@ def expand_vocabulary(video_code):
         return
 
     download_captions(video_code)
-    atomize_captions(video_code, filepath)
+    with VocabularyWriter() as writer:
+        atomize_captions(video_code, filepath, writer)
     print('Complete!')
 
 
-def write_to_tsv(row, header, filepath):
-    mode = 'w'
-    if os.path.exists(filepath):
-        mode = 'a'
+def read_video_codes(sources, ydl=None):
+    '''Expands video codes, list files (one source per line), playlist and channel URLs into video codes.'''
+    for source in sources:
+        source = source.strip()
+        if source == '' or source.startswith('#'):
+            continue
+        if os.path.isfile(source):
+            with open(source) as f:
+                yield from read_video_codes(f.read().split('\n'), ydl)
+        elif '/' in source:
+            yield from list_video_codes(source, ydl)
+        else:
+            yield source
 
-    with open(filepath, mode) as f:
-        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
-        if mode == 'w':
-            writer.writerow(header)
-        writer.writerow(row)
 
+def commit_captions(captions):
+    '''Moves caption files into captions/ once their words are flushed, which marks them as done.'''
+    for video_code, caption_filepath in captions:
+        committed_filepath = f'{CAPTIONS_DIRECTORY}/{video_code}.en.vtt'
+        if caption_filepath != committed_filepath and os.path.exists(caption_filepath):
+            os.replace(caption_filepath, committed_filepath)
 
 
-remove_c_tags = lambda x: x.replace('<c>', '').replace('</c>', '')
+def parse_caption_file(video_code, caption_filepath):
+    '''Process pool task: parse one caption file into its (word, start, end) rows.'''
+    return video_code, caption_filepath, list(iter_caption_words(caption_filepath))
 
 
-def atomize_captions(video_code, caption_filepath):
-    '''Finds start and end time of all words in .vtt caption file and writes to vocabulary.'''
+def expand_vocabulary_bulk(sources, download_workers=4, atomize_workers=None, extractor_factory=captions_downloader, max_buffered_rows=200000):
+    '''
+    Adds the captions of many videos to the vocabulary.
 
-    master_cue_list = []
+    Sources can be video codes, files listing sources, playlist URLs or channel URLs.
+    Captions are fetched on a thread pool and parsed on a process pool, then written
+    through one VocabularyWriter. Fetches land in captions/incoming and only move to
+    captions/ once their words are flushed, so an interrupted run resumes by skipping
+    every video that already has captions/<code>.en.vtt.
+    '''
+    start = time.time()
 
-    with open(caption_filepath) as f:
-        saw_line_timing = False
-        line_start = None
-        line_end = None
+    with extractor_factory(INCOMING_CAPTIONS_DIRECTORY) as ydl:
+        video_codes = list(dict.fromkeys(read_video_codes(sources, ydl)))
+
+    # Opening the writer finishes an interrupted flush, whose videos are then done, not todo
+    writer = VocabularyWriter(max_buffered_rows=max_buffered_rows, on_commit=commit_captions)
+    todo = [code for code in video_codes if not os.path.exists(f'{CAPTIONS_DIRECTORY}/{code}.en.vtt')]
+    print(f'{len(video_codes) - len(todo)} of {len(video_codes)} videos are already in our vocabulary')
+
+    # youtube_dl extractors aren't thread safe, so each download thread keeps its own
+    local = threading.local()
+
+    def fetch(video_code):
+        caption_filepath = f'{INCOMING_CAPTIONS_DIRECTORY}/{video_code}.en.vtt'
+        if not os.path.exists(caption_filepath):
+            if not hasattr(local, 'ydl'):
+                local.ydl = extractor_factory(INCOMING_CAPTIONS_DIRECTORY)
+            download_captions(video_code, local.ydl)
+        return video_code, caption_filepath
+
+    stats = {'videos': 0, 'words': 0, 'failed': 0}
+
+    with writer, \
+         ThreadPoolExecutor(download_workers) as downloads, \
+         ProcessPoolExecutor(atomize_workers) as atomizers:
+
+        pending = {downloads.submit(fetch, code) for code in todo}
+        parsing = set()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f'Skipping a video: {e}')
+                    stats['failed'] += 1
+                    continue
+
+                # A finished download, hand it to the parsers
+                if future not in parsing:
+                    video_code, caption_filepath = result
+                    if not os.path.exists(caption_filepath):
+                        print(f'No English captions for {video_code}')
+                        stats['failed'] += 1
+                        continue
+                    parse = atomizers.submit(parse_caption_file, video_code, caption_filepath)
+                    parsing.add(parse)
+                    pending.add(parse)
+
+                # A finished parse, add it to the vocabulary
+                else:
+                    parsing.discard(future)
+                    video_code, caption_filepath, words = result
+                    for word, start_time, end_time in words:
+                        writer.add(word, video_code, start_time, end_time)
+                    writer.caption_done(video_code, caption_filepath)
+                    stats['videos'] += 1
+                    stats['words'] += len(words)
+                    if stats['videos'] % 50 == 0:
+                        print(f'Atomized {stats["videos"]}/{len(todo)} videos')
+
+    elapsed = time.time() - start
+    print(f'Added {stats["words"]} words from {stats["videos"]} videos in {round(elapsed, 2)}s ' +\
+          f'({round(stats["videos"] / max(elapsed, 1e-9), 2)} videos/s, {stats["failed"]} failed)')
+    return stats
+
+
+clean_word = lambda x: ''.join([c for c in x.lower() if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+
+
+class VocabularyWriter():
+    '''
+    Buffers vocabulary rows in memory and appends each word's TSV shard once per flush.
+
+    Flushes happen between caption files, once more than max_buffered_rows rows are held.
+    Before touching any shard the writer records each shard's size in a journal, so a
+    flush interrupted part way is rolled back on the next start and its captions redone.
+    Once every row is in, the journal is marked committed and on_commit (by default moving
+    the captions into captions/) runs before it's removed, so a flush interrupted then is
+    only committed on the next start.
+    '''
+
+    def __init__(self, vocab_directory=VOCAB_DIRECTORY, max_buffered_rows=200000, on_commit=commit_captions):
+        self.vocab_directory = vocab_directory
+        self.max_buffered_rows = max_buffered_rows
+        self.on_commit = on_commit
+        self.journal_filepath = f'{vocab_directory}/.flush-journal.json'
+        self.buffered_rows = 0
+        self._shards = {}
+        self._captions = []
+
+        if not os.path.exists(vocab_directory):
+            os.makedirs(vocab_directory)
+        self.recover()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Never commit half a caption file
+        if exc_type is None:
+            self.flush()
+
+    def shard_filepath(self, safe_word):
+        return f'{self.vocab_directory}/{safe_word[0].upper()}/{safe_word}.tsv'
 
-        for line in f.readlines():
-            if '-->' in line:
-                if saw_line_timing:
-                    master_cue_list += [line_start, line_end]
+    def add(self, word, video_code, start_time, end_time):
+        safe_word = clean_word(word)
+        if safe_word == '':
+            return
+        self._shards.setdefault(self.shard_filepath(safe_word), []).append((video_code, start_time, end_time))
+        self.buffered_rows += 1
 
-                saw_line_timing = True
-                start = f'<{line.split()[0]}>'
-                end = f'<{line.split()[2]}>'
-                master_cue_list += [start]
-                line_start = start
-                line_end = end
+    def caption_done(self, video_code, caption_filepath):
+        '''Marks the end of one caption file, flushing if the buffer has grown past its bound.'''
+        self._captions += [(video_code, caption_filepath)]
+        if self.buffered_rows >= self.max_buffered_rows:
+            self.flush()
 
-            if '<c>' in line:
-                saw_line_timing = False
-                cue_line_list = remove_c_tags(line).replace('<', ' <').split()
-                master_cue_list += cue_line_list
-                master_cue_list += [line_end]
+    def flush(self):
+        if self._shards:
+            # Journal the pre-flush size of every shard we are about to append to
+            sizes = {filepath: os.path.getsize(filepath) if os.path.exists(filepath) else 0 for filepath in self._shards}
+            self._write_journal({'shards': sizes, 'captions': self._captions})
 
+            for filepath, rows in self._shards.items():
+                buffer = io.StringIO()
+                writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+                if sizes[filepath] == 0:
+                    writer.writerow(VOCAB_HEADER)
+                writer.writerows(rows)
 
-    for i, entry in enumerate(master_cue_list):
-        if '<' in entry:
-            seconds = timecode_to_seconds(entry)
-            master_cue_list[i] = seconds
+                dir_path = os.path.dirname(filepath)
+                if not os.path.exists(dir_path):
+                    os.makedirs(dir_path)
+                with open(filepath, 'a') as f:
+                    f.write(buffer.getvalue())
 
+            # Every row is in, from here on a crash only has the commit left to finish
+            self._write_journal({'shards': {}, 'captions': self._captions, 'committed': True})
+            self._shards = {}
+            self.buffered_rows = 0
 
-    for i, entry in enumerate(master_cue_list):
-        if type(entry) == str:
-            word = entry
-            start_time = master_cue_list[i-1]
-            end_time = master_cue_list[i+1]
+        # The journal goes last, so captions are never left uncommitted without one
+        self._commit()
+        if os.path.exists(self.journal_filepath):
+            os.remove(self.journal_filepath)
 
-            vocab_subdirectory = word[0].upper()
-            safe_word = ''.join([c for c in word.lower() if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+    def _write_journal(self, entry):
+        tmp_filepath = f'{self.journal_filepath}.tmp'
+        with open(tmp_filepath, 'w') as journal:
+            json.dump(entry, journal)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_filepath, self.journal_filepath)
 
-            filename = f'{safe_word}.tsv'
-            dir_path = f'{VOCAB_DIRECTORY}/{vocab_subdirectory}'
+    def _commit(self):
+        if self.on_commit is not None:
+            self.on_commit(self._captions)
+        self._captions = []
 
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
+    def recover(self):
+        '''Finishes a flush that was only left to commit, or rolls back one that never finished and re-atomizes the captions it held.'''
+        if not os.path.exists(self.journal_filepath):
+            return
 
-            write_to_tsv([video_code, start_time, end_time], ['video_code', 'start_time', 'end_time'], f'{dir_path}/{filename}')
+        with open(self.journal_filepath) as journal:
+            try:
+                entry = json.load(journal)
+            except ValueError:
+                # The journal itself was cut short, so no shard was touched yet
+                entry = {'shards': {}, 'captions': []}
+
+        if entry.get('committed'):
+            print(f'Committing {len(entry["captions"])} caption files of an interrupted vocabulary flush')
+            self._captions = [tuple(caption) for caption in entry['captions']]
+            self.flush()
+            return
+
+        for filepath, size in entry['shards'].items():
+            if not os.path.exists(filepath):
+                continue
+            if size == 0:
+                os.remove(filepath)
+            else:
+                with open(filepath, 'r+') as f:
+                    f.truncate(size)
+
+        # The journal stays until the flush below replaces it, a crash before then just rolls back again
+        print(f'Rolled back an interrupted vocabulary flush of {len(entry["captions"])} caption files')
+        for video_code, caption_filepath in entry['captions']:
+            if os.path.exists(caption_filepath):
+                atomize_captions(video_code, caption_filepath, self)
+        self.flush()
+
+
+TIMECODE = r'(?:(\d+):)?(\d\d):(\d\d)\.(\d\d\d)'
+cue_timing = re.compile(rf'^{TIMECODE} --> {TIMECODE}')
+inline_timecode = re.compile(rf'<{TIMECODE}>')
+style_tag = re.compile(r'</?c[^>]*>')
+
+
+def _seconds(h, m, s, ms):
+    return int(h or 0)*60*60 + int(m)*60 + int(s) + int(ms)/1000
+
+
+def atomize_captions(video_code, caption_filepath, writer=None):
+    '''Finds start and end time of all words in .vtt caption file and writes to vocabulary.'''
+
+    # Without a shared writer, each caption file is flushed on its own
+    if writer is None:
+        with VocabularyWriter() as writer:
+            return atomize_captions(video_code, caption_filepath, writer)
+
+    for word, start_time, end_time in iter_caption_words(caption_filepath):
+        writer.add(word, video_code, start_time, end_time)
+    writer.caption_done(video_code, caption_filepath)
+
+
+def iter_caption_words(caption_filepath):
+    '''
+    Yields (word, start_time, end_time) for every timed word in a .vtt caption file, in one pass.
+
+    Only lines carrying inline <hh:mm:ss.mmm> timecodes are word timed. The first word of such a
+    line starts with its cue and the last ends with it. Auto-captions roll each line through
+    several cues, so a word starting (or, for a re-anchored first word, ending) before the last
+    word we yielded is a repeat and dropped.
+    '''
+    cue_start = None
+    cue_end = None
+    last_start = -1
+    words_at_last_start = set()
+
+    with open(caption_filepath) as f:
+        for line in f:
+            timing = cue_timing.match(line)
+            if timing:
+                groups = timing.groups()
+                cue_start, cue_end = _seconds(*groups[:4]), _seconds(*groups[4:])
+                continue
+
+            if cue_start is None or '<' not in line:
+                continue
+
+            # Splitting on the timecodes gives [text, h, m, s, ms, text, h, m, s, ms, text, ...]
+            pieces = inline_timecode.split(style_tag.sub('', line))
+            if len(pieces) == 1:
+                continue
+            texts = pieces[0::5]
+            starts = [cue_start] + [_seconds(*pieces[i:i+4]) for i in range(1, len(pieces), 5)] + [cue_end]
+
+            for i, text in enumerate(texts):
+                start_time, end_time = starts[i], max(starts[i], starts[i+1])
+                for word in text.split():
+                    if start_time < last_start or starts[i+1] <= last_start:
+                        continue
+                    if start_time == last_start and word in words_at_last_start:
+                        continue
+                    if start_time > last_start:
+                        last_start = start_time
+                        words_at_last_start = set()
+                    words_at_last_start.add(word)
+                    yield word, start_time, end_time
 
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('video_code')
+    parser.add_argument('sources', nargs='+', help='Video codes, or with --bulk also list files, playlist and channel URLs')
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--atomize-workers', type=int, default=None)
+    parser.add_argument('--local-captions', default=None, help='Fetch from a directory of <code>.en.vtt files instead of YouTube')
+    parser.add_argument('--local-delay', type=float, default=0, help='Simulated seconds per fetch with --local-captions')
     args = parser.parse_args()
-    expand_vocabulary(str(args.video_code))
+
+    if args.bulk or args.local_captions:
+        extractor_factory = captions_downloader
+        if args.local_captions:
+            extractor_factory = partial(LocalCaptionExtractor, args.local_captions, delay=args.local_delay)
+        expand_vocabulary_bulk(args.sources, args.download_workers, args.atomize_workers, extractor_factory)
+    else:
+        for video_code in args.sources:
+            expand_vocabulary(str(video_code))
@@ -0,0 +1,79 @@
+import numpy as np
+from audio_utils import AudioBuffer
+from speech_to_text import sample_recognize, Transcript, RecognizedWord
+
+
+'''
+Many short clips recognized in one request.
+
+The clips are joined with a known stretch of silence between them, sent once, and every
+recognized word is handed back to the clip its midpoint falls in, with its offsets made
+relative to that clip. Packed audio is kept under the synchronous API's one minute limit by
+splitting into several requests when needed.
+'''
+
+
+MULTIPLEX_GAP = 1.0
+MAX_REQUEST_DURATION = 55
+
+
+def pack(buffers, gap=MULTIPLEX_GAP):
+    '''Joins buffers with gap seconds of silence. Returns the packed buffer and each clip's (start, end) in it.'''
+    sample_rate = buffers[0].sample_rate
+    silence = np.zeros(int(gap * sample_rate), dtype=buffers[0].samples.dtype)
+
+    pieces, spans = [], []
+    position = 0
+    for i, buffer in enumerate(buffers):
+        if i > 0:
+            pieces += [silence]
+            position += len(silence)
+        pieces += [buffer.samples]
+        spans += [(position / sample_rate, (position + len(buffer.samples)) / sample_rate)]
+        position += len(buffer.samples)
+    return AudioBuffer(np.concatenate(pieces), sample_rate), spans
+
+
+def split(transcript, spans, gap=MULTIPLEX_GAP):
+    '''Splits a Transcript of packed audio into one Transcript (or None if silent) per clip.'''
+    words = [[] for _ in spans]
+    if transcript is not None:
+        for w in transcript.words:
+            middle = (w.start_time + w.end_time) / 2
+            for i, (start, end) in enumerate(spans):
+                if start - gap / 2 <= middle < end + gap / 2:
+                    words[i] += [RecognizedWord(w.word, max(0, w.start_time - start), max(0, w.end_time - start), w.confidence)]
+                    break
+
+    return [Transcript(' '.join(w.word for w in clip_words), clip_words) if clip_words else None for clip_words in words]
+
+
+def recognize_multiplexed(buffers, log_filepath, label='multiplexed clips', gap=MULTIPLEX_GAP, max_duration=MAX_REQUEST_DURATION, stats=None):
+    '''
+    Returns one Transcript (or None) per buffer, using as few recognition requests as fit.
+    If a stats dict is given, its 'requests' count is increased by the requests made.
+    '''
+    transcripts = []
+    batch = []
+    batch_duration = 0
+
+    def flush():
+        if stats is not None:
+            stats['requests'] = stats.get('requests', 0) + 1
+        packed, spans = pack(batch, gap)
+        try:
+            # Packed clips run to nearly a minute, and come back as several results
+            transcript = sample_recognize(f'{label} x{len(batch)}', log_filepath, content=packed.to_wav_bytes(), long_audio=True)
+        except IndexError:
+            transcript = None
+        return split(transcript, spans, gap)
+
+    for buffer in buffers:
+        if batch and batch_duration + gap + buffer.duration > max_duration:
+            transcripts += flush()
+            batch, batch_duration = [], 0
+        batch_duration += buffer.duration + (gap if batch else 0)
+        batch += [buffer]
+    if batch:
+        transcripts += flush()
+    return transcripts
@@ -1,5 +1,11 @@
+import os
+import asyncio
 import argparse
-from clip_word import clip_word
+import threading
+from concurrent.futures import Future
+from functools import partial
+from clip_word import clip_word, trusted_load
+from trusted_vocabulary import trusted_vocabulary_filepath, read_trusted_vocabulary
 from subprocess import check_output
 from speech_to_text import sample_recognize
 from youtube_utils import video_to_flac
@@ -11,16 +17,20 @@ clean_word = lambda x: ''.join([c for c in x.lower() if c.isalpha() or c.isdigit
 
 # TODO: Create videogram. Then Quality check that. If certain word not seen swap out for another edition
 #       requires "stocking" of trusted vocab with multiple editions of word
-def ransom_videogram(phrase):
+def ransom_videogram(phrase, workers=4, timeout=None):
     safe_phrase = [clean_word(word) for word in phrase]
 
+    # Each word is clipped once, however often it appears
+    filepaths, failures = asyncio.run(clip_phrase(safe_phrase, workers, timeout))
+    if failures:
+        for word, error in failures.items():
+            print(f'Could not clip "{word}": {error!r}')
+        raise RuntimeError(f'Could not clip {", ".join(failures)}, the other words are clipped and trusted for next time')
+
     # Create a file defining which videos to concat
     with open('concat.txt', 'w') as f:
         for word in safe_phrase:
-            # Download a clip for this word
-            filepath = clip_word(word)
-
-            f.write(f"file '{filepath}'\n")
+            f.write(f"file '{filepaths[word]}'\n")
 
     # Feed the file to ffmpeg
     phrase_text = "-".join(safe_phrase)
@@ -31,9 +41,73 @@ def ransom_videogram(phrase):
 #    check_transcription(output_filename, phrase_text)
 
 
+async def clip_phrase(safe_phrase, workers=4, timeout=None):
+    '''
+    Clips the distinct words of safe_phrase, workers at a time. Returns each word's video filepath,
+    and the error of each word that couldn't be clipped. A failed word doesn't stop the others,
+    and one that timed out frees its worker for the next word while its try finishes in the background.
+    '''
+    unique_words = list(dict.fromkeys(safe_phrase))
+    worker_slots = asyncio.Semaphore(workers)
+
+    async def clip(word):
+        async with worker_slots:
+            return await clip_word_within(word, timeout)
+
+    print(f'Clipping {len(unique_words)} distinct words of {len(safe_phrase)}, {workers} at a time')
+    results = await asyncio.gather(*[clip(word) for word in unique_words], return_exceptions=True)
+    filepaths = {word: result for word, result in zip(unique_words, results) if not isinstance(result, BaseException)}
+    failures = {word: result for word, result in zip(unique_words, results) if isinstance(result, BaseException)}
+    return filepaths, failures
+
+
+async def run_within(function, timeout=None):
+    '''
+    Runs function() on a daemon thread of its own, and returns its result if it takes at most
+    timeout seconds. Otherwise raises asyncio.TimeoutError and abandons the thread: neither this
+    call, asyncio.run nor the interpreter's exit waits for it, so timeout really bounds the wait.
+    '''
+    result = Future()
+
+    def run():
+        # Once running, the future can't be cancelled from under us by the timeout
+        result.set_running_or_notify_cancel()
+        try:
+            result.set_result(function())
+        except BaseException as error:
+            result.set_exception(error)
+
+    threading.Thread(target=run, daemon=True).start()
+    return await asyncio.wait_for(asyncio.wrap_future(result), timeout)
+
+
+async def clip_word_within(safe_word, timeout=None):
+    '''
+    Clips safe_word, swapping in the next edition of it in the trusted vocabulary whenever a try
+    takes over timeout seconds (clip_word loads the first). Raises asyncio.TimeoutError once no
+    edition is left to swap in. A try that times out is abandoned, and finishes in the background.
+    '''
+    trusted_filepath = trusted_vocabulary_filepath(safe_word)
+    editions = len(read_trusted_vocabulary(trusted_filepath)) if os.path.exists(trusted_filepath) else 0
+
+    try:
+        return await run_within(partial(clip_word, safe_word), timeout)
+    except asyncio.TimeoutError:
+        print(f'Clipping "{safe_word}" took over {timeout} seconds, trying {max(0, editions - 1)} other trusted editions')
+
+    for edition in range(1, editions):
+        try:
+            return await run_within(partial(trusted_load, safe_word, trusted_filepath, edition), timeout)
+        except asyncio.TimeoutError:
+            print(f'Edition {edition} of "{safe_word}" took over {timeout} seconds')
+    raise asyncio.TimeoutError(f'Every try at "{safe_word}" took over {timeout} seconds')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('phrase', nargs='+')
+    parser.add_argument('--workers', type=int, default=4, help='Words clipped at once')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds a word may take before another trusted edition is used, or it fails')
     args = parser.parse_args()
 
-    ransom_videogram(args.phrase)
+    ransom_videogram(args.phrase, args.workers, args.timeout)
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+'''
+On-disk cache of recognition results, keyed by a hash of the audio bytes and the
+recognition config. Values are stored as JSON and handed back as they went in.
+Least recently used entries are dropped once the stored results exceed max_bytes.
+'''
+
+
+RECOGNITION_CACHE_FILEPATH = './cache/recognitions.sqlite'
+
+MISS = object()
+
+
+class RecognitionCache():
+
+    def __init__(self, filepath=RECOGNITION_CACHE_FILEPATH, max_bytes=256 * 1024**2):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._db = sqlite3.connect(filepath, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS recognitions (key TEXT PRIMARY KEY, result TEXT, size INTEGER, last_used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS recognitions_last_used ON recognitions (last_used)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM recognitions').fetchone()[0]
+
+    @staticmethod
+    def key(content, config):
+        digest = hashlib.sha256(content)
+        digest.update(json.dumps(config, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _count(self, name):
+        self._db.execute('INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+    def get(self, content, config):
+        '''Returns the stored value for this audio and config, or MISS.'''
+        key = self.key(content, config)
+        with self._lock, self._db:
+            row = self._db.execute('SELECT result FROM recognitions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._count('misses')
+                return MISS
+            self.hits += 1
+            self._count('hits')
+            self._db.execute('UPDATE recognitions SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, content, config, value):
+        key = self.key(content, config)
+        result = json.dumps(value)
+        with self._lock, self._db:
+            replaced = self._db.execute('SELECT size FROM recognitions WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO recognitions VALUES (?, ?, ?, ?)', (key, result, len(result), time.time()))
+            self._size += len(result) - (replaced[0] if replaced else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may share the file, so recount before deleting
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM recognitions').fetchone()[0]
+        for key, size in self._db.execute('SELECT key, size FROM recognitions ORDER BY last_used').fetchall():
+            if self._size <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM recognitions WHERE key = ?', (key,))
+            self._size -= size
+
+    def stats(self):
+        '''Hit and miss counts for this process, plus the totals kept on disk.'''
+        with self._lock:
+            counters = dict(self._db.execute('SELECT name, value FROM counters').fetchall())
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM recognitions').fetchone()
+        lookups = self.hits + self.misses
+        total_lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'total_hits': counters.get('hits', 0),
+            'total_misses': counters.get('misses', 0),
+            'total_hit_rate': counters.get('hits', 0) / total_lookups if total_lookups else 0,
+            'entries': entries,
+            'bytes': size,
+        }
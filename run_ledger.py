@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+
+'''
+Ledger of clipping runs, kept in SQLite so any number of workers can share it.
+
+Ids for logs, attempts and crops are handed out from per-scope counters inside a write
+transaction, so two workers stocking the same word never get the same file, and nothing has
+to list a directory to find the next free name. Each attempt is recorded with its inputs, the
+files it wrote and how it ended. Attempts still marked running were interrupted.
+'''
+
+
+LEDGER_FILEPATH = './ledger.sqlite'
+
+RUNNING = 'running'
+
+
+class RunLedger():
+
+    def __init__(self, filepath=LEDGER_FILEPATH):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Transactions are opened explicitly, so allocations can take the write lock up front
+        self._db = sqlite3.connect(filepath, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS counters (scope TEXT PRIMARY KEY, next_id INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS attempts (id INTEGER PRIMARY KEY AUTOINCREMENT, word TEXT, kind TEXT, inputs TEXT, outputs TEXT, outcome TEXT, started REAL, finished REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS attempts_word ON attempts (word)')
+
+    def _write(self, statements):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._db)
+                self._db.execute('COMMIT')
+            except BaseException:
+                # Interrupts too, or the write lock stays held by an open transaction
+                self._db.execute('ROLLBACK')
+                raise
+        return result
+
+    def next_id(self, scope, first=None):
+        '''
+        Returns the next id of scope, counting from 0.
+        first() gives the first id of a scope the ledger hasn't seen, e.g. one past the files
+        an older run left behind. It's only called once per scope.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT next_id FROM counters WHERE scope = ?', (scope,)).fetchone()
+        start = first() if row is None and first is not None else 0
+
+        def allocate(db):
+            db.execute('INSERT INTO counters VALUES (?, ?) ON CONFLICT(scope) DO UPDATE SET next_id = next_id + 1', (scope, start))
+            return db.execute('SELECT next_id FROM counters WHERE scope = ?', (scope,)).fetchone()[0]
+        return self._write(allocate)
+
+    def begin_attempt(self, word, kind, **inputs):
+        '''Records an attempt as running and returns its id.'''
+        return self._write(lambda db: db.execute(
+            'INSERT INTO attempts (word, kind, inputs, outputs, outcome, started) VALUES (?, ?, ?, ?, ?, ?)',
+            (word, kind, json.dumps(inputs), json.dumps({}), RUNNING, time.time())
+        ).lastrowid)
+
+    def finish_attempt(self, attempt_id, outcome, **outputs):
+        '''Records how an attempt ended, and any files or values it produced.'''
+        def finish(db):
+            recorded = json.loads(db.execute('SELECT outputs FROM attempts WHERE id = ?', (attempt_id,)).fetchone()[0])
+            recorded.update(outputs)
+            db.execute('UPDATE attempts SET outputs = ?, outcome = ?, finished = ? WHERE id = ?', (json.dumps(recorded), outcome, time.time(), attempt_id))
+        self._write(finish)
+
+    def attempts(self, word=None, outcome=None):
+        '''Recorded attempts as dicts, oldest first, optionally of one word and/or outcome.'''
+        query, parameters = 'SELECT id, word, kind, inputs, outputs, outcome, started, finished FROM attempts WHERE 1', []
+        if word is not None:
+            query, parameters = query + ' AND word = ?', parameters + [word]
+        if outcome is not None:
+            query, parameters = query + ' AND outcome = ?', parameters + [outcome]
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY id', parameters).fetchall()
+        return [{
+            'id': row[0],
+            'word': row[1],
+            'kind': row[2],
+            'inputs': json.loads(row[3]),
+            'outputs': json.loads(row[4]),
+            'outcome': row[5],
+            'started': row[6],
+            'finished': row[7],
+        } for row in rows]
+
+    def interrupted(self, word=None):
+        return self.attempts(word, RUNNING)
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = RunLedger()
+        return _ledger
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('word', nargs='?', help='Only show attempts at this word')
+    parser.add_argument('--interrupted', action='store_true', help='Only show attempts that never finished')
+    args = parser.parse_args()
+
+    ledger = get_ledger()
+    for attempt in ledger.attempts(args.word, RUNNING if args.interrupted else None):
+        print(f'{attempt["id"]}\t{attempt["word"]}\t{attempt["kind"]}\t{attempt["outcome"]}\t{attempt["inputs"]}\t{attempt["outputs"]}')
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from subprocess import check_output
+
+
+'''
+Downloaded source segments, kept so the same stretch of a video is only fetched once.
+
+Segments are keyed by (video_code, kind, start, end) and stored under the hash of that
+key. A request contained in a cached segment is cut from it locally. A request that
+overlaps cached segments of the same video fetches the union once, replacing them.
+Least recently used segments are evicted once the store grows past max_bytes.
+
+Segments being read are pinned, and neither evicted nor replaced until released. The
+manifest is only written when segments are added or removed, merged with what other
+processes sharing the directory wrote since; hits and last use times ride along.
+'''
+
+
+SEGMENT_DIRECTORY = './media/segments'
+
+
+def _cut(source_filepath, offset, length, output, codec_args, log_filepath=''):
+    command = f'ffmpeg -y -ss {round(offset, 3)} -i {source_filepath} -t {round(length, 3)} {codec_args} {output}'
+    with open(log_filepath or os.devnull, 'a') as log:
+        log.write(f'Executing: {command}\n')
+        check_output(command, shell=True, stderr=log)
+
+
+class SegmentCache():
+
+    def __init__(self, directory=SEGMENT_DIRECTORY, max_bytes=2 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.manifest_filepath = f'{directory}/manifest.json'
+        self._lock = threading.Lock()
+        self._video_locks = {}
+        self._pins = {}
+        self._removed = set()
+        self._unsaved = {'hits': 0, 'misses': 0}
+
+        self.segments = []
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self.manifest_filepath):
+            with open(self.manifest_filepath) as f:
+                manifest = json.load(f)
+            self.segments = [s for s in manifest['segments'] if os.path.exists(s['filepath'])]
+            self.hits = manifest['hits']
+            self.misses = manifest['misses']
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'segments': len(self.segments),
+            'bytes': sum(s['size'] for s in self.segments),
+        }
+
+    def _save(self):
+        # Keep what other processes added since, unless this one removed it
+        stored = {'segments': [], 'hits': 0, 'misses': 0}
+        if os.path.exists(self.manifest_filepath):
+            with open(self.manifest_filepath) as f:
+                stored = json.load(f)
+        known = {s['filepath'] for s in self.segments} | self._removed
+        self.segments += [s for s in stored['segments'] if s['filepath'] not in known and os.path.exists(s['filepath'])]
+        self.hits = stored['hits'] + self._unsaved['hits']
+        self.misses = stored['misses'] + self._unsaved['misses']
+        self._unsaved = {'hits': 0, 'misses': 0}
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_filepath = f'{self.manifest_filepath}.{os.getpid()}.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump({'segments': self.segments, 'hits': self.hits, 'misses': self.misses}, f)
+        os.replace(tmp_filepath, self.manifest_filepath)
+
+    def _count(self, segment):
+        name = 'hits' if segment is not None else 'misses'
+        setattr(self, name, getattr(self, name) + 1)
+        self._unsaved[name] += 1
+        if segment is not None:
+            segment['last_used'] = time.time()
+
+    def _remove(self, segment):
+        self.segments.remove(segment)
+        self._removed.add(segment['filepath'])
+        if os.path.exists(segment['filepath']):
+            os.remove(segment['filepath'])
+
+    def in_use(self, segment):
+        return self._pins.get(segment['filepath'], 0) > 0
+
+    def segment_filepath(self, video_code, kind, start, end, extension):
+        key = f'{video_code}:{kind}:{start:.3f}:{end:.3f}'
+        return f'{self.directory}/{hashlib.sha1(key.encode()).hexdigest()}.{extension}'
+
+    def _video_lock(self, video_code):
+        with self._lock:
+            return self._video_locks.setdefault(video_code, threading.Lock())
+
+    def find(self, video_code, start, end, kind='audio'):
+        '''Returns the cached segment containing [start, end], or None.'''
+        for segment in self.segments:
+            if segment['video_code'] == video_code and segment['kind'] == kind and \
+               segment['start'] <= start and end <= segment['end']:
+                return segment
+        return None
+
+    def _overlapping(self, video_code, start, end, kind):
+        return [s for s in self.segments if s['video_code'] == video_code and s['kind'] == kind and s['start'] < end and start < s['end']]
+
+    def overlapping(self, video_code, start, end, kind='audio'):
+        '''The cached segments of video_code overlapping [start, end].'''
+        with self._lock:
+            return self._overlapping(video_code, start, end, kind)
+
+    def lookup(self, video_code, start, end, kind='audio'):
+        '''
+        find, counted as a hit or miss, for callers that read cached media themselves.
+        A segment found is pinned until it's passed to release.
+        '''
+        with self._lock:
+            segment = self.find(video_code, round(start, 3), round(end, 3), kind)
+            self._count(segment)
+            if segment is not None:
+                self._pins[segment['filepath']] = self._pins.get(segment['filepath'], 0) + 1
+        return segment
+
+    def release(self, segment):
+        with self._lock:
+            self._pins[segment['filepath']] -= 1
+            if self._pins[segment['filepath']] == 0:
+                del self._pins[segment['filepath']]
+
+    def add(self, video_code, kind, start, end, filepath, replaces=()):
+        '''
+        Registers a segment written to filepath (see segment_filepath), evicting as needed.
+        Segments in replaces are dropped, unless they're in use, in which case they're left to eviction.
+        '''
+        segment = {
+            'video_code': video_code,
+            'kind': kind,
+            'start': round(start, 3),
+            'end': round(end, 3),
+            'filepath': filepath,
+            'size': os.path.getsize(filepath),
+            'last_used': time.time(),
+        }
+        with self._lock:
+            for s in replaces:
+                if s in self.segments and not self.in_use(s):
+                    self._remove(s)
+            self.segments = [s for s in self.segments if s['filepath'] != filepath] + [segment]
+            self._removed.discard(filepath)
+            self._evict(keep=segment)
+            self._save()
+        return segment
+
+    def fetch(self, video_code, start, end, output, download, kind='audio', codec_args='', extension='flac', log_filepath=''):
+        '''
+        Writes [start, end] of video_code to output, only downloading what isn't cached.
+
+        download(span_start, span_end, filepath) must fetch that span from the source.
+        codec_args are the ffmpeg output options used when cutting from a cached segment.
+        '''
+        start, end = round(start, 3), round(end, 3)
+
+        # One fetch per video at a time, so two callers never download the same span
+        with self._video_lock(video_code):
+            with self._lock:
+                segment = self.find(video_code, start, end, kind)
+                self._count(segment)
+                if segment is None:
+                    overlapping = self._overlapping(video_code, start, end, kind)
+
+            # The union replaces every segment it covers
+            if segment is None:
+                os.makedirs(self.directory, exist_ok=True)
+                span_start = min([start] + [s['start'] for s in overlapping])
+                span_end = max([end] + [s['end'] for s in overlapping])
+                filepath = self.segment_filepath(video_code, kind, span_start, span_end, extension)
+                download(span_start, span_end, filepath)
+                segment = self.add(video_code, kind, span_start, span_end, filepath, replaces=overlapping)
+
+            _cut(segment['filepath'], start - segment['start'], end - start, output, codec_args, log_filepath)
+
+    def _evict(self, keep=None):
+        total = sum(s['size'] for s in self.segments)
+        for segment in sorted(self.segments, key=lambda s: s['last_used']):
+            if total <= self.max_bytes:
+                break
+            # Never pull a segment out from under a fetch that may be cutting from it
+            lock = self._video_locks.get(segment['video_code'])
+            if segment is keep or self.in_use(segment) or (lock is not None and lock.locked()):
+                continue
+            self._remove(segment)
+            total -= segment['size']
+
+    def clear(self):
+        with self._lock:
+            self._save()
+            for segment in list(self.segments):
+                if not self.in_use(segment):
+                    self._remove(segment)
+            self._save()
@@ -1,36 +1,209 @@
 from google.cloud import speech_v1p1beta1
+from recognition_cache import RecognitionCache, MISS
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import io
 import sys
+import threading
 
-def sample_recognize(local_file_path, log_filepath):
+
+# Words carry their offsets in seconds and their confidence as plain floats
+RecognizedWord = namedtuple('RecognizedWord', ['word', 'start_time', 'end_time', 'confidence'])
+Transcript = namedtuple('Transcript', ['transcript', 'words'])
+
+RECOGNITION_CONFIG = {
+    "enable_word_confidence": True,
+    "enable_word_time_offsets": True,
+    # The language of the supplied audio
+    "language_code": "en-US",
+}
+
+
+def _seconds(duration):
+    return duration.seconds + duration.nanos / 1e9
+
+
+def transcript_from_response(response):
+    '''The most probable alternative of the first result, or None if nothing was heard.'''
+    # TODO: We throw out alternatives and only use the first one.. they may be helpful
+    if len(response.results) == 0:
+        return None
+    alternative = response.results[0].alternatives[0]
+    words = [RecognizedWord(w.word, _seconds(w.start_time), _seconds(w.end_time), float(w.confidence)) for w in alternative.words]
+    return Transcript(alternative.transcript, words)
+
+
+def transcript_from_long_response(response):
+    '''
+    The most probable alternative of every result joined into one Transcript, or None if nothing
+    was heard. Longer audio comes back split into several results, one per stretch of speech.
+    '''
+    alternatives = [result.alternatives[0] for result in response.results if len(result.alternatives) > 0]
+    if alternatives == []:
+        return None
+    words = [RecognizedWord(w.word, _seconds(w.start_time), _seconds(w.end_time), float(w.confidence)) for alternative in alternatives for w in alternative.words]
+    return Transcript(' '.join(alternative.transcript.strip() for alternative in alternatives), words)
+
+
+class SpeechRecognizer():
+    '''
+    Process-wide recognizer owning a small pool of long-lived SpeechClients, so credentials
+    and channels are set up once rather than on every request.
+    '''
+
+    def __init__(self, pool_size=2, max_workers=8, client_factory=speech_v1p1beta1.SpeechClient):
+        self.pool_size = pool_size
+        self.max_workers = max_workers
+        self.client_factory = client_factory
+        self._clients = []
+        self._next_client = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _client(self):
+        with self._lock:
+            if len(self._clients) < self.pool_size:
+                self._clients += [self.client_factory()]
+            client = self._clients[self._next_client % len(self._clients)]
+            self._next_client += 1
+        return client
+
+    def recognize(self, content, config=None, long_audio=False):
+        '''
+        Returns the Transcript of encoded (FLAC or WAV) audio bytes, or None if nothing was heard.
+        With long_audio, the words of every result are kept rather than only the first result's.
+        '''
+        response = self._client().recognize(config or RECOGNITION_CONFIG, {"content": content})
+        return transcript_from_long_response(response) if long_audio else transcript_from_response(response)
+
+    def recognize_many(self, contents, config=None, long_audio=False):
+        '''recognize for many clips at once, in the order given.'''
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+        return list(self._executor.map(lambda content: self.recognize(content, config, long_audio), contents))
+
+
+class FakeRecognizer():
+    '''
+    Local stand-in for SpeechRecognizer. respond(content, config) returns the Transcript
+    (or None) to answer with, or a response shaped like the API's, which is parsed as
+    SpeechRecognizer would. Clipping runs offline and every request is counted.
+    '''
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def recognize(self, content, config=None, long_audio=False):
+        with self._lock:
+            self.calls += 1
+        response = self.respond(content, config or RECOGNITION_CONFIG)
+        if hasattr(response, 'results'):
+            return transcript_from_long_response(response) if long_audio else transcript_from_response(response)
+        return response
+
+    def recognize_many(self, contents, config=None, long_audio=False):
+        return [self.recognize(content, config, long_audio) for content in contents]
+
+
+class CachedRecognizer():
+    '''
+    Wraps any recognizer with a RecognitionCache, so audio that was recognized before,
+    with the same config, is answered from disk instead of the API. Only heard audio is
+    cached: an empty answer may be a transient one, so silence is asked about again.
+    '''
+
+    def __init__(self, recognizer, cache=None):
+        self.recognizer = recognizer
+        self.cache = cache if cache is not None else RecognitionCache()
+
+    @staticmethod
+    def _cache_config(config, long_audio):
+        # Only the cache key tells the two apart, the API is sent config as it is
+        return dict(config, long_audio=True) if long_audio else config
+
+    def recognize(self, content, config=None, long_audio=False):
+        config = config or RECOGNITION_CONFIG
+        cache_config = self._cache_config(config, long_audio)
+        cached = self.cache.get(content, cache_config)
+        if cached is not MISS and cached is not None:
+            return _transcript_from_json(cached)
+        transcript = self.recognizer.recognize(content, config, long_audio)
+        if transcript is not None:
+            self.cache.put(content, cache_config, _transcript_to_json(transcript))
+        return transcript
+
+    def recognize_many(self, contents, config=None, long_audio=False):
+        config = config or RECOGNITION_CONFIG
+        cache_config = self._cache_config(config, long_audio)
+        # Entries cached as None before silence stopped being cached count as misses
+        cached = [self.cache.get(content, cache_config) for content in contents]
+        cached = [MISS if value is None else value for value in cached]
+        missing = [content for content, value in zip(contents, cached) if value is MISS]
+        fresh = iter(self.recognizer.recognize_many(missing, config, long_audio) if missing else [])
+
+        transcripts = []
+        for content, value in zip(contents, cached):
+            if value is MISS:
+                transcript = next(fresh)
+                if transcript is not None:
+                    self.cache.put(content, cache_config, _transcript_to_json(transcript))
+            else:
+                transcript = _transcript_from_json(value)
+            transcripts += [transcript]
+        return transcripts
+
+
+def _transcript_to_json(transcript):
+    if transcript is None:
+        return None
+    return {'transcript': transcript.transcript, 'words': [list(w) for w in transcript.words]}
+
+
+def _transcript_from_json(value):
+    if value is None:
+        return None
+    return Transcript(value['transcript'], [RecognizedWord(*w) for w in value['words']])
+
+
+_recognizer = None
+_recognizer_lock = threading.Lock()
+
+def get_recognizer():
+    global _recognizer
+    with _recognizer_lock:
+        if _recognizer is None:
+            _recognizer = CachedRecognizer(SpeechRecognizer())
+        return _recognizer
+
+
+def set_recognizer(recognizer):
+    '''Swaps the process-wide recognizer, e.g. for a FakeRecognizer (wrap it in CachedRecognizer to cache).'''
+    global _recognizer
+    with _recognizer_lock:
+        _recognizer = recognizer
+
+
+def sample_recognize(local_file_path, log_filepath, content=None, long_audio=False):
     """
     Print start and end time of each word spoken in audio file from Cloud Storage
 
     Args:
-      storage_uri URI for audio file in Cloud Storage, e.g. gs://[BUCKET]/[FILE]
+      local_file_path Path of a local audio file, or just a label for the log when content is given
+      content Encoded audio bytes (FLAC or WAV) to send instead of reading local_file_path
+      long_audio Keep the words of every result, for audio long enough to come back as several
     """
 
-    client = speech_v1p1beta1.SpeechClient()
-    enable_word_time_offsets = True
-    enable_word_confidence = True
+    if content is None:
+        with io.open(local_file_path, "rb") as f:
+            content = f.read()
+
+    alternative = get_recognizer().recognize(content, long_audio=long_audio)
+    if alternative is None:
+        raise IndexError(f'No words were found in {local_file_path}')
 
-    # The language of the supplied audio
-    language_code = "en-US"
-    config = {
-        "enable_word_confidence": enable_word_confidence,
-        "enable_word_time_offsets": enable_word_time_offsets,
-        "language_code": language_code,
-    }
-    with io.open(local_file_path, "rb") as f:
-        content = f.read()
-    audio = {"content": content}
-
-    response = client.recognize(config, audio)
-
-    # The first result includes start and end time word offsets
-    result = response.results[0]
-    # First alternative is the most probable result
-    alternative = result.alternatives[0]
     with open(log_filepath, 'a') as log:
         log.write(f'\nFile: {local_file_path}\n')
         log.write(f'transcription: {alternative.transcript}\n')
@@ -38,14 +211,6 @@ def sample_recognize(local_file_path, log_filepath):
         for word in alternative.words:
             log.write(f'Word: {word.word}\n')
             log.write(f'Conf: {word.confidence}\n')
-            log.write(
-                u"Start time: {} seconds {} nanos\n".format(
-                    word.start_time.seconds, word.start_time.nanos
-                )
-            )
-            log.write(
-                u"End time: {} seconds {} nanos\n".format(
-                    word.end_time.seconds, word.end_time.nanos
-                )
-            )
+            log.write(f'Start time: {word.start_time} seconds\n')
+            log.write(f'End time: {word.end_time} seconds\n')
     return alternative
@@ -0,0 +1,146 @@
+import pytest
+import numpy as np
+
+pytest.importorskip('google.cloud.speech_v1p1beta1')
+pytest.importorskip('youtube_dl')
+pytest.importorskip('pydub')
+
+import WordClip as word_clip
+import video_alignment
+from audio_utils import AudioBuffer
+from run_ledger import RunLedger
+from speech_to_text import FakeRecognizer, RecognizedWord, Transcript
+from WordClip import WordClip
+
+
+# Samples count hundredths of a second, so a buffer tells where in the raw clip it starts
+SAMPLE_RATE = 100
+
+
+@pytest.fixture
+def clips(tmp_path, monkeypatch):
+    '''Raw clips decode 12 seconds of counting samples, and are heard as "the quick fox".'''
+    monkeypatch.chdir(tmp_path)
+    ledger = RunLedger(str(tmp_path / 'ledger.sqlite'))
+    monkeypatch.setattr(word_clip, 'get_ledger', lambda: ledger)
+    monkeypatch.setattr(video_alignment, '_alignments', {})
+
+    produced = []
+    monkeypatch.setattr(word_clip, 'download_audio', lambda *args, **kwargs: produced.append(args[0]))
+    monkeypatch.setattr(word_clip, 'decode_audio', lambda filepath, log_filepath='': AudioBuffer(np.arange(12 * SAMPLE_RATE, dtype='<i2'), SAMPLE_RATE))
+
+    words = [RecognizedWord('The', 4.0, 4.3, 0.9), RecognizedWord('quick', 4.3, 4.8, 0.8), RecognizedWord('fox', 5.0, 5.6, 0.95)]
+    recognizer = FakeRecognizer(lambda content, config: Transcript('The quick fox', words))
+    monkeypatch.setattr(word_clip, 'get_recognizer', lambda: recognizer)
+    return produced, recognizer
+
+
+def test_audio_is_produced_once_and_only_when_needed(clips):
+    produced, recognizer = clips
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+    assert produced == []
+
+    assert clip.audio is clip.audio
+    assert produced == ['aaaaaaaaaaa']
+    assert (clip.start_time, clip.end_time, clip.audio.duration) == (1.0, 12.0, 12)
+
+
+def test_each_clip_is_recognized_once(clips):
+    produced, recognizer = clips
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+
+    assert clip.transcript == 'the quick fox'
+    assert list(clip) == ['the', 'quick', 'fox']
+    assert clip.interval_of('FOX') == (5.0, 5.6)
+    assert clip.confidence_of('quick') == 0.8
+    assert clip.occurrences_of('dog') == [] and clip.interval_of('dog') is None
+    assert recognizer.calls == 1
+
+    crop = clip.crop((4.0, 6.0))
+    crop.transcript, crop.interval_of('fox')
+    assert recognizer.calls == 2
+    assert produced == ['aaaaaaaaaaa']
+
+
+def test_silence_is_recognized_once(clips, monkeypatch):
+    produced, recognizer = clips
+    silent = FakeRecognizer(lambda content, config: None)
+    monkeypatch.setattr(word_clip, 'get_recognizer', lambda: silent)
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+
+    assert clip.transcription is None and clip.transcript is None
+    assert len(clip) == 0 and clip.interval_of('fox') is None
+    assert silent.calls == 1
+
+
+def test_aligned_raw_clips_are_not_recognized(clips):
+    produced, recognizer = clips
+    video_alignment.VideoAlignment('aaaaaaaaaaa', 60, [RecognizedWord('fox', 6.2, 6.6, 0.97), RecognizedWord('far', 13.0, 13.4, 0.9)]).save()
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+
+    assert list(clip) == ['fox']
+    assert clip.interval_of('fox') == pytest.approx((5.2, 5.6))
+    assert recognizer.calls == 0 and produced == []
+
+    # Derived clips are recognized, their times aren't the alignment's
+    assert clip.crop((4.0, 6.0)).transcript == 'the quick fox'
+    assert recognizer.calls == 1
+
+
+def test_clips_have_no_instance_dict(clips):
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+    assert not hasattr(clip, '__dict__')
+    with pytest.raises(AttributeError):
+        clip.transcribed = True
+
+
+def test_derived_clips_dont_load_alignments(clips, monkeypatch):
+    loaded = []
+    monkeypatch.setattr(word_clip, 'load_alignment', lambda video_code: loaded.append(video_code))
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+    clip.crop((4.0, 6.0)).transcript
+    assert loaded == []
+
+
+@pytest.fixture
+def speed_changes(monkeypatch):
+    '''AudioBuffer.change_speed stretches the samples by repeating them, instead of running ffmpeg.'''
+    changes = []
+    def change_speed(buffer, speed, log_filepath=''):
+        changes.append((int(buffer.samples[0]), len(buffer), speed))
+        return AudioBuffer(np.repeat(buffer.samples, int(round(1 / speed))), buffer.sample_rate)
+    monkeypatch.setattr(AudioBuffer, 'change_speed', change_speed)
+    return changes
+
+
+def test_same_derivation_twice_is_the_same_clip(clips, speed_changes):
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+    assert clip.crop((4.0, 6.0)) is clip.crop((4.0, 6.0))
+    assert clip.change_speed(0.5) is clip.change_speed(0.5)
+    assert clip.crop((4.0, 6.0)).change_speed(0.5) is clip.change_speed(0.5).crop((8.0, 12.0))
+    assert clip.crop((4.0, 6.0)) is not clip.crop((4.0, 6.5))
+
+
+def test_speed_change_of_a_crop_is_sliced_from_the_raw_audio(clips, speed_changes):
+    produced, recognizer = clips
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+    slow = clip.crop((4.0, 6.0)).change_speed(0.5)
+
+    assert (slow.start_time, slow.end_time, slow.speed) == (5.0, 7.0, 0.5)
+    assert slow.audio.duration == 4.0
+    assert speed_changes == [(400, 200, 0.5)]
+    # The crop's own audio was never needed
+    assert clip.crop((4.0, 6.0))._audio is None
+    assert produced == ['aaaaaaaaaaa']
+
+
+def test_crops_of_a_slowed_clip_map_back_through_its_speed(clips, speed_changes):
+    clip = WordClip('fox', 'aaaaaaaaaaa', 6.0, 7.0)
+    slow = clip.change_speed(0.5)
+    crop = slow.crop((2.0, 4.0))
+
+    assert (crop.start_time, crop.end_time, crop.speed) == (2.0, 3.0, 0.5)
+    # Two seconds of slowed audio, starting at source second 2, one second into the raw clip
+    assert crop.audio.duration == 2.0
+    assert int(crop.audio.samples[0]) == 100
+    assert crop.change_speed(1) is clip.crop((1.0, 2.0))
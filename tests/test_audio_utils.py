@@ -0,0 +1,52 @@
+import io
+import wave
+import shutil
+import pytest
+import numpy as np
+
+from audio_utils import AudioBuffer
+
+
+def counting(seconds=2, sample_rate=16000):
+    return AudioBuffer((np.arange(int(seconds * sample_rate)) % 30000).astype('<i2'), sample_rate)
+
+
+def test_slice_is_a_view_of_the_given_seconds():
+    buffer = counting()
+    piece = buffer.slice(0.5, 1.25)
+    assert (len(piece), int(piece.samples[0]), piece.duration) == (12000, 8000, 0.75)
+    assert np.shares_memory(piece.samples, buffer.samples)
+    assert piece.slice(0.25, 0.5).samples[0] == 12000
+
+
+def test_slice_is_clamped_to_the_buffer():
+    buffer = counting()
+    assert len(buffer.slice(-1, 0.5)) == 8000
+    assert len(buffer.slice(1.5, 5)) == 8000
+    assert len(buffer.slice(1.5, 1.0)) == 0
+
+
+def test_wav_bytes_carry_the_samples():
+    buffer = counting(sample_rate=8000)
+    with wave.open(io.BytesIO(buffer.to_wav_bytes())) as wav:
+        assert (wav.getnchannels(), wav.getsampwidth(), wav.getframerate(), wav.getnframes()) == (1, 2, 8000, 16000)
+        assert np.array_equal(np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2'), buffer.samples)
+
+
+def test_wav_bytes_of_a_slice():
+    content = counting().slice(1.0, 1.5).to_wav_bytes()
+    assert content[:4] == b'RIFF' and content[8:12] == b'WAVE'
+    assert len(content) == 44 + 8000 * 2
+
+
+def test_normal_speed_is_the_same_buffer():
+    buffer = counting()
+    assert buffer.change_speed(1) is buffer
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='needs ffmpeg')
+def test_slowed_buffer_is_longer_by_the_speed():
+    tone = AudioBuffer((8000 * np.sin(2 * np.pi * 220 * np.arange(32000) / 16000)).astype('<i2'))
+    slowed = tone.change_speed(0.5)
+    assert slowed.sample_rate == 16000
+    assert slowed.duration == pytest.approx(4.0, abs=0.05)
@@ -0,0 +1,82 @@
+import pytest
+import candidate_ranking
+from candidate_ranking import CandidateRanking
+from run_ledger import RunLedger
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    ledger = RunLedger(str(tmp_path / 'ledger.sqlite'))
+    monkeypatch.setattr(candidate_ranking, 'get_ledger', lambda: ledger)
+    return ledger
+
+
+def test_longer_spans_and_lone_rows_rank_first(tmp_path, ledger):
+    ranking = CandidateRanking(str(tmp_path / 'candidates.sqlite'))
+    rows = [
+        ('aaaaaaaaaaa', 1.0, 1.2),
+        ('bbbbbbbbbbb', 1.0, 2.0),
+        # Rolling captions repeat a word within a second
+        ('ccccccccccc', 1.0, 2.0), ('ccccccccccc', 1.5, 2.5), ('ccccccccccc', 1.8, 2.8),
+    ]
+    ranking.refresh('hello', rows)
+    assert ranking.count('hello') == 5
+    assert ranking.top('hello', 2) == [('bbbbbbbbbbb', 1.0, 2.0), ('aaaaaaaaaaa', 1.0, 1.2)]
+
+
+def test_outcomes_rerank_the_video(tmp_path, ledger):
+    ranking = CandidateRanking(str(tmp_path / 'candidates.sqlite'))
+    ranking.refresh('hello', [('aaaaaaaaaaa', 1.0, 2.0), ('aaaaaaaaaaa', 9.0, 10.0), ('bbbbbbbbbbb', 1.0, 1.8)])
+    assert ranking.top('hello')[0][0] == 'aaaaaaaaaaa'
+
+    ranking.record('hello', ('aaaaaaaaaaa', 1.0, 2.0), success=False)
+    assert ranking.count('hello') == 2
+    assert ranking.top('hello', 3) == [('bbbbbbbbbbb', 1.0, 1.8), ('aaaaaaaaaaa', 9.0, 10.0)]
+
+    # Words share what was learnt about a video
+    ranking.refresh('world', [('aaaaaaaaaaa', 3.0, 4.0), ('bbbbbbbbbbb', 3.0, 3.8)])
+    assert ranking.top('world') == [('bbbbbbbbbbb', 3.0, 3.8)]
+
+
+def test_refresh_keeps_the_ranking_while_the_row_count_holds(tmp_path, ledger):
+    ranking = CandidateRanking(str(tmp_path / 'candidates.sqlite'))
+    ranking.refresh('hello', [('aaaaaaaaaaa', 1.0, 2.0)])
+    ranking.refresh('hello', [('bbbbbbbbbbb', 1.0, 2.0)])
+    assert ranking.top('hello', 2) == [('aaaaaaaaaaa', 1.0, 2.0)]
+
+    ranking.refresh('hello', [('aaaaaaaaaaa', 1.0, 2.0), ('bbbbbbbbbbb', 1.0, 2.0)])
+    assert ranking.count('hello') == 2
+
+
+def test_video_statistics_are_seeded_from_the_ledger(tmp_path, ledger):
+    def attempt(video_code, outcome=None, **outputs):
+        attempt_id = ledger.begin_attempt('other', 'vocabulary', video_code=video_code)
+        if outcome is not None:
+            ledger.finish_attempt(attempt_id, outcome, **outputs)
+
+    for outcome in ['word not found', 'not isolated', 'fetch failed', 'search failed']:
+        attempt('aaaaaaaaaaa', outcome)
+    attempt('bbbbbbbbbbb', 'clipped', confidence=0.9)
+
+    ranking = CandidateRanking(str(tmp_path / 'candidates.sqlite'))
+    ranking.refresh('hello', [('aaaaaaaaaaa', 1.0, 2.0), ('bbbbbbbbbbb', 1.0, 1.5)])
+    assert ranking.top('hello') == [('bbbbbbbbbbb', 1.0, 1.5)]
+
+
+def test_seeding_ignores_cancelled_and_interrupted_attempts(tmp_path, ledger):
+    def attempt(video_code, outcome=None):
+        attempt_id = ledger.begin_attempt('other', 'vocabulary', video_code=video_code)
+        if outcome is not None:
+            ledger.finish_attempt(attempt_id, outcome)
+
+    # Live, cancelled attempts are never recorded
+    live = CandidateRanking(str(tmp_path / 'live.sqlite'))
+
+    # Speculative attempts that lost the race, and one a crash left running
+    for outcome in ['cancelled', 'cancelled', 'cancelled', None]:
+        attempt('aaaaaaaaaaa', outcome)
+    seeded = CandidateRanking(str(tmp_path / 'seeded.sqlite'))
+    rows = [('aaaaaaaaaaa', 1.0, 2.0), ('aaaaaaaaaaa', 5.0, 5.5), ('bbbbbbbbbbb', 1.0, 1.8)]
+    seeded.refresh('hello', rows)
+    live.refresh('hello', rows)
+    assert seeded.top('hello', 3) == live.top('hello', 3) == [('aaaaaaaaaaa', 1.0, 2.0), ('bbbbbbbbbbb', 1.0, 1.8), ('aaaaaaaaaaa', 5.0, 5.5)]
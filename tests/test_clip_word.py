@@ -0,0 +1,229 @@
+import os
+import time
+import pytest
+
+pytest.importorskip('google.cloud.speech_v1p1beta1')
+pytest.importorskip('youtube_dl')
+
+import clip_word
+from tombstones import Tombstones
+from vocabulary_index import write_index
+
+
+@pytest.fixture
+def vocabulary(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(clip_word, '_vocabulary_index', None)
+    monkeypatch.setattr(clip_word, '_vocabulary_index_mtime', None)
+    tombstones = Tombstones(str(tmp_path / 'tombstones.tsv'))
+    monkeypatch.setattr(clip_word, 'get_tombstones', lambda: tombstones)
+    os.makedirs('vocabulary/H')
+    return tmp_path
+
+
+def write_shard(rows, mode='w'):
+    with open('vocabulary/H/hello.tsv', mode) as f:
+        if mode == 'w':
+            f.write('video_code\tstart_time\tend_time\n')
+        for row in rows:
+            f.write('\t'.join(str(x) for x in row) + '\n')
+
+
+def test_rows_appended_after_the_index_are_read(vocabulary):
+    write_shard([('a', 1.0, 2.0)])
+    time.sleep(0.01)
+    write_index({'hello': [('a', 1.0, 2.0)]}, 'vocabulary.idx')
+    assert clip_word.get_clip_information('hello') == [('a', 1.0, 2.0)]
+
+    time.sleep(0.01)
+    write_shard([('b', 3.0, 4.0)], mode='a')
+    assert clip_word.get_clip_information('hello') == [('a', 1.0, 2.0), ('b', 3.0, 4.0)]
+
+
+def test_rebuilt_index_is_reopened(vocabulary):
+    write_shard([('a', 1.0, 2.0)])
+    time.sleep(0.01)
+    write_index({'hello': [('a', 1.0, 2.0)]}, 'vocabulary.idx')
+    clip_word.get_clip_information('hello')
+
+    time.sleep(0.01)
+    write_index({'hello': [('a', 1.0, 2.0), ('c', 5.0, 6.0)]}, 'vocabulary.idx')
+    assert clip_word.get_clip_information('hello') == [('a', 1.0, 2.0), ('c', 5.0, 6.0)]
+    assert clip_word.vocabulary_index().posting_count == 2
+
+
+class Pipeline():
+    '''clip_candidates over fake vocabulary rows, with downloads, searches and rendering stubbed out.'''
+
+    def __init__(self, tmp_path, monkeypatch, rows, search):
+        import asyncio
+        import candidate_ranking
+        from run_ledger import RunLedger
+
+        monkeypatch.chdir(tmp_path)
+        self.ledger = RunLedger(str(tmp_path / 'ledger.sqlite'))
+        monkeypatch.setattr(clip_word, 'get_ledger', lambda: self.ledger)
+        monkeypatch.setattr(candidate_ranking, 'get_ledger', lambda: self.ledger)
+        self.ranking = candidate_ranking.CandidateRanking(str(tmp_path / 'candidates.sqlite'))
+        self.ranking.refresh('hello', rows)
+        tombstones = Tombstones(str(tmp_path / 'tombstones.tsv'))
+        monkeypatch.setattr(clip_word, 'get_tombstones', lambda: tombstones)
+
+        async def fetch(video_code, start_time, end_time, speed, audio_output=None, **kwargs):
+            await asyncio.sleep(0.01)
+            if isinstance(search.get(video_code), OSError):
+                raise search[video_code]
+            with open(audio_output, 'w') as f:
+                f.write(video_code)
+        monkeypatch.setattr(clip_word, 'fetch_slowed_clip_async', fetch)
+
+        def search_candidate(safe_word, candidate, ranking, cancelled=None, **options):
+            outcome = search[candidate['clip_info'][0]]
+            if isinstance(outcome, Exception):
+                raise outcome
+            if outcome is None:
+                self.ledger.finish_attempt(candidate['attempt_id'], 'word not found')
+                ranking.record(safe_word, candidate['clip_info'], success=False)
+                return None
+            return dict(candidate, confidence=outcome)
+        monkeypatch.setattr(clip_word, 'search_candidate', search_candidate)
+
+        async def render_candidate(safe_word, candidate, ranking):
+            self.ledger.finish_attempt(candidate['attempt_id'], 'clipped')
+            return candidate['clip_info'][0]
+        monkeypatch.setattr(clip_word, 'render_candidate', render_candidate)
+
+    def run(self, speculate=1, prefetch=1):
+        import asyncio
+        return asyncio.run(clip_word.clip_candidates('hello', self.ranking, speculate, prefetch))
+
+    def outcomes(self):
+        return {attempt['inputs']['video_code']: attempt['outcome'] for attempt in self.ledger.attempts()}
+
+    def slowed_clips(self):
+        return sorted(os.listdir('media/audio/hello/slow-clips'))
+
+
+# Rows rank by span length, so a is tried first and d last
+ROWS = [('a', 1.0, 3.0), ('b', 1.0, 2.8), ('c', 1.0, 2.6), ('d', 1.0, 2.4)]
+
+
+def test_search_errors_lose_only_their_row(tmp_path, monkeypatch):
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS, {'a': RuntimeError('speech api'), 'b': RuntimeError('speech api'), 'c': 0.97, 'd': None})
+    assert pipeline.run(speculate=1) == 'c'
+    outcomes = pipeline.outcomes()
+    assert outcomes['a'] == outcomes['b'] == 'search failed'
+    assert outcomes['c'] == 'clipped'
+    assert 'running' not in outcomes.values()
+    assert ('a', 1.0, 3.0) not in pipeline.ranking.top('hello', 4)
+
+
+def test_search_errors_surface_when_nothing_passes(tmp_path, monkeypatch):
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS[:2], {'a': RuntimeError('speech api'), 'b': None})
+    with pytest.raises(RuntimeError):
+        pipeline.run(speculate=2)
+    assert set(pipeline.outcomes().values()) == {'search failed', 'word not found'}
+
+
+def test_download_errors_move_on_to_the_next_row(tmp_path, monkeypatch):
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS, {'a': OSError('video removed'), 'b': 0.97, 'c': None, 'd': None})
+    assert pipeline.run(speculate=2) == 'b'
+    outcomes = pipeline.outcomes()
+    assert outcomes['a'] == 'fetch failed'
+    assert outcomes['b'] == 'clipped'
+    assert 'running' not in outcomes.values()
+
+
+def test_rows_passing_after_the_winner_are_dropped(tmp_path, monkeypatch):
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS, {'a': 0.96, 'b': 0.97, 'c': 0.98, 'd': 0.99})
+    winner = pipeline.run(speculate=3, prefetch=1)
+    outcomes = pipeline.outcomes()
+    assert outcomes[winner] == 'clipped'
+    assert [outcome for code, outcome in outcomes.items() if code != winner] == ['cancelled'] * (len(outcomes) - 1)
+    # Only the winner's slowed audio is kept
+    assert len(pipeline.slowed_clips()) == 1
+
+
+def test_aligned_words_are_trusted_at_their_own_interval():
+    from speech_to_text import RecognizedWord
+
+    occurrence = RecognizedWord('hello', 12.3, 12.7, 0.93)
+    clip_info = clip_word.aligned_clip_information('a', occurrence)
+    assert (clip_info['clip_start_time'], clip_info['clip_end_time']) == (12.3, 12.7)
+    assert clip_word.word_video_interval(clip_info) == pytest.approx((12.3, 12.7))
+
+
+real_render_candidate = clip_word.render_candidate
+
+
+class Audio():
+
+    def slice(self, start_time, end_time):
+        return self
+
+    def save(self, filepath, log_filepath=''):
+        pass
+
+
+def test_failed_render_ends_the_winners_attempt(tmp_path, monkeypatch):
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS[:1], {'a': 0.97})
+    search_candidate = clip_word.search_candidate
+    monkeypatch.setattr(clip_word, 'search_candidate', lambda *args, **kwargs: dict(search_candidate(*args, **kwargs), audio=Audio(), interval=(1.0, 1.5), clip_information={}))
+    monkeypatch.setattr(clip_word, 'render_candidate', real_render_candidate)
+
+    async def render_word_video(clip_info, output, log_filepath):
+        raise OSError('video removed')
+    monkeypatch.setattr(clip_word, 'render_word_video_async', render_word_video)
+
+    with pytest.raises(OSError):
+        pipeline.run()
+    assert pipeline.outcomes() == {'a': 'render failed'}
+    assert pipeline.slowed_clips() == []
+    assert pipeline.ranking.top('hello') == [('a', 1.0, 3.0)]
+
+
+def test_vocabulary_is_read_off_the_event_loop(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS, {'a': 0.97, 'b': None, 'c': None, 'd': None})
+    readers = []
+    def get_clip_information(word):
+        readers.append(threading.current_thread())
+        return ROWS
+    monkeypatch.setattr(clip_word, 'get_clip_information', get_clip_information)
+    monkeypatch.setattr(clip_word, 'in_vocabulary', lambda word: True)
+    monkeypatch.setattr(clip_word, 'get_candidate_ranking', lambda: pipeline.ranking)
+
+    assert asyncio.run(clip_word.clip_word_async('hello', use_alignments=False)) == 'a'
+    assert readers and threading.main_thread() not in readers
+
+
+def test_stocking_passes_over_aligned_occurrences_already_trusted(tmp_path, monkeypatch):
+    import asyncio
+    import video_alignment
+    from speech_to_text import RecognizedWord
+
+    pipeline = Pipeline(tmp_path, monkeypatch, ROWS, {'a': 0.97, 'b': None, 'c': None, 'd': None})
+    monkeypatch.setattr(clip_word, 'in_vocabulary', lambda word: True)
+    monkeypatch.setattr(clip_word, 'get_clip_information', lambda word: ROWS)
+    monkeypatch.setattr(clip_word, 'get_candidate_ranking', lambda: pipeline.ranking)
+    monkeypatch.setattr(video_alignment, '_alignments', {})
+    video_alignment.VideoAlignment('v', 60, [RecognizedWord('hello', 12.3, 12.7, 0.95), RecognizedWord('hello', 30.1, 30.5, 0.9)]).save()
+
+    cut = []
+    def clip_aligned_word(safe_word, video_code, occurrence, log_filepath=''):
+        cut.append(occurrence.start_time)
+        with open(f'{occurrence.start_time}.mkv', 'w') as f:
+            f.write(str(occurrence.start_time))
+        return f'{occurrence.start_time}.mkv'
+    monkeypatch.setattr(clip_word, 'clip_aligned_word', clip_aligned_word)
+
+    stock = lambda: asyncio.run(clip_word.clip_word_async('hello', use_trusted=False))
+    stock()
+    stock()
+    assert cut == [12.3, 30.1]
+
+    # With every aligned occurrence trusted, the vocabulary is searched
+    assert stock() == 'a'
+    assert cut == [12.3, 30.1]
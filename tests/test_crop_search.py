@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from crop_search import search_crop, evaluate_concurrently, ISOLATED, NOT_ISOLATED, MISSING
+
+
+def counting(results):
+    sent = []
+    lock = threading.Lock()
+
+    def evaluate(interval):
+        with lock:
+            sent.append(interval)
+        return results[interval]
+    return evaluate, sent
+
+
+def test_confident_hit_skips_later_waves():
+    intervals = [(0, 1), (0, 2), (0, 3), (0, 4)]
+    evaluate, sent = counting({(0, 1): (ISOLATED, 0.97), (0, 2): (MISSING, 0), (0, 3): (MISSING, 0), (0, 4): (MISSING, 0)})
+    with ThreadPoolExecutor(4) as executor:
+        results = evaluate_concurrently(evaluate, intervals, executor, stop_confidence=0.95, wave_size=2)
+    assert sorted(sent) == [(0, 1), (0, 2)]
+    assert results == [(ISOLATED, 0.97), (MISSING, 0), None, None]
+
+
+def test_without_stop_confidence_every_interval_is_sent():
+    intervals = [(0, 1), (0, 2), (0, 3)]
+    evaluate, sent = counting({(0, 1): (ISOLATED, 0.97), (0, 2): (MISSING, 0), (0, 3): (MISSING, 0)})
+    with ThreadPoolExecutor(4) as executor:
+        results = evaluate_concurrently(evaluate, intervals, executor, wave_size=2)
+    assert len(sent) == 3
+    assert results == [(ISOLATED, 0.97), (MISSING, 0), (MISSING, 0)]
+
+
+def test_evaluations_given_up_come_back_as_none():
+    with ThreadPoolExecutor(2) as executor:
+        assert evaluate_concurrently(lambda interval: None, [(0, 1), (0, 2)], executor, stop_confidence=0.95) == [None, None]
+
+
+def recognizer(word=(1.0, 1.4), others=((0.5, 0.9), (1.5, 1.9))):
+    '''evaluate_many for a clip where a crop hears each word it covers, less confidently the more slack it leaves.'''
+    calls = []
+
+    def covers(interval, span):
+        return interval[0] <= span[0] and span[1] <= interval[1]
+
+    def evaluate(interval):
+        if not covers(interval, word):
+            return (MISSING, 0)
+        if any(covers(interval, span) for span in others):
+            return (NOT_ISOLATED, 0)
+        slack = (interval[1] - interval[0]) - (word[1] - word[0])
+        return (ISOLATED, round(1 - slack / 2, 3))
+
+    def evaluate_many(intervals):
+        calls.append(list(intervals))
+        return [evaluate(interval) for interval in intervals]
+    return evaluate_many, calls
+
+
+def test_too_wide_crop_is_narrowed_to_the_word():
+    evaluate_many, calls = recognizer()
+    interval, confidence, trials = search_crop(evaluate_many, 0.4, 2.0, duration=3, max_calls=20)
+    assert interval[0] <= 1.0 and 1.4 <= interval[1]
+    assert trials[(0.4, 2.0)] == (NOT_ISOLATED, 0)
+    assert confidence == trials[interval][1] and confidence >= 0.9
+
+
+def test_too_narrow_crop_is_widened_to_the_word():
+    evaluate_many, calls = recognizer()
+    interval, confidence, trials = search_crop(evaluate_many, 1.1, 1.3, duration=3, max_calls=20)
+    assert interval is not None and interval[0] <= 1.0 and 1.4 <= interval[1]
+
+
+def test_calls_stay_within_budget():
+    evaluate_many, calls = recognizer()
+    interval, confidence, trials = search_crop(evaluate_many, 0, 3, duration=3, max_calls=4, parallelism=2)
+    assert len(trials) <= 4
+    assert sum(len(c) for c in calls) == len(trials)
+    assert all(len(c) <= 2 for c in calls[1:])
+
+
+def test_confident_start_needs_no_search():
+    evaluate_many, calls = recognizer()
+    interval, confidence, trials = search_crop(evaluate_many, 1.0, 1.4, duration=3)
+    assert (interval, confidence, len(trials)) == ((1.0, 1.4), 1.0, 1)
+
+
+def test_candidates_are_tried_together_first():
+    evaluate_many, calls = recognizer()
+    search_crop(evaluate_many, 0, 3, duration=3, candidates=[(0.95, 1.45), (0.2, 2.5), (1.1, 1.25)])
+    assert calls[0] == [(0.95, 1.45), (0.2, 2.5), (1.1, 1.25)]
+
+
+def test_unheard_word_is_not_found():
+    evaluate_many, calls = recognizer(word=(5, 6))
+    interval, confidence, trials = search_crop(evaluate_many, 1.0, 1.4, duration=3, max_calls=6)
+    assert (interval, confidence) == (None, 0)
+    assert len(trials) == 6
+
+
+def test_given_up_evaluations_are_not_counted_as_trials():
+    interval, confidence, trials = search_crop(lambda intervals: [None] * len(intervals), 1.0, 1.4, duration=3)
+    assert (interval, confidence, trials) == (None, 0, {})
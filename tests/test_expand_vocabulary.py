@@ -0,0 +1,183 @@
+import json
+import os
+import pytest
+from functools import partial
+
+pytest.importorskip('youtube_dl')
+
+import expand_vocabulary
+from expand_vocabulary import expand_vocabulary_bulk, read_video_codes, VocabularyWriter
+from youtube_utils import LocalCaptionExtractor
+from vocabulary_index import read_tsv_shard
+
+
+def captions(*cues):
+    '''A .vtt file of (start, end, line) cues, lines carrying inline word timecodes.'''
+    timecode = lambda t: f'00:00:{int(t):02d}.{int(round(t % 1 * 1000)):03d}'
+    text = 'WEBVTT\n\n'
+    for start, end, line in cues:
+        text += f'{timecode(start)} --> {timecode(end)}\n{line}\n\n'
+    return text
+
+
+VIDEOS = {
+    'aaaaaaaaaaa': captions((1, 3, 'hello<00:00:01.500><c> world</c>')),
+    'bbbbbbbbbbb': captions((2, 4, 'hello<00:00:02.400><c> there</c>')),
+}
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    source_directory = tmp_path / 'source'
+    source_directory.mkdir()
+    for video_code, text in VIDEOS.items():
+        (source_directory / f'{video_code}.en.vtt').write_text(text)
+    working_directory = tmp_path / 'work'
+    working_directory.mkdir()
+    monkeypatch.chdir(working_directory)
+    return partial(LocalCaptionExtractor, str(source_directory))
+
+
+def shard(word):
+    return read_tsv_shard(f'vocabulary/{word[0].upper()}/{word}.tsv')
+
+
+def test_playlist_is_ingested(source):
+    stats = expand_vocabulary_bulk(['https://www.youtube.com/playlist?list=local'], extractor_factory=source, atomize_workers=1)
+    assert stats == {'videos': 2, 'words': 4, 'failed': 0}
+    assert sorted(shard('hello')) == [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)]
+    assert shard('world') == [('aaaaaaaaaaa', 1.5, 3.0)]
+    assert sorted(os.listdir('captions')) == ['aaaaaaaaaaa.en.vtt', 'bbbbbbbbbbb.en.vtt', 'incoming']
+
+
+def test_resume_skips_videos_already_ingested(source):
+    expand_vocabulary_bulk(['aaaaaaaaaaa'], extractor_factory=source, atomize_workers=1)
+    stats = expand_vocabulary_bulk(['aaaaaaaaaaa', 'bbbbbbbbbbb'], extractor_factory=source, atomize_workers=1)
+    assert stats['videos'] == 1
+    assert len(shard('hello')) == 2
+
+
+def test_missing_captions_are_counted_as_failed(source):
+    stats = expand_vocabulary_bulk(['aaaaaaaaaaa', 'zzzzzzzzzzz'], extractor_factory=source, atomize_workers=1)
+    assert stats == {'videos': 1, 'words': 2, 'failed': 1}
+
+
+class LocalChannelExtractor(LocalCaptionExtractor):
+    '''Channels resolve to their uploads playlist, as they do on YouTube.'''
+
+    def extract_info(self, url, download=True, process=True):
+        if '/channel/' in url:
+            return {'_type': 'url', 'url': 'https://www.youtube.com/playlist?list=uploads'}
+        return super().extract_info(url, download, process)
+
+
+def test_sources_expand_lists_playlists_and_channels(source, tmp_path):
+    extractor = LocalChannelExtractor(source.args[0])
+    list_filepath = tmp_path / 'videos.txt'
+    list_filepath.write_text('# a comment\nccccccccccc\n\nhttps://www.youtube.com/channel/local\n')
+
+    video_codes = list(read_video_codes(['ddddddddddd', str(list_filepath), 'https://www.youtube.com/playlist?list=local'], extractor))
+    assert video_codes == ['ddddddddddd', 'ccccccccccc', 'aaaaaaaaaaa', 'bbbbbbbbbbb', 'aaaaaaaaaaa', 'bbbbbbbbbbb']
+
+
+def test_interrupted_flush_is_rolled_back_and_redone(source):
+    # A flush of video a, cut short after appending part of a row to hello's shard
+    expand_vocabulary_bulk(['bbbbbbbbbbb'], extractor_factory=source, atomize_workers=1)
+    os.makedirs('captions/incoming', exist_ok=True)
+    with open('captions/incoming/aaaaaaaaaaa.en.vtt', 'w') as f:
+        f.write(VIDEOS['aaaaaaaaaaa'])
+
+    hello_filepath, world_filepath = 'vocabulary/H/hello.tsv', 'vocabulary/W/world.tsv'
+    with open('vocabulary/.flush-journal.json', 'w') as journal:
+        json.dump({
+            'shards': {hello_filepath: os.path.getsize(hello_filepath), world_filepath: 0},
+            'captions': [['aaaaaaaaaaa', 'captions/incoming/aaaaaaaaaaa.en.vtt']],
+        }, journal)
+    with open(hello_filepath, 'a') as f:
+        f.write('aaaaaaaaaaa\t1.0\t1.')
+
+    committed = []
+    VocabularyWriter(on_commit=committed.extend)
+    assert not os.path.exists('vocabulary/.flush-journal.json')
+    assert sorted(shard('hello')) == [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)]
+    assert shard('world') == [('aaaaaaaaaaa', 1.5, 3.0)]
+    assert committed == [('aaaaaaaaaaa', 'captions/incoming/aaaaaaaaaaa.en.vtt')]
+
+
+def test_cut_short_journal_touches_nothing(source):
+    expand_vocabulary_bulk(['aaaaaaaaaaa'], extractor_factory=source, atomize_workers=1)
+    with open('vocabulary/.flush-journal.json', 'w') as journal:
+        journal.write('{"shards": {"vocabulary/H/hel')
+
+    VocabularyWriter()
+    assert shard('hello') == [('aaaaaaaaaaa', 1.0, 1.5)]
+
+
+def test_flush_interrupted_while_committing_is_committed_not_redone(source):
+    os.makedirs('captions/incoming')
+    with open('captions/incoming/aaaaaaaaaaa.en.vtt', 'w') as f:
+        f.write(VIDEOS['aaaaaaaaaaa'])
+
+    def crash(captions):
+        raise KeyboardInterrupt
+
+    writer = VocabularyWriter(on_commit=crash)
+    expand_vocabulary.atomize_captions('aaaaaaaaaaa', 'captions/incoming/aaaaaaaaaaa.en.vtt', writer)
+    with pytest.raises(KeyboardInterrupt):
+        writer.flush()
+    assert os.path.exists('vocabulary/.flush-journal.json')
+
+    VocabularyWriter()
+    assert not os.path.exists('vocabulary/.flush-journal.json')
+    assert os.path.exists('captions/aaaaaaaaaaa.en.vtt') and not os.path.exists('captions/incoming/aaaaaaaaaaa.en.vtt')
+    assert shard('hello') == [('aaaaaaaaaaa', 1.0, 1.5)]
+
+    stats = expand_vocabulary_bulk(['aaaaaaaaaaa'], extractor_factory=source, atomize_workers=1)
+    assert stats['videos'] == 0
+    assert shard('hello') == [('aaaaaaaaaaa', 1.0, 1.5)]
+
+
+def test_interrupted_bulk_run_resumes_without_duplicates(source, monkeypatch):
+    expand_vocabulary_bulk(['bbbbbbbbbbb'], extractor_factory=source, atomize_workers=1)
+
+    # Interrupted with every row of video a appended, but before its flush committed
+    write_journal = VocabularyWriter._write_journal
+    def crash_once_written(self, entry):
+        if entry.get('committed'):
+            raise KeyboardInterrupt
+        write_journal(self, entry)
+    monkeypatch.setattr(VocabularyWriter, '_write_journal', crash_once_written)
+    with pytest.raises(KeyboardInterrupt):
+        expand_vocabulary_bulk(['aaaaaaaaaaa', 'bbbbbbbbbbb'], extractor_factory=source, atomize_workers=1)
+    monkeypatch.setattr(VocabularyWriter, '_write_journal', write_journal)
+    assert os.path.exists('captions/incoming/aaaaaaaaaaa.en.vtt')
+
+    stats = expand_vocabulary_bulk(['aaaaaaaaaaa', 'bbbbbbbbbbb'], extractor_factory=source, atomize_workers=1)
+    assert stats['videos'] == 0
+    assert sorted(shard('hello')) == [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)]
+    assert shard('world') == [('aaaaaaaaaaa', 1.5, 3.0)]
+    assert os.listdir('captions/incoming') == []
+
+
+def test_rolling_auto_captions_yield_each_word_once(tmp_path):
+    # Auto-captions repeat the previous line above the new one, and re-send cues as they roll
+    caption_filepath = tmp_path / 'rolling.en.vtt'
+    caption_filepath.write_text(
+        'WEBVTT\nKind: captions\nLanguage: en\n\n'
+        '00:00:01.000 --> 00:00:03.000 align:start position:0%\n'
+        'hello<00:00:01.500><c> world</c>\n\n'
+        '00:00:01.000 --> 00:00:03.000 align:start position:0%\n'
+        'hello<00:00:01.500><c> world</c>\n\n'
+        '00:00:03.000 --> 00:00:03.010 align:start position:0%\n'
+        'hello world\n\n'
+        '00:00:01.200 --> 00:00:05.000 align:start position:0%\n'
+        'hello world\n'
+        'world<00:00:03.000><c> how</c><00:00:03.500><c> are</c><00:00:04.200><c> you</c>\n'
+    )
+    assert list(expand_vocabulary.iter_caption_words(str(caption_filepath))) == [
+        ('hello', 1.0, 1.5),
+        ('world', 1.5, 3.0),
+        ('how', 3.0, 3.5),
+        ('are', 3.5, 4.2),
+        ('you', 4.2, 5.0),
+    ]
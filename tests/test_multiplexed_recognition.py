@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from types import SimpleNamespace
+
+pytest.importorskip('google.cloud.speech_v1p1beta1')
+
+import speech_to_text
+from audio_utils import AudioBuffer
+from speech_to_text import FakeRecognizer
+from multiplexed_recognition import recognize_multiplexed
+
+
+def word(text, start, end, confidence=0.9):
+    seconds = lambda t: SimpleNamespace(seconds=int(t), nanos=int(round((t - int(t)) * 1e9)))
+    return SimpleNamespace(word=text, start_time=seconds(start), end_time=seconds(end), confidence=confidence)
+
+
+def result(*words):
+    return SimpleNamespace(alternatives=[SimpleNamespace(transcript=' '.join(w.word for w in words), words=list(words))])
+
+
+@pytest.fixture
+def recognizer(monkeypatch):
+    # Two 2 s clips packed with a 1 s gap, heard as one result per clip
+    response = SimpleNamespace(results=[
+        result(word('hello', 0.5, 1.0)),
+        result(word('world', 3.4, 3.9)),
+    ])
+    fake = FakeRecognizer(lambda content, config: response)
+    monkeypatch.setattr(speech_to_text, '_recognizer', fake)
+    return fake
+
+
+def test_clips_after_the_first_result_are_heard(recognizer, tmp_path):
+    clips = [AudioBuffer(np.zeros(32000, dtype=np.int16)), AudioBuffer(np.zeros(32000, dtype=np.int16))]
+    first, second = recognize_multiplexed(clips, str(tmp_path / 'log.txt'))
+
+    assert recognizer.calls == 1
+    assert [w.word for w in first.words] == ['hello']
+    assert [w.word for w in second.words] == ['world']
+    assert second.words[0].start_time == pytest.approx(0.4)
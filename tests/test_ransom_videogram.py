@@ -0,0 +1,105 @@
+import asyncio
+import os
+import time
+import pytest
+
+pytest.importorskip('google.cloud.speech_v1p1beta1')
+pytest.importorskip('youtube_dl')
+
+import ransom_videogram
+
+
+TRUSTED_HEADER = 'video_code\tclip_start_time\tclip_end_time\tspeed_multiplier\tword_start_time\tword_end_time\tartifact\n'
+
+
+@pytest.fixture
+def clipping(tmp_path, monkeypatch):
+    '''
+    clip_word blocks for the seconds in delays (default 0.01) and fails for the words in errors.
+    trusted_load blocks for the seconds in delays under (word, edition).
+    '''
+    monkeypatch.chdir(tmp_path)
+    calls, delays, errors = [], {}, {}
+
+    def clip_word(word):
+        calls.append(word)
+        time.sleep(delays.get(word, 0.01))
+        if word in errors:
+            raise errors[word]
+        return f'{word}.mkv'
+
+    def trusted_load(word, filepath, edition):
+        time.sleep(delays.get((word, edition), 0.01))
+        return f'{word}-{edition}.mkv'
+    monkeypatch.setattr(ransom_videogram, 'clip_word', clip_word)
+    monkeypatch.setattr(ransom_videogram, 'trusted_load', trusted_load)
+    return calls, delays, errors
+
+
+def trust(word, editions):
+    os.makedirs(f'trusted-vocabulary/{word[0].upper()}', exist_ok=True)
+    with open(f'trusted-vocabulary/{word[0].upper()}/{word}.tsv', 'w') as f:
+        f.write(TRUSTED_HEADER)
+        for i in range(editions):
+            f.write(f'v{i}\t1.0\t2.0\t0.7\t1.0\t1.5\t\n')
+
+
+def test_repeated_words_are_clipped_once(clipping):
+    calls, delays, errors = clipping
+    filepaths, failures = asyncio.run(ransom_videogram.clip_phrase(['the', 'fox', 'the', 'fox', 'jumps']))
+    assert sorted(calls) == ['fox', 'jumps', 'the']
+    assert filepaths == {'the': 'the.mkv', 'fox': 'fox.mkv', 'jumps': 'jumps.mkv'}
+    assert failures == {}
+
+
+def test_slow_trusted_word_gets_another_edition(clipping):
+    calls, delays, errors = clipping
+    trust('slow', 3)
+    delays['slow'] = delays[('slow', 1)] = 2
+    started = time.time()
+    filepaths, failures = asyncio.run(ransom_videogram.clip_phrase(['slow', 'fox'], timeout=0.1))
+    assert filepaths == {'slow': 'slow-2.mkv', 'fox': 'fox.mkv'}
+    assert time.time() - started < 1
+
+
+def test_slow_untrusted_word_fails_alone_within_the_timeout(clipping):
+    calls, delays, errors = clipping
+    delays['slow'] = 2
+    started = time.time()
+    filepaths, failures = asyncio.run(ransom_videogram.clip_phrase(['slow', 'fox'], timeout=0.1))
+    assert filepaths == {'fox': 'fox.mkv'}
+    assert isinstance(failures['slow'], asyncio.TimeoutError)
+    assert time.time() - started < 1
+
+
+def test_words_without_a_timeout_are_waited_for(clipping):
+    calls, delays, errors = clipping
+    delays['slow'] = 0.3
+    filepaths, failures = asyncio.run(ransom_videogram.clip_phrase(['slow', 'fox']))
+    assert filepaths == {'slow': 'slow.mkv', 'fox': 'fox.mkv'}
+
+
+def test_timed_out_phrase_is_not_held_up_on_exit(clipping, monkeypatch):
+    calls, delays, errors = clipping
+    trust('slow', 2)
+    delays['slow'] = 2
+    monkeypatch.setattr(ransom_videogram, 'check_output', lambda command, shell: None)
+    os.makedirs('videograms')
+
+    started = time.time()
+    ransom_videogram.ransom_videogram(['slow', 'fox'], timeout=0.1)
+    assert time.time() - started < 1
+    with open('concat.txt') as f:
+        assert f.read() == "file 'slow-1.mkv'\nfile 'fox.mkv'\n"
+
+
+def test_failed_words_dont_stop_the_others(clipping):
+    calls, delays, errors = clipping
+    errors['bad'] = FileNotFoundError('not in the vocabulary')
+    filepaths, failures = asyncio.run(ransom_videogram.clip_phrase(['bad', 'fox', 'jumps']))
+    assert filepaths == {'fox': 'fox.mkv', 'jumps': 'jumps.mkv'}
+    assert list(failures) == ['bad']
+
+    with pytest.raises(RuntimeError):
+        ransom_videogram.ransom_videogram(['bad', 'fox'])
+    assert not os.path.exists('concat.txt')
@@ -0,0 +1,101 @@
+import os
+import pytest
+import segment_cache
+from segment_cache import SegmentCache
+
+
+@pytest.fixture
+def cuts(monkeypatch):
+    '''Records the cuts fetch makes from cached segments, instead of running ffmpeg.'''
+    cuts = []
+    def cut(source_filepath, offset, length, output, codec_args, log_filepath=''):
+        cuts.append((source_filepath, round(offset, 3), round(length, 3)))
+        with open(output, 'w') as f:
+            f.write('cut')
+    monkeypatch.setattr(segment_cache, '_cut', cut)
+    return cuts
+
+
+def downloader(size=10):
+    downloads = []
+    def download(span_start, span_end, filepath):
+        downloads.append((span_start, span_end))
+        with open(filepath, 'wb') as f:
+            f.write(b'x' * size)
+    return download, downloads
+
+
+def test_contained_span_is_cut_from_the_cached_segment(tmp_path, cuts):
+    cache = SegmentCache(str(tmp_path / 'segments'))
+    download, downloads = downloader()
+    cache.fetch('aaaaaaaaaaa', 10, 20, str(tmp_path / 'first.flac'), download)
+    cache.fetch('aaaaaaaaaaa', 12, 15, str(tmp_path / 'second.flac'), download)
+
+    assert downloads == [(10, 20)]
+    assert cuts[1] == (cache.segments[0]['filepath'], 2, 3)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_overlapping_spans_are_fetched_as_their_union(tmp_path, cuts):
+    cache = SegmentCache(str(tmp_path / 'segments'))
+    download, downloads = downloader()
+    cache.fetch('aaaaaaaaaaa', 10, 20, str(tmp_path / 'first.flac'), download)
+    replaced = cache.segments[0]['filepath']
+    cache.fetch('aaaaaaaaaaa', 18, 25, str(tmp_path / 'second.flac'), download)
+    cache.fetch('bbbbbbbbbbb', 18, 25, str(tmp_path / 'other.flac'), download)
+
+    assert downloads == [(10, 20), (10, 25), (18, 25)]
+    assert [(s['video_code'], s['start'], s['end']) for s in cache.segments] == [('aaaaaaaaaaa', 10, 25), ('bbbbbbbbbbb', 18, 25)]
+    assert not os.path.exists(replaced)
+    assert cuts[1] == (cache.segments[0]['filepath'], 8, 7)
+
+
+def test_least_recently_used_segments_are_evicted(tmp_path, cuts):
+    cache = SegmentCache(str(tmp_path / 'segments'), max_bytes=25)
+    download, downloads = downloader(size=10)
+    for video_code in ['aaaaaaaaaaa', 'bbbbbbbbbbb']:
+        cache.fetch(video_code, 10, 20, str(tmp_path / 'out.flac'), download)
+    cache.fetch('aaaaaaaaaaa', 12, 15, str(tmp_path / 'out.flac'), download)
+    evicted = cache.find('bbbbbbbbbbb', 10, 20)['filepath']
+    cache.fetch('ccccccccccc', 10, 20, str(tmp_path / 'out.flac'), download)
+
+    assert sorted(s['video_code'] for s in cache.segments) == ['aaaaaaaaaaa', 'ccccccccccc']
+    assert not os.path.exists(evicted)
+
+
+def test_segments_in_use_are_neither_evicted_nor_replaced(tmp_path, cuts):
+    cache = SegmentCache(str(tmp_path / 'segments'), max_bytes=15)
+    download, downloads = downloader(size=10)
+    cache.fetch('aaaaaaaaaaa', 10, 20, str(tmp_path / 'out.flac'), download)
+    reading = cache.lookup('aaaaaaaaaaa', 12, 15)
+
+    cache.fetch('aaaaaaaaaaa', 18, 25, str(tmp_path / 'out.flac'), download)
+    cache.fetch('bbbbbbbbbbb', 10, 20, str(tmp_path / 'out.flac'), download)
+    assert reading in cache.segments and os.path.exists(reading['filepath'])
+
+    cache.release(reading)
+    cache.fetch('ccccccccccc', 10, 20, str(tmp_path / 'out.flac'), download)
+    assert reading not in cache.segments and not os.path.exists(reading['filepath'])
+
+
+def test_manifest_is_only_written_when_segments_change(tmp_path, cuts):
+    cache = SegmentCache(str(tmp_path / 'segments'))
+    download, downloads = downloader()
+    cache.fetch('aaaaaaaaaaa', 10, 20, str(tmp_path / 'out.flac'), download)
+    written = os.stat(cache.manifest_filepath).st_mtime_ns
+
+    cache.release(cache.lookup('aaaaaaaaaaa', 12, 15))
+    cache.lookup('aaaaaaaaaaa', 30, 35)
+    assert os.stat(cache.manifest_filepath).st_mtime_ns == written
+
+
+def test_processes_sharing_a_directory_keep_each_others_segments(tmp_path, cuts):
+    directory = str(tmp_path / 'segments')
+    download, downloads = downloader()
+    first, second = SegmentCache(directory), SegmentCache(directory)
+    first.fetch('aaaaaaaaaaa', 10, 20, str(tmp_path / 'out.flac'), download)
+    second.fetch('bbbbbbbbbbb', 10, 20, str(tmp_path / 'out.flac'), download)
+
+    reopened = SegmentCache(directory)
+    assert sorted(s['video_code'] for s in reopened.segments) == ['aaaaaaaaaaa', 'bbbbbbbbbbb']
+    assert (reopened.hits, reopened.misses) == (0, 2)
@@ -0,0 +1,70 @@
+import pytest
+from types import SimpleNamespace
+
+pytest.importorskip('google.cloud.speech_v1p1beta1')
+
+from speech_to_text import SpeechRecognizer, transcript_from_response, transcript_from_long_response
+
+
+def duration(seconds):
+    return SimpleNamespace(seconds=int(seconds), nanos=int(round((seconds - int(seconds)) * 1e9)))
+
+
+def result(*words):
+    '''A recognition result hearing (word, start, end, confidence) words.'''
+    alternative = SimpleNamespace(
+        transcript=' '.join(w[0] for w in words),
+        words=[SimpleNamespace(word=w, start_time=duration(s), end_time=duration(e), confidence=c) for w, s, e, c in words],
+    )
+    return SimpleNamespace(alternatives=[alternative])
+
+
+# Speech-to-Text splits a long request into one result per stretch of speech
+LONG_RESPONSE = SimpleNamespace(results=[
+    result(('the', 0.5, 0.7, 0.9), ('quick', 0.7, 1.1, 0.92)),
+    result(('brown', 31.2, 31.6, 0.88), ('fox', 31.6, 32.0, 0.95)),
+])
+
+
+class FakeClient():
+
+    def recognize(self, config, audio):
+        return LONG_RESPONSE
+
+
+def test_long_response_keeps_every_result():
+    transcript = transcript_from_long_response(LONG_RESPONSE)
+    assert transcript.transcript == 'the quick brown fox'
+    assert [w.word for w in transcript.words] == ['the', 'quick', 'brown', 'fox']
+    assert transcript.words[2].start_time == pytest.approx(31.2)
+
+
+def test_short_response_keeps_the_first_result():
+    assert [w.word for w in transcript_from_response(LONG_RESPONSE).words] == ['the', 'quick']
+
+
+def test_nothing_heard():
+    empty = SimpleNamespace(results=[])
+    assert transcript_from_response(empty) is None
+    assert transcript_from_long_response(empty) is None
+
+
+def test_recognizer_long_audio():
+    recognizer = SpeechRecognizer(client_factory=FakeClient)
+    assert len(recognizer.recognize(b'audio').words) == 2
+    assert [len(t.words) for t in recognizer.recognize_many([b'one', b'two'], long_audio=True)] == [4, 4]
+
+
+def test_silence_is_not_cached(tmp_path):
+    from recognition_cache import RecognitionCache
+    from speech_to_text import CachedRecognizer, FakeRecognizer, Transcript, RecognizedWord
+
+    heard = Transcript('hello', [RecognizedWord('hello', 0.1, 0.5, 0.9)])
+    answers = iter([None, heard])
+    fake = FakeRecognizer(lambda content, config: next(answers))
+    recognizer = CachedRecognizer(fake, RecognitionCache(str(tmp_path / 'recognitions.sqlite')))
+
+    assert recognizer.recognize(b'audio') is None
+    assert recognizer.recognize(b'audio') == heard
+    assert recognizer.recognize_many([b'audio']) == [heard]
+    assert fake.calls == 2
@@ -0,0 +1,70 @@
+from tombstones import Tombstones, compact
+from vocabulary_index import VocabularyIndex, write_index, read_tsv_shard
+
+
+def write_shard(filepath, rows):
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    filepath.write_text('video_code\tstart_time\tend_time\n' + ''.join(f'{v}\t{s}\t{e}\n' for v, s, e in rows))
+
+
+def test_rejected_rows_are_dropped_and_remembered(tmp_path):
+    filepath = tmp_path / 'vocabulary' / '.tombstones.tsv'
+    tombstones = Tombstones(str(filepath))
+    tombstones.reject('hello', ('aaaaaaaaaaa', 1.0, 1.5))
+    tombstones.reject('hello', ('aaaaaaaaaaa', 1.0, 1.5))
+
+    rows = [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)]
+    assert tombstones.alive('hello', rows) == [('bbbbbbbbbbb', 2.0, 2.4)]
+    assert tombstones.alive('world', rows) == rows
+    assert len(filepath.read_text().splitlines()) == 1
+
+    reopened = Tombstones(str(filepath))
+    assert reopened.is_rejected('hello', ('aaaaaaaaaaa', '1.0', '1.50'))
+    assert len(reopened) == 1
+
+
+def test_torn_last_line_is_ignored_and_ended(tmp_path):
+    filepath = tmp_path / '.tombstones.tsv'
+    filepath.write_text('hello\taaaaaaaaaaa\t1.0\t1.5\nhello\tbbbbbbbbbbb\t2.0\t2.')
+    tombstones = Tombstones(str(filepath))
+    tombstones.reject('world', ('ccccccccccc', 0.5, 1.0))
+
+    assert len(tombstones) == 3
+    assert Tombstones(str(filepath)).is_rejected('world', ('ccccccccccc', 0.5, 1.0))
+
+
+def test_compaction_applies_tombstones_to_shards_and_index(tmp_path):
+    vocab_directory, index_filepath = tmp_path / 'vocabulary', str(tmp_path / 'vocabulary.idx')
+    tombstones_filepath = str(vocab_directory / '.tombstones.tsv')
+    write_shard(vocab_directory / 'H' / 'hello.tsv', [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)])
+    write_shard(vocab_directory / 'W' / 'world.tsv', [('aaaaaaaaaaa', 1.5, 3.0)])
+    write_index({'hello': [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)], 'world': [('aaaaaaaaaaa', 1.5, 3.0)]}, index_filepath)
+
+    tombstones = Tombstones(tombstones_filepath)
+    tombstones.reject('hello', ('aaaaaaaaaaa', 1.0, 1.5))
+    tombstones.reject('world', ('aaaaaaaaaaa', 1.5, 3.0))
+
+    assert compact(tombstones_filepath, str(vocab_directory), index_filepath) == 2
+    assert read_tsv_shard(str(vocab_directory / 'H' / 'hello.tsv')) == [('bbbbbbbbbbb', 2.0, 2.4)]
+    assert not (vocab_directory / 'W' / 'world.tsv').exists()
+    with VocabularyIndex(index_filepath) as index:
+        assert list(index) == ['hello']
+        assert index.lookup('hello') == [('bbbbbbbbbbb', 2.0, 2.4)]
+    assert compact(tombstones_filepath, str(vocab_directory), index_filepath) == 0
+
+
+def test_interrupted_compaction_is_finished_by_the_next(tmp_path):
+    vocab_directory, index_filepath = tmp_path / 'vocabulary', str(tmp_path / 'vocabulary.idx')
+    tombstones_filepath = str(vocab_directory / '.tombstones.tsv')
+    write_shard(vocab_directory / 'H' / 'hello.tsv', [('aaaaaaaaaaa', 1.0, 1.5), ('bbbbbbbbbbb', 2.0, 2.4)])
+
+    # Moved aside, then a crash, then more rejections while nothing was compacting
+    vocab_directory.joinpath('.tombstones.tsv.compacting').write_text('hello\taaaaaaaaaaa\t1.0\t1.5\n')
+    tombstones = Tombstones(tombstones_filepath)
+    assert tombstones.is_rejected('hello', ('aaaaaaaaaaa', 1.0, 1.5))
+    tombstones.reject('hello', ('bbbbbbbbbbb', 2.0, 2.4))
+
+    assert compact(tombstones_filepath, str(vocab_directory), index_filepath) == 1
+    assert read_tsv_shard(str(vocab_directory / 'H' / 'hello.tsv')) == [('bbbbbbbbbbb', 2.0, 2.4)]
+    assert compact(tombstones_filepath, str(vocab_directory), index_filepath) == 1
+    assert not (vocab_directory / 'H' / 'hello.tsv').exists()
@@ -0,0 +1,74 @@
+import os
+import pytest
+
+import trusted_vocabulary
+from trusted_vocabulary import add_to_trusted_vocabulary, read_trusted_vocabulary, trusted_vocabulary_filepath, trusted_artifact
+
+
+@pytest.fixture
+def trusted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(trusted_vocabulary, 'MAX_EDITIONS', 2)
+
+
+def clip(video_code, start_time=1.0, content=None):
+    filepath = f'{video_code}-{start_time}.mkv'
+    with open(filepath, 'w') as f:
+        f.write(content or f'{video_code} {start_time}')
+    clip_info = {
+        'video_code': video_code,
+        'clip_start_time': start_time,
+        'clip_end_time': start_time + 1,
+        'speed_multiplier': 0.7,
+        'start_time': 1.2,
+        'end_time': 1.6,
+    }
+    return clip_info, filepath
+
+
+def artifacts():
+    return sorted(name for directory in os.listdir('trusted-vocabulary/artifacts') for name in os.listdir(f'trusted-vocabulary/artifacts/{directory}'))
+
+
+def test_editions_are_stored_by_content(trusted):
+    first = add_to_trusted_vocabulary('hello', *clip('a'))
+    second = add_to_trusted_vocabulary('hello', *clip('b'))
+    assert first != second
+    assert open(first).read() == 'a 1.0'
+
+    filepath = trusted_vocabulary_filepath('hello')
+    editions = read_trusted_vocabulary(filepath)
+    assert [edition[0] for edition in editions] == ['a', 'b']
+    assert trusted_artifact(filepath, 1) == second
+
+
+def test_same_clip_keeps_its_stored_video(trusted):
+    stored = add_to_trusted_vocabulary('hello', *clip('a'))
+    clip_info, filepath = clip('a', content='rendered again')
+    assert add_to_trusted_vocabulary('hello', clip_info, filepath) == stored
+    assert len(read_trusted_vocabulary(trusted_vocabulary_filepath('hello'))) == 1
+    assert len(artifacts()) == 1
+
+    # A lost artifact is replaced
+    os.remove(stored)
+    restored = add_to_trusted_vocabulary('hello', clip_info, filepath)
+    assert open(restored).read() == 'rendered again'
+    assert trusted_artifact(trusted_vocabulary_filepath('hello')) == restored
+
+
+def test_full_words_store_nothing(trusted):
+    add_to_trusted_vocabulary('hello', *clip('a'))
+    add_to_trusted_vocabulary('hello', *clip('b'))
+    clip_info, filepath = clip('c')
+    assert add_to_trusted_vocabulary('hello', clip_info, filepath) == filepath
+    assert len(read_trusted_vocabulary(trusted_vocabulary_filepath('hello'))) == 2
+    assert len(artifacts()) == 2
+
+
+def test_rows_without_artifacts_are_read(trusted):
+    os.makedirs('trusted-vocabulary/O')
+    with open('trusted-vocabulary/O/old.tsv', 'w') as f:
+        f.write('video_code\tclip_start_time\tclip_end_time\tspeed_multiplier\tword_start_time\tword_end_time\n')
+        f.write('a\t1.0\t2.0\t0.7\t1.2\t1.6\n')
+    assert read_trusted_vocabulary('trusted-vocabulary/O/old.tsv') == [('a', 1.0, 2.0, 0.7, 1.2, 1.6, '')]
+    assert trusted_artifact('trusted-vocabulary/O/old.tsv') is None
@@ -0,0 +1,75 @@
+import io
+import wave
+import pytest
+import numpy as np
+
+pytest.importorskip('google.cloud.speech_v1p1beta1')
+pytest.importorskip('youtube_dl')
+
+import video_alignment
+from audio_utils import AudioBuffer
+from segment_cache import SegmentCache
+from speech_to_text import FakeRecognizer, RecognizedWord, Transcript
+from video_alignment import chunk_spans, align_video
+
+
+def test_chunks_overlap_and_own_the_video_between_them():
+    spans = chunk_spans(120, chunk_length=50, overlap=5)
+    assert [chunk for chunk, own in spans] == [(0, 50), (45, 95), (90, 120)]
+    assert [own for chunk, own in spans] == [(0, 47.5), (47.5, 92.5), (92.5, 120)]
+
+
+def test_short_video_is_one_chunk():
+    assert chunk_spans(30) == [((0, 30), (0, 30))]
+
+
+# Samples count tenths of a second, so a recognizer can tell where a chunk starts
+SAMPLE_RATE = 10
+DURATION = 120
+SPOKEN = [RecognizedWord(f'word{i}', i + 0.3, i + 0.8, 0.9) for i in range(DURATION)]
+
+
+def hear_wholly_inside(content, config):
+    with wave.open(io.BytesIO(content)) as wav:
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2')
+    start, end = samples[0] / SAMPLE_RATE, (samples[-1] + 1) / SAMPLE_RATE
+    words = [RecognizedWord(w.word, w.start_time - start, w.end_time - start, w.confidence) for w in SPOKEN if start <= w.start_time and w.end_time <= end]
+    return Transcript(' '.join(w.word for w in words), words)
+
+
+@pytest.fixture
+def video(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = SegmentCache(str(tmp_path / 'segments'))
+    recognizer = FakeRecognizer(hear_wholly_inside)
+    monkeypatch.setattr(video_alignment, 'segment_cache', cache)
+    monkeypatch.setattr(video_alignment, '_alignments', {})
+    monkeypatch.setattr(video_alignment, 'get_recognizer', lambda: recognizer)
+    monkeypatch.setattr(video_alignment, 'download_full_audio', lambda video_code, output, log_filepath='': open(output, 'wb').close())
+    monkeypatch.setattr(video_alignment, 'decode_audio', lambda filepath, log_filepath='': AudioBuffer(np.arange(DURATION * SAMPLE_RATE, dtype='<i2'), SAMPLE_RATE))
+    return cache, recognizer
+
+
+def test_words_across_chunk_seams_are_kept_once(video):
+    cache, recognizer = video
+    alignment = align_video('aaaaaaaaaaa')
+
+    assert recognizer.calls == 3
+    assert [w.word for w in alignment.words] == [w.word for w in SPOKEN]
+    assert alignment.words[47] == RecognizedWord('word47', 47.3, 47.8, 0.9)
+    assert video_alignment.load_alignment('aaaaaaaaaaa') is alignment
+
+
+def test_full_audio_replaces_cached_segments_not_in_use(video, tmp_path):
+    cache, recognizer = video
+    (tmp_path / 'segments').mkdir()
+    for start in (10, 60):
+        filepath = cache.segment_filepath('aaaaaaaaaaa', 'audio', start, start + 10, 'flac')
+        with open(filepath, 'wb') as f:
+            f.write(b'x')
+        cache.add('aaaaaaaaaaa', 'audio', start, start + 10, filepath)
+    cache.lookup('aaaaaaaaaaa', 62, 65)
+
+    align_video('aaaaaaaaaaa')
+    assert [(s['start'], s['end']) for s in cache.segments] == [(60, 70), (0, DURATION)]
+    assert cache.find('aaaaaaaaaaa', 12, 15)['end'] == DURATION
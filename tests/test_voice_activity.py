@@ -0,0 +1,61 @@
+import numpy as np
+
+from audio_utils import AudioBuffer
+from voice_activity import silent_frames, snap_boundaries, HOP_LENGTH
+
+
+SAMPLE_RATE = 16000
+
+
+def signal(*parts):
+    '''A buffer of (kind, seconds) parts: 'silence' is a faint noise floor, 'tone' a loud 220Hz tone, 'hiss' quiet noise.'''
+    rng = np.random.default_rng(0)
+    samples = []
+    for kind, seconds in parts:
+        n = int(seconds * SAMPLE_RATE)
+        if kind == 'tone':
+            samples += [0.5 * np.sin(2 * np.pi * 220 * np.arange(n) / SAMPLE_RATE)]
+        else:
+            samples += [rng.uniform(-1, 1, n) * (2e-4 if kind == 'hiss' else 1e-5)]
+    return AudioBuffer((np.concatenate(samples) * 32767).astype('<i2'), SAMPLE_RATE)
+
+
+def frame_starts(mask):
+    return np.arange(len(mask)) * HOP_LENGTH
+
+
+def test_tone_is_voiced_and_its_padding_silent():
+    buffer = signal(('silence', 0.5), ('tone', 0.4), ('silence', 0.6))
+    silent = silent_frames(buffer)
+    starts = frame_starts(silent)
+
+    assert len(silent) == 1 + (len(buffer) - 400) // 160
+    assert silent[starts + 0.025 <= 0.5].all()
+    assert not silent[(starts >= 0.5) & (starts + 0.025 <= 0.9)].any()
+    assert silent[starts >= 0.9 + 1e-9].all()
+
+
+def test_quiet_hiss_counts_as_speech():
+    buffer = signal(('silence', 0.5), ('hiss', 0.2), ('tone', 0.4), ('silence', 0.5))
+    silent = silent_frames(buffer)
+    starts = frame_starts(silent)
+    assert not silent[(starts >= 0.5) & (starts + 0.025 <= 0.7)].any()
+
+
+def test_buffers_shorter_than_a_frame_have_no_frames():
+    assert len(silent_frames(AudioBuffer(np.zeros(100, dtype='<i2'), SAMPLE_RATE))) == 0
+
+
+def test_boundaries_snap_to_the_edges_of_the_tone():
+    buffer = signal(('silence', 0.5), ('tone', 0.4), ('silence', 0.6))
+    candidates = snap_boundaries(buffer, 0.42, 0.97)
+
+    start, end = candidates[0]
+    assert 0.44 <= start <= 0.5 and 0.9 <= end <= 0.95
+    assert len(candidates) <= 3
+    assert all(end - start >= 0.1 for start, end in candidates)
+
+
+def test_proposed_interval_stands_when_no_edge_is_near():
+    buffer = signal(('silence', 0.5), ('tone', 0.4), ('silence', 0.6))
+    assert snap_boundaries(buffer, 0.05, 0.2) == [(0.05, 0.2)]
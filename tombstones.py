@@ -0,0 +1,152 @@
+import os
+import csv
+import argparse
+import threading
+from vocabulary_index import VocabularyIndex, read_tsv_shard, write_index, VOCAB_DIRECTORY, VOCAB_INDEX_FILEPATH
+
+
+'''
+Rejected vocabulary rows, recorded as tombstones instead of rewriting the word's TSV.
+
+Rejecting a row appends one line to an append-only file and adds it to an in-memory set, so
+it costs the same for a word with ten rows as for one with ten thousand, and an interruption
+can at worst lose the last, partly written line. Lookups drop tombstoned rows with a set check.
+
+Compaction applies the tombstones to the TSV shards and the vocabulary index, each rewritten
+next to the original and swapped in. The tombstone file is first moved aside, so clipping can
+keep rejecting rows while compaction runs, and a compaction that was interrupted is finished
+by the next one. Compaction shouldn't run alongside expand_vocabulary, which appends to shards.
+'''
+
+
+TOMBSTONE_FILEPATH = f'{VOCAB_DIRECTORY}/.tombstones.tsv'
+
+
+def _key(word, clip_info):
+    video_code, start_time, end_time = clip_info
+    return (word, video_code, round(float(start_time), 3), round(float(end_time), 3))
+
+
+def _read_tombstones(filepath):
+    if not os.path.exists(filepath):
+        return set()
+    with open(filepath, newline='') as f:
+        rows = [row for row in csv.reader(f, delimiter='\t') if len(row) == 4]
+
+    keys = set()
+    for word, video_code, start_time, end_time in rows:
+        try:
+            keys.add(_key(word, (video_code, start_time, end_time)))
+        except ValueError:
+            # Only the last line can be torn, by a crash while it was written
+            continue
+    return keys
+
+
+class Tombstones():
+
+    def __init__(self, filepath=TOMBSTONE_FILEPATH):
+        self.filepath = filepath
+        self.compacting_filepath = f'{filepath}.compacting'
+        self._lock = threading.Lock()
+        self._keys = _read_tombstones(self.compacting_filepath) | _read_tombstones(filepath)
+
+        # End a line torn by a crash, so the next tombstone starts on its own line
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            with open(filepath, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+
+    def __len__(self):
+        return len(self._keys)
+
+    def is_rejected(self, word, clip_info):
+        return _key(word, clip_info) in self._keys
+
+    def alive(self, word, clip_info_list):
+        '''clip_info_list without the rows of word that were rejected.'''
+        return [x for x in clip_info_list if _key(word, x) not in self._keys]
+
+    def reject(self, word, clip_info):
+        key = _key(word, clip_info)
+        with self._lock:
+            if key in self._keys:
+                return
+            if os.path.dirname(self.filepath) and not os.path.exists(os.path.dirname(self.filepath)):
+                os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            with open(self.filepath, 'a', newline='') as f:
+                csv.writer(f, delimiter='\t', lineterminator='\n').writerow(key)
+                f.flush()
+                os.fsync(f.fileno())
+            self._keys.add(key)
+
+
+def compact(tombstones_filepath=TOMBSTONE_FILEPATH, vocab_directory=VOCAB_DIRECTORY, index_filepath=VOCAB_INDEX_FILEPATH):
+    '''Removes tombstoned rows from the shards and index. Returns the number of tombstones applied.'''
+    compacting_filepath = f'{tombstones_filepath}.compacting'
+    if not os.path.exists(compacting_filepath):
+        if not os.path.exists(tombstones_filepath):
+            return 0
+        os.replace(tombstones_filepath, compacting_filepath)
+    keys = _read_tombstones(compacting_filepath)
+    dead_words = {key[0] for key in keys}
+    alive = lambda word, rows: [x for x in rows if _key(word, x) not in keys]
+
+    for word in dead_words:
+        tsv_filepath = f'{vocab_directory}/{word[0].upper()}/{word}.tsv'
+        if not os.path.exists(tsv_filepath):
+            continue
+        rows = alive(word, read_tsv_shard(tsv_filepath))
+        if rows == []:
+            os.remove(tsv_filepath)
+            continue
+        tmp_filepath = f'{tsv_filepath}.tmp'
+        with open(tmp_filepath, 'w') as out:
+            writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+            writer.writerow(['video_code', 'start_time', 'end_time'])
+            for row in rows:
+                writer.writerow(row)
+        os.replace(tmp_filepath, tsv_filepath)
+
+    if os.path.exists(index_filepath):
+        with VocabularyIndex(index_filepath) as index:
+            postings_by_word = {word: alive(word, index.lookup(word)) if word in dead_words else index.lookup(word) for word in index}
+        write_index({word: rows for word, rows in postings_by_word.items() if rows}, index_filepath)
+
+    # Everything it records is applied, a crash before here just applies it again
+    os.remove(compacting_filepath)
+    return len(keys)
+
+
+_tombstones = None
+_tombstones_lock = threading.Lock()
+
+def get_tombstones():
+    global _tombstones
+    with _tombstones_lock:
+        if _tombstones is None:
+            _tombstones = Tombstones()
+        return _tombstones
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tombstones', default=TOMBSTONE_FILEPATH)
+    parser.add_argument('--vocabulary', default=VOCAB_DIRECTORY)
+    parser.add_argument('--index', default=VOCAB_INDEX_FILEPATH)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('compact', help='Apply the tombstones to the vocabulary shards and index')
+    subparsers.add_parser('count', help='Print how many rows are tombstoned')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        applied = compact(args.tombstones, args.vocabulary, args.index)
+        print(f'Applied {applied} tombstones to {args.vocabulary} and {args.index}')
+
+    elif args.command == 'count':
+        print(f'{len(Tombstones(args.tombstones))} rows are tombstoned')
+
+    else:
+        parser.print_help()
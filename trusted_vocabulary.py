@@ -0,0 +1,153 @@
+import os
+import csv
+import hashlib
+import argparse
+import threading
+from shutil import copyfile
+
+
+'''
+Trusted vocabulary: words clipped successfully before, kept so the next request for them is a
+file lookup.
+
+Each word has a TSV of editions. An edition records where the word was cut from (the clip, its
+speed and the word's interval in it once slowed, as clip_word measures it) and the rendered word
+video, stored in an artifact directory under the SHA1 of its contents. A trusted hit returns the
+stored video without downloading or encoding anything. Editions recorded before artifacts were
+stored, or whose artifact was lost, are rendered from their coordinates once and stored then.
+'''
+
+
+TRUSTED_VOCABULARY_DIRECTORY = './trusted-vocabulary'
+ARTIFACT_DIRECTORY = f'{TRUSTED_VOCABULARY_DIRECTORY}/artifacts'
+
+MAX_EDITIONS = 5
+
+HEADER = 'video_code clip_start_time clip_end_time speed_multiplier word_start_time word_end_time artifact'.split()
+
+# Trusted words are recorded from clip_word's worker threads
+_lock = threading.Lock()
+
+
+def trusted_vocabulary_filepath(safe_word):
+    return f'{TRUSTED_VOCABULARY_DIRECTORY}/{safe_word[0].upper()}/{safe_word}.tsv'
+
+
+def read_trusted_vocabulary(tsv_filepath):
+    '''The editions of a trusted word, each a clip, the word's interval in it once slowed, and its artifact.'''
+    clip_info_list = []
+    with open(tsv_filepath, mode='r') as infile:
+        reader = csv.reader(infile, delimiter='\t')
+        next(reader)
+        for row in reader:
+            clip_info_list += [(
+                row[0],
+                float(row[1]),
+                float(row[2]),
+                float(row[3]),
+                float(row[4]),
+                float(row[5]),
+                # Rows written before artifacts were stored have none
+                row[6] if len(row) > 6 else '',
+            )]
+    return clip_info_list
+
+
+def _write_trusted_vocabulary(tsv_filepath, clip_info_list):
+    tmp_filepath = f'{tsv_filepath}.tmp'
+    with open(tmp_filepath, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(HEADER)
+        for row in clip_info_list:
+            writer.writerow(row)
+    os.replace(tmp_filepath, tsv_filepath)
+
+
+def artifact_filepath(digest):
+    return f'{ARTIFACT_DIRECTORY}/{digest[:2]}/{digest}.mkv'
+
+
+def store_artifact(filepath):
+    '''Copies the word video at filepath into the artifact store, unless identical content is there already. Returns its digest.'''
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            sha1.update(block)
+    digest = sha1.hexdigest()
+
+    # Copied rather than linked, later runs overwrite their outputs in place
+    stored_filepath = artifact_filepath(digest)
+    if not os.path.exists(stored_filepath):
+        os.makedirs(os.path.dirname(stored_filepath), exist_ok=True)
+        tmp_filepath = f'{stored_filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+        copyfile(filepath, tmp_filepath)
+        os.replace(tmp_filepath, stored_filepath)
+    return digest
+
+
+def add_to_trusted_vocabulary(safe_word, clip_info, video_filepath):
+    '''
+    Records a successful clip of safe_word as a new edition, storing video_filepath as its artifact.
+    An edition from the same clip and interval keeps the video stored for it, if it's still there.
+    Once a word has MAX_EDITIONS nothing is recorded or stored. Returns the stored video's filepath,
+    or video_filepath if it wasn't stored.
+    '''
+    coordinates = (
+        clip_info['video_code'],
+        clip_info['clip_start_time'],
+        clip_info['clip_end_time'],
+        clip_info['speed_multiplier'],
+        clip_info['start_time'],
+        clip_info['end_time'],
+    )
+
+    filepath = trusted_vocabulary_filepath(safe_word)
+    with _lock:
+        editions = read_trusted_vocabulary(filepath) if os.path.exists(filepath) else []
+        same = [i for i, edition in enumerate(editions) if edition[:6] == coordinates]
+        if same == [] and len(editions) >= MAX_EDITIONS:
+            return video_filepath
+        if same and editions[same[0]][6] and os.path.exists(artifact_filepath(editions[same[0]][6])):
+            return artifact_filepath(editions[same[0]][6])
+
+        row = coordinates + (store_artifact(video_filepath),)
+        if same:
+            editions[same[0]] = row
+        else:
+            editions += [row]
+        if not os.path.exists(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        _write_trusted_vocabulary(filepath, editions)
+    return artifact_filepath(row[6])
+
+
+def set_artifact(tsv_filepath, edition, video_filepath):
+    '''Stores video_filepath as the artifact of an existing edition. Returns the stored video's filepath.'''
+    digest = store_artifact(video_filepath)
+    with _lock:
+        editions = read_trusted_vocabulary(tsv_filepath)
+        editions[edition] = editions[edition][:6] + (digest,)
+        _write_trusted_vocabulary(tsv_filepath, editions)
+    return artifact_filepath(digest)
+
+
+def trusted_artifact(tsv_filepath, edition=0):
+    '''The stored video of an edition, or None if it has to be rendered.'''
+    digest = read_trusted_vocabulary(tsv_filepath)[edition][6]
+    if digest and os.path.exists(artifact_filepath(digest)):
+        return artifact_filepath(digest)
+    return None
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('word')
+    args = parser.parse_args()
+
+    filepath = trusted_vocabulary_filepath(args.word)
+    if not os.path.exists(filepath):
+        print(f'"{args.word}" is not in the trusted vocabulary')
+    else:
+        for i, (video_code, clip_start_time, clip_end_time, speed_multiplier, word_start_time, word_end_time, digest) in enumerate(read_trusted_vocabulary(filepath)):
+            print(f'{i}\t{video_code}\t{clip_start_time}\t{clip_end_time}\t{speed_multiplier}\t{word_start_time}\t{word_end_time}\t{artifact_filepath(digest) if digest else "-"}')
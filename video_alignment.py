@@ -0,0 +1,194 @@
+import os
+import json
+import argparse
+import threading
+from audio_utils import decode_audio
+from speech_to_text import get_recognizer, RecognizedWord
+from youtube_utils import download_full_audio, segment_cache
+
+
+'''
+Word level alignment of whole videos.
+
+Candidates tend to come from the same few videos, and caption timings are only good to a
+second or so. Aligning a video downloads its audio once, recognizes it in overlapping chunks
+short enough for the synchronous API, and stores every word heard with its offsets in the
+source video and its confidence. Words in an aligned video can then be cut directly, without
+downloading and recognizing a clip around each one.
+
+The downloaded audio is registered with the segment cache, so any later clip of an aligned
+video is cut from local audio too.
+'''
+
+
+ALIGNMENT_DIRECTORY = './alignments'
+CHUNK_LENGTH = 50
+CHUNK_OVERLAP = 5
+
+clean_word = lambda x: ''.join([c for c in x.lower() if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+
+
+def alignment_filepath(video_code):
+    return f'{ALIGNMENT_DIRECTORY}/{video_code}.json'
+
+
+class VideoAlignment():
+    '''Every word recognized in one video, with start and end times in seconds of the source video.'''
+
+    def __init__(self, video_code, duration, words):
+        self.video_code = video_code
+        self.duration = duration
+        self.words = words
+
+        self._occurrences = {}
+        for w in words:
+            self._occurrences.setdefault(clean_word(w.word), []).append(w)
+
+    def __repr__(self):
+        return f'VideoAlignment({self.video_code}, {len(self.words)} words over {round(self.duration, 1)}s)'
+
+    def __contains__(self, word):
+        return word in self._occurrences
+
+    def occurrences(self, word):
+        return self._occurrences.get(word, [])
+
+    def best_occurrence(self, word, min_confidence=0):
+        '''The most confident occurrence of word, or None if none reaches min_confidence.'''
+        occurrences = [w for w in self.occurrences(word) if w.confidence >= min_confidence]
+        if occurrences == []:
+            return None
+        return max(occurrences, key=lambda w: w.confidence)
+
+    def words_between(self, start_time, end_time):
+        '''Words lying wholly inside [start_time, end_time].'''
+        return [w for w in self.words if start_time <= w.start_time and w.end_time <= end_time]
+
+    def save(self, filepath=None):
+        filepath = filepath or alignment_filepath(self.video_code)
+        if not os.path.exists(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+
+        tmp_filepath = f'{filepath}.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump({'video_code': self.video_code, 'duration': self.duration, 'words': [list(w) for w in self.words]}, f)
+        os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath) as f:
+            alignment = json.load(f)
+        return cls(alignment['video_code'], alignment['duration'], [RecognizedWord(*w) for w in alignment['words']])
+
+
+_alignments = {}
+_alignments_lock = threading.Lock()
+
+def load_alignment(video_code):
+    '''Returns the VideoAlignment of video_code, or None if it hasn't been aligned.'''
+    with _alignments_lock:
+        if video_code not in _alignments:
+            filepath = alignment_filepath(video_code)
+            _alignments[video_code] = VideoAlignment.load(filepath) if os.path.exists(filepath) else None
+        return _alignments[video_code]
+
+
+def aligned_video_codes():
+    if not os.path.exists(ALIGNMENT_DIRECTORY):
+        return []
+    return sorted(f[:-len('.json')] for f in os.listdir(ALIGNMENT_DIRECTORY) if f.endswith('.json'))
+
+
+def best_aligned_occurrence(word, min_confidence=0.85, exclude=()):
+    '''
+    Searches every aligned video for word, passing over occurrences whose
+    (video_code, start_time, end_time) is in exclude.
+    Returns (video_code, RecognizedWord) of its most confident occurrence, or None.
+    '''
+    best = None
+    for video_code in aligned_video_codes():
+        occurrences = [w for w in load_alignment(video_code).occurrences(word) if (video_code, w.start_time, w.end_time) not in exclude]
+        occurrence = max((w for w in occurrences if w.confidence >= min_confidence), key=lambda w: w.confidence, default=None)
+        if occurrence is not None and (best is None or occurrence.confidence > best[1].confidence):
+            best = (video_code, occurrence)
+    return best
+
+
+def chunk_spans(duration, chunk_length=CHUNK_LENGTH, overlap=CHUNK_OVERLAP):
+    '''
+    Overlapping (start, end) chunks covering [0, duration], each with the part of it that it
+    owns. A word is kept from the chunk owning its midpoint, so words cut by a chunk edge are
+    taken from the neighbouring chunk, where they were heard whole.
+    '''
+    starts = [0]
+    while starts[-1] + chunk_length < duration:
+        starts += [starts[-1] + chunk_length - overlap]
+
+    spans = []
+    for i, start in enumerate(starts):
+        end = min(duration, start + chunk_length)
+        own_start = start + overlap / 2 if i > 0 else 0
+        own_end = end - overlap / 2 if i < len(starts) - 1 else duration
+        spans += [((start, end), (own_start, own_end))]
+    return spans
+
+
+def align_video(video_code, chunk_length=CHUNK_LENGTH, overlap=CHUNK_OVERLAP, log_filepath=''):
+    '''Downloads, recognizes and stores the word alignment of video_code. Returns the VideoAlignment.'''
+    os.makedirs(segment_cache.directory, exist_ok=True)
+    audio_filepath = f'{segment_cache.directory}/{video_code}-full.flac'
+    print(f'Downloading the audio of {video_code}...')
+    download_full_audio(video_code, audio_filepath, log_filepath)
+    audio = decode_audio(audio_filepath, log_filepath=log_filepath)
+
+    # The whole video covers every audio segment cached for it so far. Those being read are left to eviction
+    segment_cache.add(video_code, 'audio', 0, audio.duration, audio_filepath, replaces=segment_cache.overlapping(video_code, 0, audio.duration))
+
+    spans = chunk_spans(audio.duration, chunk_length, overlap)
+    print(f'Recognizing {round(audio.duration, 1)}s of audio in {len(spans)} chunks...')
+    # Each chunk is long enough to come back as several results, all of them are kept
+    transcripts = get_recognizer().recognize_many([audio.slice(*chunk).to_wav_bytes() for chunk, own in spans], long_audio=True)
+
+    words = []
+    for ((chunk_start, chunk_end), (own_start, own_end)), transcript in zip(spans, transcripts):
+        if transcript is None:
+            continue
+        for w in transcript.words:
+            start_time, end_time = chunk_start + w.start_time, chunk_start + w.end_time
+            if own_start <= (start_time + end_time) / 2 < own_end:
+                words += [RecognizedWord(w.word, round(start_time, 3), round(end_time, 3), w.confidence)]
+
+    alignment = VideoAlignment(video_code, audio.duration, words)
+    alignment.save()
+    with _alignments_lock:
+        _alignments[video_code] = alignment
+    print(f'Aligned {len(words)} words in {video_code}')
+    return alignment
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    align_parser = subparsers.add_parser('align', help='Align every word of some videos')
+    align_parser.add_argument('video_codes', nargs='+')
+    align_parser.add_argument('--chunk-length', type=int, default=CHUNK_LENGTH)
+    align_parser.add_argument('--overlap', type=int, default=CHUNK_OVERLAP)
+
+    lookup_parser = subparsers.add_parser('lookup', help='List the aligned occurrences of a word')
+    lookup_parser.add_argument('word')
+    args = parser.parse_args()
+
+    if args.command == 'align':
+        for video_code in args.video_codes:
+            align_video(video_code, args.chunk_length, args.overlap)
+
+    elif args.command == 'lookup':
+        word = clean_word(args.word)
+        for video_code in aligned_video_codes():
+            for w in load_alignment(video_code).occurrences(word):
+                print(f'{video_code}\t{w.start_time}\t{w.end_time}\t{round(w.confidence, 2)}')
+
+    else:
+        parser.print_help()
@@ -0,0 +1,241 @@
+import argparse
+import os
+import csv
+import mmap
+import struct
+
+
+'''
+One file holding the whole caption vocabulary, so a lookup is a binary search
+and a slice instead of opening and parsing vocabulary/<L>/<word>.tsv.
+
+Layout (little endian, every section padded to 8 bytes):
+
+    header            MAGIC, version, word_count, video_count, posting_count
+    word offsets      (word_count + 1) uint32 byte offsets into the word blob
+    word blob         utf-8 words, sorted
+    video offsets     (video_count + 1) uint32 byte offsets into the video blob
+    video blob        ascii video codes
+    posting offsets   (word_count + 1) uint32 row offsets into the posting columns
+    video ids         posting_count uint32 indexes into the video table
+    start times       posting_count float64
+    end times         posting_count float64
+
+Postings of word i live in rows [posting_offsets[i], posting_offsets[i+1]).
+'''
+
+
+VOCAB_DIRECTORY = './vocabulary'
+VOCAB_INDEX_FILEPATH = './vocabulary.idx'
+
+MAGIC = b'STAPVOCB'
+VERSION = 1
+HEADER = struct.Struct('<8sIIII')
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def _string_table(strings):
+    '''Returns (offsets, blob) for a list of strings.'''
+    offsets = [0]
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode()
+        offsets += [len(blob)]
+    return offsets, bytes(blob)
+
+
+def write_index(postings_by_word, index_filepath=VOCAB_INDEX_FILEPATH):
+    '''Writes {word: [(video_code, start_time, end_time), ...]} to a single index file.'''
+    words = sorted(postings_by_word)
+
+    video_codes = sorted({row[0] for rows in postings_by_word.values() for row in rows})
+    video_id = {code: i for i, code in enumerate(video_codes)}
+
+    posting_offsets = [0]
+    video_ids, start_times, end_times = [], [], []
+    for word in words:
+        for video_code, start_time, end_time in postings_by_word[word]:
+            video_ids += [video_id[video_code]]
+            start_times += [float(start_time)]
+            end_times += [float(end_time)]
+        posting_offsets += [len(video_ids)]
+
+    word_offsets, word_blob = _string_table(words)
+    video_offsets, video_blob = _string_table(video_codes)
+
+    sections = [
+        HEADER.pack(MAGIC, VERSION, len(words), len(video_codes), len(video_ids)),
+        struct.pack(f'<{len(word_offsets)}I', *word_offsets),
+        word_blob,
+        struct.pack(f'<{len(video_offsets)}I', *video_offsets),
+        video_blob,
+        struct.pack(f'<{len(posting_offsets)}I', *posting_offsets),
+        struct.pack(f'<{len(video_ids)}I', *video_ids),
+        struct.pack(f'<{len(start_times)}d', *start_times),
+        struct.pack(f'<{len(end_times)}d', *end_times),
+    ]
+
+    # Write next to the target and swap in, so readers never see half an index
+    tmp_filepath = f'{index_filepath}.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        for section in sections:
+            f.write(section)
+            f.write(b'\0' * _pad(len(section)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, index_filepath)
+
+
+def read_tsv_shard(tsv_filepath):
+    '''Reads one vocabulary/<L>/<word>.tsv shard into a list of (video_code, start_time, end_time).'''
+    with open(tsv_filepath, mode='r') as infile:
+        reader = csv.reader(infile, delimiter='\t')
+        next(reader, None)
+        return [(row[0], float(row[1]), float(row[2])) for row in reader if len(row) >= 3]
+
+
+def import_tsv_tree(vocab_directory=VOCAB_DIRECTORY, index_filepath=VOCAB_INDEX_FILEPATH):
+    '''Converts the per-word TSV tree into a single index file. Returns the number of words imported.'''
+    postings_by_word = {}
+    for subdirectory in sorted(os.listdir(vocab_directory)):
+        subdirectory_path = f'{vocab_directory}/{subdirectory}'
+        if not os.path.isdir(subdirectory_path):
+            continue
+        for filename in os.listdir(subdirectory_path):
+            if not filename.endswith('.tsv'):
+                continue
+            word = filename[:-len('.tsv')]
+            postings_by_word.setdefault(word, [])
+            postings_by_word[word] += read_tsv_shard(f'{subdirectory_path}/{filename}')
+
+    write_index(postings_by_word, index_filepath)
+    return len(postings_by_word)
+
+
+class VocabularyIndex():
+    '''Read-only, memory-mapped view of an index written by write_index.'''
+
+    def __init__(self, index_filepath=VOCAB_INDEX_FILEPATH):
+        self.index_filepath = index_filepath
+        self._file = open(index_filepath, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = self._view = memoryview(self._mmap)
+
+        magic, version, word_count, video_count, posting_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{index_filepath} is not a vocabulary index')
+
+        position = HEADER.size + _pad(HEADER.size)
+
+        def take(length, fmt=None):
+            nonlocal position
+            section = view[position:position + length]
+            position += length + _pad(length)
+            return section.cast(fmt) if fmt else section
+
+        self._word_offsets = take(4 * (word_count + 1), 'I')
+        self._word_blob = take(self._word_offsets[-1])
+        video_offsets = take(4 * (video_count + 1), 'I')
+        video_blob = take(video_offsets[-1])
+        self._posting_offsets = take(4 * (word_count + 1), 'I')
+        self._video_ids = take(4 * posting_count, 'I')
+        self._start_times = take(8 * posting_count, 'd')
+        self._end_times = take(8 * posting_count, 'd')
+
+        # The video table is small, decode it once
+        self.video_codes = [bytes(video_blob[video_offsets[i]:video_offsets[i+1]]).decode() for i in range(video_count)]
+        self.word_count = word_count
+        self.posting_count = posting_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.word_count
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def __iter__(self):
+        for i in range(self.word_count):
+            yield self._word(i)
+
+    def close(self):
+        # Views onto the map must be dropped before it can be closed
+        for name in ('_word_offsets', '_word_blob', '_posting_offsets', '_video_ids', '_start_times', '_end_times'):
+            section = self.__dict__.pop(name, None)
+            if section is not None:
+                section.release()
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def _word_bytes(self, i):
+        return bytes(self._word_blob[self._word_offsets[i]:self._word_offsets[i+1]])
+
+    def _word(self, i):
+        return self._word_bytes(i).decode()
+
+    def find(self, word):
+        '''Returns the position of word in the sorted word table, or -1.'''
+        target = word.encode()
+        low, high = 0, self.word_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._word_bytes(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.word_count and self._word_bytes(low) == target:
+            return low
+        return -1
+
+    def postings(self, word):
+        '''Returns zero-copy (video_ids, start_times, end_times) column slices for word.'''
+        i = self.find(word)
+        if i < 0:
+            raise KeyError(word)
+        first, last = self._posting_offsets[i], self._posting_offsets[i+1]
+        return self._video_ids[first:last], self._start_times[first:last], self._end_times[first:last]
+
+    def lookup(self, word):
+        '''Returns [(video_code, start_time, end_time), ...] for word, as get_clip_information does.'''
+        video_ids, start_times, end_times = self.postings(word)
+        return [(self.video_codes[v], s, e) for v, s, e in zip(video_ids, start_times, end_times)]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', default=VOCAB_INDEX_FILEPATH)
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser('import', help='Convert the vocabulary TSV tree into a single index')
+    import_parser.add_argument('--vocabulary', default=VOCAB_DIRECTORY)
+
+    lookup_parser = subparsers.add_parser('lookup', help='Print every occurrence of a word')
+    lookup_parser.add_argument('word')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        word_count = import_tsv_tree(args.vocabulary, args.index)
+        print(f'Imported {word_count} words from {args.vocabulary} into {args.index}')
+
+    elif args.command == 'lookup':
+        with VocabularyIndex(args.index) as index:
+            if args.word not in index:
+                print(f'"{args.word}" is not in {args.index}')
+            else:
+                for video_code, start_time, end_time in index.lookup(args.word):
+                    print(f'{video_code}\t{start_time}\t{end_time}')
+
+    else:
+        parser.print_help()
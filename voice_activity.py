@@ -0,0 +1,84 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+'''
+Local boundary refinement, so the recognizer only has to confirm crops instead of finding them.
+
+Short-time energy and zero-crossing rate are computed over the decoded samples in one
+vectorized pass. A frame counts as silent when its energy is near the clip's noise floor,
+unless a high zero-crossing rate says it's a quiet fricative (the hiss of an s or f) which
+belongs to the word. The boundaries the recognizer proposed are then snapped to the nearest
+edges between silence and speech, giving a few candidate crops ranked by how far they moved.
+'''
+
+
+FRAME_LENGTH = 0.025
+HOP_LENGTH = 0.01
+
+
+def frames(buffer, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+    '''A (frame count, frame size) view of the buffer's samples as floats, frames starting every hop_length seconds.'''
+    samples = buffer.samples.astype(np.float32) / 32768
+    size = int(frame_length * buffer.sample_rate)
+    hop = int(hop_length * buffer.sample_rate)
+    if len(samples) < size:
+        return np.zeros((0, size), dtype=np.float32)
+    count = 1 + (len(samples) - size) // hop
+    return as_strided(samples, shape=(count, size), strides=(hop * samples.strides[0], samples.strides[0]), writeable=False)
+
+
+def short_time_energy(framed):
+    '''Log energy of every frame, in dB.'''
+    return 10 * np.log10(np.mean(framed**2, axis=1) + 1e-10)
+
+
+def zero_crossing_rate(framed):
+    '''Fraction of neighbouring samples in every frame that change sign.'''
+    return np.mean(np.signbit(framed[:, 1:]) != np.signbit(framed[:, :-1]), axis=1)
+
+
+def silent_frames(buffer, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH, energy_ratio=0.25, fricative_zcr=0.3):
+    '''Boolean mask of the frames of buffer that hold no speech.'''
+    framed = frames(buffer, frame_length, hop_length)
+    if len(framed) == 0:
+        return np.zeros(0, dtype=bool)
+    energy = short_time_energy(framed)
+    zcr = zero_crossing_rate(framed)
+
+    # Thresholds follow the clip's own noise floor and speech level
+    floor, peak = np.percentile(energy, 10), np.percentile(energy, 95)
+    quiet = energy < floor + energy_ratio * (peak - floor)
+    fricative = (zcr > fricative_zcr) & (energy > floor + 0.1 * (peak - floor))
+    return quiet & ~fricative
+
+
+def snap_boundaries(buffer, start_time, end_time, max_shift=0.25, padding=0.02, max_candidates=3, min_length=0.1, hop_length=HOP_LENGTH):
+    '''
+    Candidate (start, end) crops of buffer around a proposed word interval.
+
+    Each boundary is moved to the nearest silence/speech edges within max_shift seconds, and
+    padding seconds out into the silence. Candidates are ranked by how far they moved, and the
+    proposed interval itself is the only candidate when no edge is near.
+    '''
+    silent = silent_frames(buffer, hop_length=hop_length)
+    frame_times = np.arange(len(silent)) * hop_length
+
+    # Speech starts where a silent frame is followed by a voiced one, and ends the other way round
+    onsets = frame_times[1:][silent[:-1] & ~silent[1:]] - padding
+    offsets = frame_times[:-1][~silent[:-1] & silent[1:]] + hop_length + padding
+
+    def options(time, edges):
+        nearby = edges[np.abs(edges - time) <= max_shift]
+        nearby = nearby[np.argsort(np.abs(nearby - time))][:2]
+        return [round(float(t), 3) for t in nearby] or [round(time, 3)]
+
+    candidates = []
+    for start in options(start_time, onsets):
+        for end in options(end_time, offsets):
+            start, end = max(0, start), min(buffer.duration, end)
+            if end - start >= min_length and (start, end) not in candidates:
+                candidates += [(start, end)]
+
+    candidates.sort(key=lambda c: abs(c[0] - start_time) + abs(c[1] - end_time))
+    return candidates[:max_candidates] or [(start_time, end_time)]
@@ -1,5 +1,14 @@
-from subprocess import check_output
+from subprocess import check_output, CalledProcessError
+from concurrent.futures import Future
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+from shutil import copyfile
+import os
+import time
+import asyncio
+import threading
 import youtube_dl
+from segment_cache import SegmentCache
 from google.cloud import storage
 
 
@@ -44,12 +53,10 @@ def timecode_to_seconds(timecode):
     return int(h)*60*60 + int(m)*60 + int(s) + float(ms)/1000
 
 
-def download_captions(video_code):
-    video_url = 'https://www.youtube.com/watch?v=' + video_code
-
+def captions_downloader(output_directory='captions'):
     # Define the Youtube extractor to only grab english subtitles
-    ydl = youtube_dl.YoutubeDL({
-        'outtmpl': 'captions/' + video_code,
+    return youtube_dl.YoutubeDL({
+        'outtmpl': output_directory + '/%(id)s',
         'skip_download': True,
         'noplaylist': True,
         'subtitleslangs': ['en'],
@@ -58,14 +65,80 @@ def download_captions(video_code):
         'writeautomaticsub': True
     })
 
+
+def download_captions(video_code, ydl=None):
+    video_url = 'https://www.youtube.com/watch?v=' + video_code
+
+    # Extractors can be reused across many videos, one is only built if none is given
+    if ydl is None:
+        ydl = captions_downloader()
+
     # Download
     with ydl:
         result = ydl.extract_info(video_url)
 
 
+def list_video_codes(url, ydl=None):
+    '''Yields the video codes behind a video, playlist or channel URL without downloading anything.'''
+    if ydl is None:
+        ydl = youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'quiet': True})
+
+    result = ydl.extract_info(url, download=False, process=False)
+
+    # Channels resolve to their uploads playlist first
+    if result.get('_type') in ('url', 'url_transparent'):
+        yield from list_video_codes(result['url'], ydl)
+
+    elif result.get('_type') == 'playlist':
+        for entry in result['entries']:
+            if entry.get('ie_key', 'Youtube') == 'Youtube':
+                yield entry['id']
+            else:
+                yield from list_video_codes(entry['url'], ydl)
+
+    else:
+        yield result['id']
+
+
+class LocalCaptionExtractor():
+    '''
+    Stand-in for youtube_dl.YoutubeDL that serves captions from a local directory of
+    <video_code>.en.vtt files, so caption ingestion can be run and timed offline.
+
+    Watch URLs copy that video's captions to output_directory. Any other URL is treated
+    as a playlist of every caption file in source_directory. delay simulates network time.
+    '''
+
+    def __init__(self, source_directory, output_directory='captions', delay=0):
+        self.source_directory = source_directory
+        self.output_directory = output_directory
+        self.delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def extract_info(self, url, download=True, process=True):
+        if 'watch?v=' not in url:
+            video_codes = sorted(x.replace('.en.vtt', '') for x in os.listdir(self.source_directory) if x.endswith('.en.vtt'))
+            return {'_type': 'playlist', 'entries': [{'_type': 'url', 'ie_key': 'Youtube', 'id': code} for code in video_codes]}
+
+        video_code = url.split('watch?v=')[-1]
+        time.sleep(self.delay)
+        source_filepath = f'{self.source_directory}/{video_code}.en.vtt'
+        if download and os.path.exists(source_filepath):
+            os.makedirs(self.output_directory, exist_ok=True)
+            copyfile(source_filepath, f'{self.output_directory}/{video_code}.en.vtt')
+        return {'id': video_code}
+
+
 def change_audio_speed(audio_filepath, multiplier, output_filepath, log_filepath=''):
-    command = f'ffmpeg -i {audio_filepath} -filter:a "atempo={str(multiplier)}" -vn {output_filepath}'
-    check_output(command, shell=True)
+    command = f'ffmpeg -y -i {audio_filepath} -filter:a "atempo={str(multiplier)}" -vn {output_filepath}'
+    with open(log_filepath or os.devnull, 'a') as log:
+        log.write(f'Executing: {command}\n')
+        check_output(command, shell=True, stderr=log)
 
 
 def change_video_speed(video_filepath, multiplier, output_filepath, log_filepath=''):
@@ -75,20 +148,254 @@ def change_video_speed(video_filepath, multiplier, output_filepath, log_filepath
         check_output(command, shell=True, stderr=log)
 
 
+# Signed stream URLs carry their own expiry, entries are dropped a margin before it
+STREAM_URL_TTL = 60 * 60
+STREAM_URL_EXPIRY_MARGIN = 5 * 60
+
+_stream_urls = {}
+_pending_resolves = {}
+_stream_url_lock = threading.Lock()
+
+
+def _url_expiry(url):
+    '''Returns the unix time a googlevideo URL stops working, or None if it doesn't say.'''
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get('expire')
+    if expire:
+        return int(expire[0])
+    parts = parsed.path.split('/')
+    if 'expire' in parts and parts.index('expire') + 1 < len(parts):
+        return int(parts[parts.index('expire') + 1])
+    return None
+
+
+def _resolve_stream_urls(video_code):
+    ydl = youtube_dl.YoutubeDL({'format': 'bestvideo+bestaudio/best', 'quiet': True, 'no_warnings': True})
+    info = ydl.extract_info(f'https://www.youtube.com/watch?v={video_code}', download=False)
+
+    # Merged formats list the video and audio stream separately, single files serve both
+    formats = info.get('requested_formats') or [info]
+    video_url = next((f['url'] for f in formats if f.get('vcodec') != 'none'), formats[0]['url'])
+    audio_url = next((f['url'] for f in formats if f.get('acodec') != 'none'), formats[-1]['url'])
+    return {'video': video_url, 'audio': audio_url}
+
+
+def resolve_stream_urls(video_code, log_filepath=''):
+    '''
+    Returns {'video': url, 'audio': url} for video_code, resolving through youtube_dl in process.
+
+    Results are shared across threads until shortly before the signed URLs expire. Callers
+    asking for a code that is already being resolved wait on that resolve instead of starting one.
+    '''
+    with _stream_url_lock:
+        cached = _stream_urls.get(video_code)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        pending = _pending_resolves.get(video_code)
+        if pending is None:
+            pending = _pending_resolves[video_code] = Future()
+            resolving = True
+        else:
+            resolving = False
+
+    if not resolving:
+        return pending.result()
+
+    try:
+        urls = _resolve_stream_urls(video_code)
+        expiries = [_url_expiry(url) for url in urls.values()]
+        expires_at = min([e for e in expiries if e is not None] or [time.time() + STREAM_URL_TTL]) - STREAM_URL_EXPIRY_MARGIN
+        with _stream_url_lock:
+            _stream_urls[video_code] = (expires_at, urls)
+        pending.set_result(urls)
+    except Exception as e:
+        pending.set_exception(e)
+        raise
+    finally:
+        with _stream_url_lock:
+            del _pending_resolves[video_code]
+
+    if log_filepath:
+        with open(log_filepath, 'a') as log:
+            log.write(f'Resolved stream URLs for {video_code}, valid for {int(expires_at - time.time())}s\n')
+    return urls
+
+
+def forget_stream_urls(video_code):
+    '''Drops cached URLs for video_code, e.g. after they were refused.'''
+    with _stream_url_lock:
+        _stream_urls.pop(video_code, None)
+
+
 def video_code_to_url(video_code, log_filepath=''):
-    url = f'https://www.youtube.com/watch?v={video_code}'
-    command = f'youtube-dl -g {url}'
-    with open(log_filepath, 'a') as log:
-        response = check_output(command, shell=True, stderr=log).decode().split('\n')[:-1]
-    return response
+    urls = resolve_stream_urls(video_code, log_filepath)
+    return [urls['video'], urls['audio']]
+
+segment_cache = SegmentCache()
+
 
 # TODO: If you start to close to the beginning of a video, we fail for lookahead
-def download_video(video_code, start_time, end_time, output, safety_buffer=5, lookahead=10, log_filepath=''):
-    clip_length = end_time - start_time + (2 * safety_buffer)
+def download_audio(video_code, start_time, end_time, output, safety_buffer=5, lookahead=10, log_filepath='', cache=True):
+    '''
+    Writes [start_time, end_time] of video_code's audio, widened by safety_buffer, to output as mono FLAC.
+    Identical or overlapping spans fetched earlier are cut from local segments instead.
+    '''
+    span_start = start_time - safety_buffer
+    span_end = end_time + safety_buffer
 
-    # Get the true URLs of audio and video from the video_code
-    url_one, url_two = video_code_to_url(video_code, log_filepath)
+    def download(span_start, span_end, filepath):
+        download_audio_span(video_code, span_start, span_end, filepath, lookahead, log_filepath)
 
-    ffmpeg_command = f'ffmpeg -y -ss {seconds_to_timecode(start_time - lookahead)} -i "{url_one}" -ss {seconds_to_timecode(start_time - lookahead)} -i "{url_two}" -map 0:v -map 1:a -ss {lookahead - safety_buffer} -t {seconds_to_timecode(clip_length)} -c:v libx264 -c:a aac {output}'
-    with open(log_filepath, 'a') as log:
-        check_output(ffmpeg_command, shell=True, stderr=log)
+    if not cache:
+        return download(span_start, span_end, output)
+    segment_cache.fetch(video_code, span_start, span_end, output, download, kind='audio', codec_args='-vn -c:a flac -ac 1', extension='flac', log_filepath=log_filepath)
+
+
+def download_audio_span(video_code, span_start, span_end, output, lookahead=10, log_filepath=''):
+    clip_length = span_end - span_start
+
+    for retry in (False, True):
+        audio_url = resolve_stream_urls(video_code, log_filepath)['audio']
+
+        ffmpeg_command = f'ffmpeg -y -ss {seconds_to_timecode(span_start - lookahead)} -i "{audio_url}" -map 0:a -ss {lookahead} -t {seconds_to_timecode(clip_length)} -vn -c:a flac -ac 1 {output}'
+        try:
+            with open(log_filepath, 'a') as log:
+                check_output(ffmpeg_command, shell=True, stderr=log)
+            return
+        except CalledProcessError:
+            if retry:
+                raise
+            forget_stream_urls(video_code)
+
+
+def download_full_audio(video_code, output, log_filepath=''):
+    '''Downloads the whole audio stream of video_code as 16kHz mono FLAC.'''
+    for retry in (False, True):
+        audio_url = resolve_stream_urls(video_code, log_filepath)['audio']
+
+        ffmpeg_command = f'ffmpeg -y -i "{audio_url}" -map 0:a -vn -c:a flac -ac 1 -ar 16000 {output}'
+        try:
+            with open(log_filepath or os.devnull, 'a') as log:
+                log.write(f'Executing: {ffmpeg_command}\n')
+                check_output(ffmpeg_command, shell=True, stderr=log)
+            return
+        except CalledProcessError:
+            if retry:
+                raise
+            forget_stream_urls(video_code)
+
+
+def slowed_clip_command(video_code, start_time, end_time, speed, audio_output=None, video_output=None, safety_buffer=5, lookahead=10, log_filepath=''):
+    '''
+    Builds the single ffmpeg pass of fetch_slowed_clip, resolving stream URLs if no cached segment
+    covers the span. Returns (command, finish), where finish(succeeded) must be called once the
+    command has run, however it ended, to release the cached segment it reads, register the
+    segment it teed off, or delete it and drop URLs that may have stopped working (unless
+    refused=False, e.g. when the command was cancelled).
+    '''
+    span_start = round(start_time - safety_buffer, 3)
+    span_end = round(end_time + safety_buffer, 3)
+    clip_length = span_end - span_start
+    want_video = video_output is not None
+
+    # Only audio is cached, and the cached segment is pinned so it isn't evicted while ffmpeg reads it
+    cached = segment_cache.lookup(video_code, span_start, span_end) if not want_video else None
+    segment_filepath = None
+    if cached is not None:
+        # Local input seeks are accurate, so trim from the start of the seek
+        inputs = ['-ss', str(round(span_start - cached["start"], 3)), '-i', cached["filepath"]]
+        video_stream, audio_stream, trim_start = '0:v', '0:a', 0
+    else:
+        urls = resolve_stream_urls(video_code, log_filepath)
+        seek = seconds_to_timecode(span_start - lookahead)
+        inputs = ['-ss', seek, '-i', urls["audio"]]
+        audio_stream, trim_start = '0:a', lookahead
+        if want_video:
+            inputs = ['-ss', seek, '-i', urls["video"]] + inputs
+            video_stream, audio_stream = '0:v', '1:a'
+        os.makedirs(segment_cache.directory, exist_ok=True)
+        segment_filepath = segment_cache.segment_filepath(video_code, 'audio', span_start, span_end, 'flac')
+
+    # Trim once, then fan the audio out to every output that needs it
+    audio_outputs = [label for label, wanted in (('raw', segment_filepath), ('mono', audio_output), ('av', video_output)) if wanted]
+    tempo = f'atempo={speed}' if speed != 1 else 'anull'
+    graph = [f'[{audio_stream}]atrim=start={trim_start}:duration={round(clip_length, 3)},asetpts=PTS-STARTPTS,asplit={len(audio_outputs)}' + ''.join(f'[{l}]' for l in audio_outputs)]
+    for label in ('mono', 'av'):
+        if label in audio_outputs:
+            graph += [f'[{label}]{tempo}[{label}_slow]']
+    if want_video:
+        graph += [f'[{video_stream}]trim=start={trim_start}:duration={round(clip_length, 3)},setpts=PTS-STARTPTS,setpts={float(1/speed)}*PTS[v_slow]']
+
+    outputs = []
+    if segment_filepath:
+        outputs += ['-map', '[raw]', '-c:a', 'flac', '-ac', '1', segment_filepath]
+    if audio_output:
+        outputs += ['-map', '[mono_slow]', '-c:a', 'flac', '-ac', '1', audio_output]
+    if video_output:
+        outputs += ['-map', '[v_slow]', '-map', '[av_slow]', '-c:v', 'libx264', '-c:a', 'aac', video_output]
+
+    def finish(succeeded, refused=True):
+        if cached is not None:
+            segment_cache.release(cached)
+        if succeeded and segment_filepath:
+            segment_cache.add(video_code, 'audio', span_start, span_end, segment_filepath)
+        elif segment_filepath and os.path.exists(segment_filepath):
+            os.remove(segment_filepath)
+        if not succeeded and refused and cached is None:
+            forget_stream_urls(video_code)
+
+    return ['ffmpeg', '-y'] + inputs + ['-filter_complex', ';'.join(graph)] + outputs, finish
+
+
+def fetch_slowed_clip(video_code, start_time, end_time, speed, audio_output=None, video_output=None, safety_buffer=5, lookahead=10, log_filepath=''):
+    '''
+    Fetches, slows and converts a clip in a single ffmpeg pass with several outputs:
+    slowed mono FLAC for recognition (audio_output) and/or slowed video (video_output).
+
+    Reads from a cached segment when one covers the span, otherwise from the stream URLs,
+    in which case the unslowed mono audio is teed into the segment cache in the same pass.
+    '''
+    command, finish = slowed_clip_command(video_code, start_time, end_time, speed, audio_output, video_output, safety_buffer, lookahead, log_filepath)
+    try:
+        with open(log_filepath or os.devnull, 'a') as log:
+            log.write(f'Executing: {" ".join(command)}\n')
+            check_output(command, stderr=log)
+    except CalledProcessError:
+        finish(False)
+        raise
+    except BaseException:
+        finish(False, refused=False)
+        raise
+    finish(True)
+
+
+async def run_command_async(command, log_filepath=''):
+    '''Runs command without blocking the event loop. Raises CalledProcessError like check_output, and kills it if cancelled.'''
+    with open(log_filepath or os.devnull, 'a') as log:
+        log.write(f'Executing: {" ".join(command)}\n')
+        log.flush()
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL, stderr=log)
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+    if returncode != 0:
+        raise CalledProcessError(returncode, command)
+
+
+async def fetch_slowed_clip_async(video_code, start_time, end_time, speed, audio_output=None, video_output=None, safety_buffer=5, lookahead=10, log_filepath=''):
+    '''fetch_slowed_clip for the event loop. Resolving stream URLs blocks in youtube_dl, so it runs on the default executor.'''
+    loop = asyncio.get_running_loop()
+    command, finish = await loop.run_in_executor(None, partial(slowed_clip_command, video_code, start_time, end_time, speed, audio_output, video_output, safety_buffer, lookahead, log_filepath))
+    try:
+        await run_command_async(command, log_filepath)
+    except CalledProcessError:
+        finish(False)
+        raise
+    except BaseException:
+        # Cancelled, most likely
+        finish(False, refused=False)
+        raise
+    finish(True)